@@ -0,0 +1,260 @@
+"""
+Admission control for recognition jobs.
+Estimates each job's cost from its pixel count and requested outputs,
+rejects work beyond the configured budgets with a retry hint, and starts
+admitted jobs in weighted fair order across clients so one heavy user
+cannot starve everyone else.
+"""
+
+import asyncio
+import hashlib
+import io
+import itertools
+import logging
+import math
+import os
+import threading
+from typing import Dict, Optional
+
+from PIL import Image
+
+from audiveris_client import AUDIVERIS_MAX_CONCURRENCY, runtime_history
+
+logger = logging.getLogger(__name__)
+
+# Jobs running at once across all clients, and per client
+ADMISSION_MAX_RUNNING = int(os.getenv("ADMISSION_MAX_RUNNING", str(AUDIVERIS_MAX_CONCURRENCY)))
+CLIENT_MAX_CONCURRENCY = int(os.getenv("CLIENT_MAX_CONCURRENCY", "2"))
+# Queue budgets; costs are in estimated engine seconds
+CLIENT_MAX_QUEUED = int(os.getenv("CLIENT_MAX_QUEUED", "8"))
+CLIENT_MAX_QUEUED_COST = float(os.getenv("CLIENT_MAX_QUEUED_COST", "600"))
+ADMISSION_MAX_QUEUED_COST = float(os.getenv("ADMISSION_MAX_QUEUED_COST", "3600"))
+# Relative share per client, e.g. "client:node-backend=4,key:0123abcd=2"
+CLIENT_WEIGHTS = os.getenv("CLIENT_WEIGHTS", "")
+
+# Extra seconds per requested output format (conversions after recognition)
+OUTPUT_COSTS = {"musicxml": 0.0, "midi": 1.0, "pdf": 5.0, "all": 6.0}
+# The in-process recognizer costs about this much regardless of size
+NATIVE_COST = 0.5
+
+
+class AdmissionRejected(Exception):
+    """Job exceeds an admission budget; retry_after is a hint in seconds."""
+
+    def __init__(self, reason: str, message: str, retry_after: int):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """Parse "client=weight" pairs separated by commas."""
+    weights = {}
+    for item in spec.split(","):
+        client, _, weight = item.strip().rpartition("=")
+        if client:
+            try:
+                weights[client] = max(float(weight), 0.01)
+            except ValueError:
+                logger.warning(f"Ignoring invalid client weight: {item}")
+    return weights
+
+
+def client_identity(headers, client_host: Optional[str] = None) -> str:
+    """
+    Identity used for fairness and budgets: the API key (hashed, so it never
+    shows up in logs or metrics), else the client id header set by the Node
+    backend, else the remote address.
+    """
+    api_key = headers.get("x-api-key")
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    client_id = headers.get("x-client-id")
+    if client_id:
+        return "client:" + client_id.strip()[:64]
+    return "ip:" + (client_host or "unknown")
+
+
+def upload_megapixels(content: bytes) -> float:
+    """Pixel count of an uploaded image, read from its header only."""
+    try:
+        with Image.open(io.BytesIO(content)) as img:
+            width, height = img.size
+        return width * height / 1_000_000
+    except Exception as e:
+        logger.warning(f"Could not read upload size: {e}")
+        return 1.0
+
+
+def estimate_cost(megapixels: float, output_format: str = "musicxml",
+                  engine: str = "auto", variants: int = 1) -> float:
+    """
+    Estimated engine seconds for a job: observed Audiveris seconds per
+    megapixel times the image size for each variant, plus conversions.
+    Auto-routed jobs are costed as Audiveris runs, since they may fall back.
+    """
+    if engine == "native":
+        per_variant = NATIVE_COST
+    else:
+        per_variant = runtime_history.seconds_per_megapixel * max(megapixels, 0.5)
+    return round(per_variant * variants + OUTPUT_COSTS.get(output_format, 0.0), 2)
+
+
+class Ticket:
+    """A job's place in the admission queue."""
+
+    def __init__(self, client: str, cost: float, finish_tag: float, sequence: int):
+        self.client = client
+        self.cost = cost
+        self.finish_tag = finish_tag
+        self.sequence = sequence
+        self.state = "queued"
+        self.started = asyncio.get_running_loop().create_future()
+
+
+class FairScheduler:
+    """
+    Weighted fair queue of admitted jobs.
+
+    Each ticket gets a virtual finish tag (the later of the current virtual
+    time and the client's previous tag, plus cost / weight); the queued
+    ticket with the smallest tag whose client is below its concurrency
+    limit starts next. Light users therefore overtake a backlog of large
+    scans from one client. All methods run on the event loop.
+    """
+
+    def __init__(self, max_running: int = ADMISSION_MAX_RUNNING,
+                 client_concurrency: int = CLIENT_MAX_CONCURRENCY,
+                 weights: Optional[Dict[str, float]] = None):
+        self.max_running = max(1, max_running)
+        self.client_concurrency = max(1, client_concurrency)
+        self.weights = weights if weights is not None else parse_weights(CLIENT_WEIGHTS)
+        self.virtual_time = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self._queue = []
+        self._running = []
+        self._last_tags = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()  # guards counters read by stats()
+
+    def admit(self, client: str, cost: float) -> Ticket:
+        """
+        Queue a job or reject it.
+
+        Raises:
+            AdmissionRejected: If the client's or the global queue budget
+                would be exceeded
+        """
+        client_queued = [t for t in self._queue if t.client == client]
+        client_cost = sum(t.cost for t in client_queued)
+        client_running = [t for t in self._running if t.client == client]
+        queued_cost = sum(t.cost for t in self._queue)
+
+        rejection = None
+        if len(client_queued) >= CLIENT_MAX_QUEUED:
+            rejection = ("client_queue_full", f"Too many queued jobs for this client "
+                                              f"({len(client_queued)})")
+        elif client_queued and client_cost + cost > CLIENT_MAX_QUEUED_COST:
+            rejection = ("client_budget", f"Queued work for this client would exceed "
+                                          f"{CLIENT_MAX_QUEUED_COST:.0f}s")
+        elif self._queue and queued_cost + cost > ADMISSION_MAX_QUEUED_COST:
+            rejection = ("server_busy", "Server queue is full")
+
+        if rejection:
+            if rejection[0] == "server_busy":
+                backlog = queued_cost + sum(t.cost for t in self._running)
+                slots = self.max_running
+            else:
+                backlog = client_cost + sum(t.cost for t in client_running)
+                slots = min(self.client_concurrency, self.max_running)
+            retry_after = max(1, math.ceil(backlog / slots))
+            with self._lock:
+                self.rejected += 1
+            logger.info(f"Rejected job from {client}: {rejection[1]} (retry after {retry_after}s)")
+            raise AdmissionRejected(rejection[0], rejection[1], retry_after)
+
+        weight = self.weights.get(client, 1.0)
+        start_tag = max(self.virtual_time, self._last_tags.get(client, 0.0))
+        ticket = Ticket(client, cost, start_tag + cost / weight, next(self._sequence))
+        self._last_tags[client] = ticket.finish_tag
+        self._queue.append(ticket)
+        with self._lock:
+            self.admitted += 1
+        self._dispatch()
+        return ticket
+
+    async def wait_turn(self, ticket: Ticket, cancel_event: Optional[threading.Event] = None,
+                        poll_interval: float = 0.25) -> bool:
+        """
+        Wait until the ticket may start.
+
+        Returns:
+            False if cancel_event was set while the ticket was still queued
+            (it is then removed from the queue)
+        """
+        while not ticket.started.done():
+            if cancel_event is not None and cancel_event.is_set():
+                self.release(ticket)
+                return False
+            try:
+                await asyncio.wait_for(asyncio.shield(ticket.started), timeout=poll_interval)
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    def release(self, ticket: Ticket):
+        """Remove a finished or abandoned ticket and start the next ones."""
+        if ticket.state == "queued":
+            self._queue.remove(ticket)
+        elif ticket.state == "running":
+            self._running.remove(ticket)
+        ticket.state = "done"
+        self._dispatch()
+
+    def position(self, ticket: Ticket) -> int:
+        """Number of queued tickets that would start before this one."""
+        if ticket.state != "queued":
+            return 0
+        key = (ticket.finish_tag, ticket.sequence)
+        return sum(1 for t in self._queue if (t.finish_tag, t.sequence) < key)
+
+    def _dispatch(self):
+        while len(self._running) < self.max_running:
+            running_per_client = {}
+            for t in self._running:
+                running_per_client[t.client] = running_per_client.get(t.client, 0) + 1
+            eligible = [t for t in self._queue
+                        if running_per_client.get(t.client, 0) < self.client_concurrency]
+            if not eligible:
+                return
+            ticket = min(eligible, key=lambda t: (t.finish_tag, t.sequence))
+            self._queue.remove(ticket)
+            self._running.append(ticket)
+            ticket.state = "running"
+            self.virtual_time = max(self.virtual_time, ticket.finish_tag - ticket.cost /
+                                    self.weights.get(ticket.client, 1.0))
+            ticket.started.set_result(None)
+
+    def stats(self) -> Dict:
+        """Queue state for the metrics endpoint."""
+        with self._lock:
+            counters = {"admitted": self.admitted, "rejected": self.rejected}
+        clients = {}
+        for state, tickets in (("queued", self._queue), ("running", self._running)):
+            for t in tickets:
+                entry = clients.setdefault(t.client, {"queued": 0, "running": 0, "cost": 0.0})
+                entry[state] += 1
+                entry["cost"] = round(entry["cost"] + t.cost, 2)
+        return {
+            **counters,
+            "queued": len(self._queue),
+            "running": len(self._running),
+            "queued_cost": round(sum(t.cost for t in self._queue), 2),
+            "max_running": self.max_running,
+            "client_concurrency": self.client_concurrency,
+            "clients": clients,
+        }
+
+
+scheduler = FairScheduler()
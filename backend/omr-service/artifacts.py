@@ -0,0 +1,211 @@
+"""
+Serving of recognition artifacts.
+Job outputs never change once written, so downloads get content-hash
+ETags, long-lived caching and stored compressed variants of MusicXML
+(created on first request and reused afterwards). Small artifacts can also
+be embedded in the recognition response itself.
+"""
+
+import base64
+import gzip
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is always available
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Downloadable artifact types; anything else in the output directory
+# (Audiveris project files, logs, compressed variants) is not served
+MEDIA_TYPES = {
+    '.xml': 'application/xml',
+    '.musicxml': 'application/vnd.recordare.musicxml+xml',
+    '.mxl': 'application/vnd.recordare.musicxml',
+    '.mid': 'audio/midi',
+    '.midi': 'audio/midi',
+    '.pdf': 'application/pdf'
+}
+# Plain-text formats worth compressing (.mxl is already zipped, MIDI is tiny)
+COMPRESSIBLE_SUFFIXES = {'.xml', '.musicxml'}
+# Plain names only: no path separators, no hidden files
+ARTIFACT_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+# Artifact names contain the job id and are written once
+ARTIFACT_CACHE_CONTROL = os.getenv("ARTIFACT_CACHE_CONTROL", "public, max-age=31536000, immutable")
+
+# Stored variant suffix per content coding, in order of preference
+VARIANT_SUFFIXES = OrderedDict([("br", ".br"), ("gzip", ".gz")])
+if brotli is None:
+    del VARIANT_SUFFIXES["br"]
+
+# Inline delivery: artifact types embedded in responses on request, and the
+# largest payload (after compression) embedded rather than linked
+INLINE_FILE_TYPES = ("musicxml", "midi")
+INLINE_MAX_BYTES = int(os.getenv("INLINE_MAX_BYTES", str(256 * 1024)))
+
+# Number of file hashes remembered (keyed by path, size and mtime)
+ETAG_CACHE_SIZE = 4096
+
+_etag_cache = OrderedDict()
+_etag_lock = threading.Lock()
+_compress_lock = threading.Lock()
+
+
+def resolve_artifact(directory: Path, filename: str) -> Optional[Path]:
+    """
+    Map a requested file name to an artifact inside directory.
+
+    Returns:
+        The artifact path, or None if the name is not a servable artifact
+        (unknown type, path components, or not an existing file)
+    """
+    if not ARTIFACT_NAME_PATTERN.match(filename) or ".." in filename:
+        return None
+    if Path(filename).suffix.lower() not in MEDIA_TYPES:
+        return None
+
+    base = directory.resolve()
+    path = (base / filename).resolve()
+    if path.parent != base or not path.is_file():
+        return None
+    return path
+
+
+def content_etag(path: Path) -> str:
+    """Strong ETag from the file's content hash (cached while the file is unchanged)."""
+    stat = path.stat()
+    cache_key = (str(path), stat.st_size, stat.st_mtime_ns)
+    with _etag_lock:
+        etag = _etag_cache.get(cache_key)
+        if etag is not None:
+            _etag_cache.move_to_end(cache_key)
+            return etag
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    etag = f'"{digest.hexdigest()[:32]}"'
+
+    with _etag_lock:
+        _etag_cache[cache_key] = etag
+        while len(_etag_cache) > ETAG_CACHE_SIZE:
+            _etag_cache.popitem(last=False)
+    return etag
+
+
+def variant_etag(etag: str, encoding: Optional[str]) -> str:
+    """ETag of an encoded representation (distinct from the identity one)."""
+    if not encoding:
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header matches etag (weak comparison)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+def negotiate_encoding(path: Path, accept_encoding: str) -> Optional[str]:
+    """
+    Pick the stored content coding for a download.
+
+    Returns:
+        "br" or "gzip", or None to send the file as is
+    """
+    if path.suffix.lower() not in COMPRESSIBLE_SUFFIXES or not accept_encoding:
+        return None
+
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+
+    for encoding in VARIANT_SUFFIXES:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > 0:
+            return encoding
+    return None
+
+
+def compressed_variant(path: Path, encoding: str) -> Path:
+    """
+    Stored compressed copy of an artifact, created if missing or stale.
+    Written to a temporary name and renamed, so readers never see a partial file.
+    """
+    variant = path.with_name(path.name + VARIANT_SUFFIXES[encoding])
+    source_mtime = path.stat().st_mtime_ns
+    if variant.exists() and variant.stat().st_mtime_ns >= source_mtime:
+        return variant
+
+    with _compress_lock:
+        if variant.exists() and variant.stat().st_mtime_ns >= source_mtime:
+            return variant
+        data = path.read_bytes()
+        if encoding == "br":
+            compressed = brotli.compress(data, quality=11)
+        else:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+
+        tmp = variant.with_name(f"{variant.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(compressed)
+        os.replace(tmp, variant)
+
+    logger.info(f"Stored {encoding} variant of {path.name}: "
+                f"{len(data)} -> {len(compressed)} bytes")
+    return variant
+
+
+def inline_artifacts(files: Dict[str, str], max_bytes: int = INLINE_MAX_BYTES) -> Dict[str, Dict]:
+    """
+    Embed small artifacts in a response, base64 encoded. MusicXML is sent as
+    its stored gzip variant (content_encoding "gzip"); MIDI as is. Files
+    whose payload exceeds max_bytes are left to their download URL.
+
+    Returns:
+        Dictionary mapping file type to filename, media type, content
+        encoding, original size and data
+    """
+    inline = {}
+    for file_type in INLINE_FILE_TYPES:
+        path = files.get(file_type)
+        if not path or not Path(path).is_file():
+            continue
+        path = Path(path)
+
+        encoding = "gzip" if path.suffix.lower() in COMPRESSIBLE_SUFFIXES else None
+        payload_path = compressed_variant(path, encoding) if encoding else path
+        payload_size = payload_path.stat().st_size
+        if payload_size > max_bytes:
+            logger.info(f"Not inlining {path.name}: {payload_size} bytes > {max_bytes}")
+            continue
+
+        inline[file_type] = {
+            "filename": path.name,
+            "media_type": MEDIA_TYPES.get(path.suffix.lower(), 'application/octet-stream'),
+            "content_encoding": encoding,
+            "size": path.stat().st_size,
+            "data": base64.b64encode(payload_path.read_bytes()).decode("ascii")
+        }
+    return inline
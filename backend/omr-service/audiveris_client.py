@@ -6,15 +6,224 @@ Handles communication with Audiveris engine.
 import subprocess
 import logging
 import os
+import re
+import signal
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Callable, Dict, Iterable, List, Optional
 import xml.etree.ElementTree as ET
+from PIL import Image
+
+from shared_state import OMR_STATE_DIR, SHARED_STATE, FileLockSemaphore
 
 logger = logging.getLogger(__name__)
 
 # Audiveris configuration
 AUDIVERIS_JAR = os.getenv("AUDIVERIS_JAR", "/opt/audiveris/Audiveris.jar")
 JAVA_PATH = os.getenv("JAVA_PATH", "java")
+# Number of Audiveris output lines retained for error reports
+AUDIVERIS_LOG_LINES = int(os.getenv("AUDIVERIS_LOG_LINES", "200"))
+
+# Maximum number of concurrent Audiveris processes (the pool size; shared by
+# all workers in multi-worker mode)
+AUDIVERIS_MAX_CONCURRENCY = int(os.getenv("AUDIVERIS_MAX_CONCURRENCY", str(os.cpu_count() or 1)))
+
+# Recognition engines: auto tries the in-process recognizer for simple
+# single-staff melodies and falls back to Audiveris below this confidence
+OMR_ENGINES = ("auto", "audiveris", "native")
+OMR_ENGINE = os.getenv("OMR_ENGINE", "auto")
+NATIVE_MIN_CONFIDENCE = float(os.getenv("NATIVE_MIN_CONFIDENCE", "0.8"))
+
+# Timeout budget: safety factor times the expected runtime for the image's
+# pixel count, clamped between a floor and a hard ceiling (seconds)
+AUDIVERIS_TIMEOUT_MIN = float(os.getenv("AUDIVERIS_TIMEOUT_MIN", "30"))
+AUDIVERIS_TIMEOUT_MAX = float(os.getenv("AUDIVERIS_TIMEOUT_MAX", "300"))
+AUDIVERIS_TIMEOUT_FACTOR = float(os.getenv("AUDIVERIS_TIMEOUT_FACTOR", "3.0"))
+# Seconds per megapixel assumed until real runs have been observed
+DEFAULT_SECONDS_PER_MEGAPIXEL = float(os.getenv("AUDIVERIS_SECONDS_PER_MEGAPIXEL", "8.0"))
+
+# Audiveris pipeline steps in execution order, mapped to the coarse
+# progress stages reported to clients
+AUDIVERIS_STEPS = [
+    ("LOAD", "load"),
+    ("BINARY", "binarize"),
+    ("SCALE", "scale"),
+    ("GRID", "grid"),
+    ("HEADERS", "symbols"),
+    ("STEM_SEEDS", "symbols"),
+    ("BEAMS", "symbols"),
+    ("LEDGERS", "symbols"),
+    ("HEADS", "symbols"),
+    ("STEMS", "symbols"),
+    ("REDUCTION", "symbols"),
+    ("CUE_BEAMS", "symbols"),
+    ("TEXTS", "symbols"),
+    ("MEASURES", "symbols"),
+    ("CHORDS", "symbols"),
+    ("CURVES", "symbols"),
+    ("SYMBOLS", "symbols"),
+    ("LINKS", "symbols"),
+    ("RHYTHMS", "symbols"),
+    ("PAGE", "symbols"),
+]
+STEP_PATTERN = re.compile(r"\b(" + "|".join(step for step, _ in AUDIVERIS_STEPS) + r")\b")
+EXPORT_PATTERN = re.compile(r"\bexport", re.IGNORECASE)
+
+
+class AudiverisError(RuntimeError):
+    """Audiveris run failed; carries the tail of its output for error reports."""
+
+    def __init__(self, message: str, log_tail: Optional[List[str]] = None):
+        super().__init__(message)
+        self.log_tail = log_tail or []
+
+
+class AudiverisCancelled(AudiverisError):
+    """Audiveris run was cancelled before it finished."""
+
+
+class RuntimeHistory:
+    """
+    Tracks observed Audiveris runtime per megapixel.
+    Uses an exponentially weighted moving average so the estimate follows
+    changes in load and engine version.
+    """
+
+    def __init__(self, initial: float = DEFAULT_SECONDS_PER_MEGAPIXEL, alpha: float = 0.2):
+        self.seconds_per_megapixel = initial
+        self.alpha = alpha
+        self.samples = 0
+        self._lock = threading.Lock()
+
+    def record(self, elapsed: float, megapixels: float):
+        # Very small images are dominated by JVM startup; don't let them skew the rate
+        rate = elapsed / max(megapixels, 0.5)
+        with self._lock:
+            if self.samples == 0:
+                self.seconds_per_megapixel = rate
+            else:
+                self.seconds_per_megapixel += self.alpha * (rate - self.seconds_per_megapixel)
+            self.samples += 1
+
+    def timeout_for(self, megapixels: float) -> float:
+        """Timeout budget for an image of the given size."""
+        with self._lock:
+            expected = self.seconds_per_megapixel * max(megapixels, 0.5)
+        budget = AUDIVERIS_TIMEOUT_FACTOR * expected
+        return max(AUDIVERIS_TIMEOUT_MIN, min(AUDIVERIS_TIMEOUT_MAX, budget))
+
+
+runtime_history = RuntimeHistory()
+if SHARED_STATE:
+    audiveris_slots = FileLockSemaphore(os.path.join(OMR_STATE_DIR, "audiveris-slots"),
+                                        AUDIVERIS_MAX_CONCURRENCY)
+else:
+    audiveris_slots = threading.BoundedSemaphore(AUDIVERIS_MAX_CONCURRENCY)
+
+
+def acquire_audiveris_slot(cancel_event: Optional[threading.Event] = None, poll_interval: float = 0.25):
+    """Wait for a free Audiveris pool slot, giving up if the job is cancelled."""
+    while not audiveris_slots.acquire(timeout=poll_interval):
+        if cancel_event is not None and cancel_event.is_set():
+            raise AudiverisCancelled("Audiveris processing cancelled while queued")
+
+
+def image_megapixels(image_path: str) -> float:
+    """Read the pixel count of an image from its header (no full decode)."""
+    try:
+        with Image.open(image_path) as img:
+            width, height = img.size
+        return width * height / 1_000_000
+    except Exception as e:
+        logger.warning(f"Could not read image size for {image_path}: {e}")
+        return 1.0
+
+
+def terminate_process_tree(process: subprocess.Popen, grace_period: float = 3.0):
+    """
+    Stop Audiveris and every process it spawned.
+    The JVM runs in its own session, so the whole process group is signalled.
+    """
+    if process.poll() is not None:
+        return
+    
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, signal.SIGTERM)
+        else:
+            process.terminate()
+        process.wait(timeout=grace_period)
+    except (subprocess.TimeoutExpired, ProcessLookupError):
+        pass
+    
+    if process.poll() is None:
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+
+def parse_progress_line(line: str) -> Optional[Dict]:
+    """
+    Map an Audiveris output line to a progress event.
+    
+    Returns:
+        Dictionary with stage, step and percent complete, or None if the
+        line does not mark the start of a new step
+    """
+    if EXPORT_PATTERN.search(line):
+        return {"stage": "export", "step": "EXPORT", "percent": 95}
+    
+    match = STEP_PATTERN.search(line)
+    if match is None:
+        return None
+    
+    step = match.group(1)
+    for index, (name, stage) in enumerate(AUDIVERIS_STEPS):
+        if name == step:
+            percent = int(90 * index / len(AUDIVERIS_STEPS))
+            return {"stage": stage, "step": step, "percent": percent}
+    return None
+
+
+def consume_output(
+    stream: Iterable[str],
+    log_buffer: deque,
+    progress_callback: Optional[Callable[[Dict], None]] = None
+):
+    """
+    Consume Audiveris output line by line.
+    
+    Lines go to a bounded ring buffer (instead of being held in memory in full)
+    and are parsed into progress events as they arrive.
+    """
+    last_step = None
+    for line in stream:
+        line = line.rstrip()
+        if not line:
+            continue
+        log_buffer.append(line)
+        
+        if line.startswith(("WARN", "ERROR")):
+            logger.warning(f"Audiveris: {line}")
+        else:
+            logger.debug(f"Audiveris: {line}")
+        
+        event = parse_progress_line(line)
+        if event and event["step"] != last_step:
+            last_step = event["step"]
+            if progress_callback:
+                try:
+                    progress_callback(event)
+                except Exception as e:
+                    logger.warning(f"Progress callback failed: {e}")
 
 
 def check_audiveris_installation() -> bool:
@@ -48,7 +257,11 @@ def check_audiveris_installation() -> bool:
 def process_with_audiveris(
     image_path: str,
     output_dir: str,
-    output_format: str = "musicxml"
+    output_format: str = "musicxml",
+    progress_callback: Optional[Callable[[Dict], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+    timeout: Optional[float] = None,
+    publish: Optional[Callable[[str, Dict], None]] = None
 ) -> Dict:
     """
     Process image with Audiveris OMR engine.
@@ -57,6 +270,13 @@ def process_with_audiveris(
         image_path: Path to preprocessed image
         output_dir: Directory for output files
         output_format: Output format (musicxml, midi, pdf)
+        progress_callback: Called with a progress event dict (stage, step,
+            percent) each time Audiveris starts a new step
+        cancel_event: When set, Audiveris is killed and AudiverisCancelled is raised
+        timeout: Time budget in seconds; derived from the image's pixel count
+            and historical runtime when omitted
+        publish: Called as publish(kind, data) with partial results as they
+            become available (see finish_outputs)
     
     Returns:
         Dictionary containing paths to generated files and metadata
@@ -67,13 +287,18 @@ def process_with_audiveris(
     if not check_audiveris_installation():
         raise RuntimeError("Audiveris is not properly installed")
     
-    # Prepare output paths
-    output_dir_path = Path(output_dir)
+    # Prepare output paths (absolute, since Audiveris runs inside the output directory)
+    output_dir_path = Path(output_dir).resolve()
     output_dir_path.mkdir(exist_ok=True)
+    image_path = str(Path(image_path).resolve())
     
     base_name = Path(image_path).stem
     output_base = output_dir_path / base_name
     
+    megapixels = image_megapixels(image_path)
+    if timeout is None:
+        timeout = runtime_history.timeout_for(megapixels)
+    
     # Build Audiveris command
     # Audiveris command line options:
     # -batch: Run in batch mode (no GUI)
@@ -94,66 +319,341 @@ def process_with_audiveris(
     # Set output options
     cmd.extend(["-output", str(output_dir_path)])
     
+    acquire_audiveris_slot(cancel_event)
     try:
-        logger.info(f"Running Audiveris command: {' '.join(cmd)}")
+        logger.info(f"Running Audiveris command: {' '.join(cmd)} (timeout {timeout:.0f}s)")
         
-        # Run Audiveris
-        result = subprocess.run(
+        # Run Audiveris, streaming its merged stdout/stderr through a reader thread.
+        # A new session makes the JVM a process group leader so it can be killed as a tree.
+        started = time.monotonic()
+        process = subprocess.Popen(
             cmd,
-            capture_output=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
             text=True,
-            timeout=120,  # 2 minute timeout
-            cwd=str(output_dir_path)
+            errors="replace",
+            bufsize=1,
+            cwd=str(output_dir_path),
+            start_new_session=True
+        )
+        log_buffer = deque(maxlen=AUDIVERIS_LOG_LINES)
+        reader = threading.Thread(
+            target=consume_output,
+            args=(process.stdout, log_buffer, progress_callback),
+            daemon=True
         )
+        reader.start()
         
-        # Log output
-        if result.stdout:
-            logger.info(f"Audiveris stdout: {result.stdout}")
-        if result.stderr:
-            logger.warning(f"Audiveris stderr: {result.stderr}")
+        try:
+            returncode = wait_for_process(process, started, timeout, cancel_event)
+        except subprocess.TimeoutExpired:
+            raise AudiverisError(
+                f"Audiveris processing timed out (>{timeout:.0f} seconds)",
+                log_tail=list(log_buffer)[-20:]
+            )
+        except AudiverisCancelled as e:
+            e.log_tail = list(log_buffer)[-20:]
+            raise
+        finally:
+            reader.join(timeout=5)
         
-        if result.returncode != 0:
-            raise RuntimeError(f"Audiveris failed with code {result.returncode}: {result.stderr}")
+        elapsed = time.monotonic() - started
         
-        # Find generated files
-        generated_files = find_generated_files(output_dir_path, base_name)
+        if returncode != 0:
+            log_tail = list(log_buffer)[-20:]
+            raise AudiverisError(
+                f"Audiveris failed with code {returncode}: " + " | ".join(log_tail[-5:]),
+                log_tail=log_tail
+            )
         
-        # Convert to requested formats if needed
-        if "musicxml" in generated_files:
-            musicxml_path = generated_files["musicxml"]
-            
-            # Convert to MIDI if requested
-            if output_format == "midi" or output_format == "all":
-                midi_path = convert_to_midi(musicxml_path)
-                if midi_path:
-                    generated_files["midi"] = midi_path
-            
-            # Convert to PDF if requested (requires additional tools)
-            if output_format == "pdf" or output_format == "all":
-                pdf_path = convert_to_pdf(musicxml_path)
-                if pdf_path:
-                    generated_files["pdf"] = pdf_path
+        runtime_history.record(elapsed, megapixels)
         
-        # Extract metadata from MusicXML
-        metadata = {}
-        if "musicxml" in generated_files:
-            metadata = extract_musicxml_metadata(generated_files["musicxml"])
+        # Find generated files
+        generated_files = find_generated_files(output_dir_path, base_name)
+        metadata = finish_outputs(generated_files, output_format, publish)
         
         logger.info("Audiveris processing complete")
         
         return {
             "status": "success",
             "files": generated_files,
-            "metadata": metadata
+            "metadata": metadata,
+            "timing": {
+                "audiveris_seconds": round(elapsed, 3),
+                "timeout_budget": round(timeout, 1),
+                "megapixels": round(megapixels, 2)
+            }
         }
         
-    except subprocess.TimeoutExpired:
-        logger.error("Audiveris processing timed out")
-        raise RuntimeError("Audiveris processing timed out (>2 minutes)")
+    except AudiverisCancelled:
+        logger.info("Audiveris processing cancelled")
+        raise
     
     except Exception as e:
         logger.error(f"Audiveris processing failed: {e}")
         raise
+    
+    finally:
+        audiveris_slots.release()
+
+
+def finish_outputs(
+    generated_files: Dict[str, str],
+    output_format: str,
+    publish: Optional[Callable[[str, Dict], None]] = None
+) -> Dict:
+    """
+    Convert a recognized MusicXML file to the requested formats (adding them
+    to generated_files) and extract its metadata.
+    
+    Args:
+        publish: Called as publish("file", {"type", "path"}) for each file
+            and publish("metadata", metadata) as soon as each is ready; the
+            metadata comes before the slower conversions
+    
+    Returns:
+        MusicXML metadata (empty if no MusicXML was generated)
+    """
+    def emit(kind: str, data: Dict):
+        if publish:
+            try:
+                publish(kind, data)
+            except Exception as e:
+                logger.warning(f"Publishing {kind} failed: {e}")
+    
+    for file_type, path in generated_files.items():
+        emit("file", {"type": file_type, "path": path})
+    
+    if "musicxml" not in generated_files:
+        return {}
+    musicxml_path = generated_files["musicxml"]
+    
+    # Extract metadata from MusicXML
+    metadata = extract_musicxml_metadata(musicxml_path)
+    emit("metadata", metadata)
+    
+    # Convert to MIDI if requested
+    if output_format == "midi" or output_format == "all":
+        midi_path = convert_to_midi(musicxml_path)
+        if midi_path:
+            generated_files["midi"] = midi_path
+            emit("file", {"type": "midi", "path": midi_path})
+    
+    # Convert to PDF if requested (requires additional tools)
+    if output_format == "pdf" or output_format == "all":
+        pdf_path = convert_to_pdf(musicxml_path)
+        if pdf_path:
+            generated_files["pdf"] = pdf_path
+            emit("file", {"type": "pdf", "path": pdf_path})
+    
+    return metadata
+
+
+class OMRBackend(ABC):
+    """
+    Recognition engine interface.
+    
+    recognize() takes the preprocessed image and returns a dictionary with
+    status, files, metadata and timing, in the shape of process_with_audiveris.
+    The context carries the original input path and the preprocessing options,
+    for engines that work from the (cached) preprocessing stages instead, and
+    optionally a "publish" callback for partial results (see finish_outputs).
+    """
+    
+    name = ""
+    
+    @abstractmethod
+    def recognize(
+        self,
+        image_path: str,
+        output_dir: str,
+        output_format: str = "musicxml",
+        progress_callback: Optional[Callable[[Dict], None]] = None,
+        cancel_event: Optional[threading.Event] = None,
+        context: Optional[Dict] = None
+    ) -> Dict:
+        """Recognize image_path into output_dir (see the class docstring)."""
+
+
+class AudiverisBackend(OMRBackend):
+    """Full recognition by the Audiveris engine (separate JVM process)."""
+    
+    name = "audiveris"
+    
+    def recognize(self, image_path, output_dir, output_format="musicxml",
+                  progress_callback=None, cancel_event=None, context=None):
+        return process_with_audiveris(
+            image_path=image_path,
+            output_dir=output_dir,
+            output_format=output_format,
+            progress_callback=progress_callback,
+            cancel_event=cancel_event,
+            publish=(context or {}).get("publish")
+        )
+
+
+class NativeBackend(OMRBackend):
+    """
+    In-process recognizer for simple single-staff melodies.
+    Works on the deskewed, cropped grayscale and staff model from the
+    preprocessing stage cache, so it costs a fraction of a second instead of
+    a JVM run. It reads the image from before smoothing: its own local
+    threshold copes with noise, while smoothing blurs thin stems and flags.
+    The result carries a confidence (0-1) for routing decisions.
+    
+    Raises:
+        NotSimpleScore: If the image is not a single treble staff without
+            key signature or accidentals
+    """
+    
+    name = "native"
+    
+    def recognize(self, image_path, output_dir, output_format="musicxml",
+                  progress_callback=None, cancel_event=None, context=None):
+        # OpenCV and the pipeline are loaded on first use (see warmup.py)
+        from preprocessor import preprocessed_grayscale
+        from simple_recognizer import recognize_simple_score
+        
+        context = context or {}
+        started = time.monotonic()
+        
+        if context.get("input_path"):
+            image, image_metadata = preprocessed_grayscale(
+                context["input_path"], until="smooth", **context.get("preprocessing", {})
+            )
+        else:
+            # Without the original input, read the preprocessed image itself
+            image, image_metadata = preprocessed_grayscale(image_path, until="smooth")
+        
+        if progress_callback:
+            progress_callback({"stage": "symbols", "step": "NATIVE", "percent": 50})
+        if cancel_event is not None and cancel_event.is_set():
+            raise AudiverisCancelled("Recognition cancelled")
+        
+        recognized = recognize_simple_score(image, image_metadata.get("staff_model"))
+        
+        output_dir_path = Path(output_dir).resolve()
+        output_dir_path.mkdir(exist_ok=True)
+        musicxml_path = output_dir_path / f"{Path(image_path).stem}.musicxml"
+        musicxml_path.write_text(recognized["musicxml"], encoding="utf-8")
+        
+        generated_files = {"musicxml": str(musicxml_path)}
+        metadata = finish_outputs(generated_files, output_format, context.get("publish"))
+        elapsed = time.monotonic() - started
+        
+        logger.info(f"Native recognition complete: {recognized['notes']} notes, "
+                    f"confidence {recognized['confidence']:.2f} in {elapsed:.2f}s")
+        
+        return {
+            "status": "success",
+            "files": generated_files,
+            "metadata": metadata,
+            "timing": {"native_seconds": round(elapsed, 3)},
+            "confidence": recognized["confidence"],
+            "native": {k: v for k, v in recognized.items() if k != "musicxml"}
+        }
+
+
+OMR_BACKENDS = {backend.name: backend for backend in (AudiverisBackend(), NativeBackend())}
+
+
+def recognize_score(
+    image_path: str,
+    output_dir: str,
+    output_format: str = "musicxml",
+    progress_callback: Optional[Callable[[Dict], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+    engine: str = OMR_ENGINE,
+    context: Optional[Dict] = None
+) -> Dict:
+    """
+    Recognize a preprocessed image with the selected engine.
+    
+    "auto" runs the native recognizer first and keeps its result when its
+    confidence reaches NATIVE_MIN_CONFIDENCE; anything else (not a simple
+    score, low confidence, native failure) falls back to Audiveris.
+    
+    Returns:
+        The engine's result with an "engine" entry (requested, used,
+        native confidence and the reason for any fallback)
+    """
+    if engine not in OMR_ENGINES:
+        raise ValueError(f"Unknown OMR engine: {engine}")
+    
+    confidence = None
+    fallback_reason = None
+    
+    if engine in ("auto", "native"):
+        from simple_recognizer import NotSimpleScore
+        
+        # Partial results of the native run are only published once it is kept
+        publish = (context or {}).get("publish")
+        native_context = {k: v for k, v in (context or {}).items() if k != "publish"}
+        try:
+            result = OMR_BACKENDS["native"].recognize(
+                image_path, output_dir, output_format, progress_callback, cancel_event, native_context
+            )
+            confidence = result["confidence"]
+            if engine == "native" or confidence >= NATIVE_MIN_CONFIDENCE:
+                result["engine"] = {"requested": engine, "used": "native",
+                                    "confidence": confidence, "fallback_reason": None}
+                if publish:
+                    for file_type, path in result["files"].items():
+                        publish("file", {"type": file_type, "path": path})
+                    publish("metadata", result["metadata"])
+                return result
+            fallback_reason = f"confidence {confidence:.2f} below {NATIVE_MIN_CONFIDENCE:.2f}"
+            # The low-confidence output must not be picked up as Audiveris output
+            for path in result["files"].values():
+                Path(path).unlink(missing_ok=True)
+        except AudiverisCancelled:
+            raise
+        except NotSimpleScore as e:
+            if engine == "native":
+                raise
+            fallback_reason = str(e)
+        except Exception as e:
+            if engine == "native":
+                raise
+            logger.warning(f"Native recognizer failed, using Audiveris: {e}")
+            fallback_reason = f"native recognizer failed: {e}"
+        logger.info(f"Falling back to Audiveris: {fallback_reason}")
+    
+    result = OMR_BACKENDS["audiveris"].recognize(
+        image_path, output_dir, output_format, progress_callback, cancel_event, context
+    )
+    result["engine"] = {"requested": engine, "used": "audiveris",
+                        "confidence": confidence, "fallback_reason": fallback_reason}
+    return result
+
+
+def wait_for_process(
+    process: subprocess.Popen,
+    started: float,
+    timeout: float,
+    cancel_event: Optional[threading.Event] = None,
+    poll_interval: float = 0.25
+) -> int:
+    """
+    Wait for Audiveris to exit, killing its process tree on cancellation or timeout.
+    
+    Returns:
+        The process return code
+    """
+    while True:
+        try:
+            return process.wait(timeout=poll_interval)
+        except subprocess.TimeoutExpired:
+            pass
+        
+        if cancel_event is not None and cancel_event.is_set():
+            terminate_process_tree(process)
+            raise AudiverisCancelled("Audiveris processing cancelled")
+        
+        if time.monotonic() - started > timeout:
+            logger.error("Audiveris processing timed out")
+            terminate_process_tree(process)
+            raise subprocess.TimeoutExpired(process.args, timeout)
 
 
 def find_generated_files(output_dir: Path, base_name: str) -> Dict[str, str]:
@@ -167,9 +667,9 @@ def find_generated_files(output_dir: Path, base_name: str) -> Dict[str, str]:
             files["musicxml"] = str(musicxml_file)
             break
     
-    # Look for other possible outputs
+    # Look for other possible outputs of this image only (the directory is shared)
     for pattern in ['*.mxl', '*.musicxml', '*.xml', '*.mid', '*.midi', '*.pdf']:
-        matches = list(output_dir.glob(pattern))
+        matches = list(output_dir.glob(f"{base_name}{pattern}"))
         if matches:
             file_type = pattern.replace('*.', '').replace('mxl', 'musicxml')
             if file_type not in files:
@@ -0,0 +1,453 @@
+"""
+Recognition accuracy and speed benchmark.
+Runs a corpus of score images with ground-truth MusicXML through
+preprocessing, recognition and validation, aligns the recognized notes
+with the ground truth and reports note-level pitch, duration and measure
+accuracy together with per-stage timings:
+
+    python benchmark.py corpus/ --json before.json
+    python benchmark.py corpus/ --json after.json --baseline before.json --fail-on-regression
+
+The ground truth of page1.png is page1.musicxml (or .xml/.mxl) next to it
+or in --truth-dir. Without an Audiveris installation the Audiveris engine
+is replaced by stub_audiveris.py, whose canned output makes its accuracy
+figures meaningless; the native recognizer and the preprocessing timings
+are real either way.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from fractions import Fraction
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".tiff", ".tif", ".bmp"}
+TRUTH_SUFFIXES = (".musicxml", ".xml", ".mxl")
+STUB_AUDIVERIS = Path(__file__).resolve().parent / "stub_audiveris.py"
+ACCURACY_METRICS = ("precision", "recall", "f1", "pitch_accuracy", "duration_accuracy", "measure_accuracy")
+
+# A note token: (MIDI pitch or "rest", duration in quarter notes)
+Token = Tuple[object, Fraction]
+
+
+def use_audiveris_stub() -> bool:
+    """
+    Point the Audiveris client at the stub when Java or the Audiveris JAR
+    is missing. Must run before audiveris_client is imported, which reads
+    both paths at import time.
+    """
+    java = os.getenv("JAVA_PATH", "java")
+    jar = os.getenv("AUDIVERIS_JAR", "/opt/audiveris/Audiveris.jar")
+    if shutil.which(java) and Path(jar).exists():
+        return False
+    os.environ["JAVA_PATH"] = str(STUB_AUDIVERIS)
+    os.environ["AUDIVERIS_JAR"] = str(STUB_AUDIVERIS)
+    os.environ.setdefault("STUB_AUDIVERIS_DELAY", "0")
+    return True
+
+
+def find_corpus(roots: List[Path], truth_dir: Optional[Path]) -> Tuple[List[Tuple[Path, Path]], List[str]]:
+    """Pairs of (image, ground truth) under roots, and images without ground truth."""
+    images = []
+    for root in roots:
+        candidates = [root] if root.is_file() else root.rglob("*")
+        images.extend(p for p in candidates if p.suffix.lower() in IMAGE_SUFFIXES and p.is_file())
+
+    pairs, missing = [], []
+    for image in sorted(images):
+        folder = truth_dir or image.parent
+        truth = next((folder / f"{image.stem}{s}" for s in TRUTH_SUFFIXES
+                      if (folder / f"{image.stem}{s}").exists()), None)
+        if truth is None:
+            missing.append(str(image))
+        else:
+            pairs.append((image, truth))
+    return pairs, missing
+
+
+def score_tokens(path: str) -> List[List[List[Token]]]:
+    """
+    Notes of a score as parts -> measures -> tokens. Chord notes are sorted
+    by pitch so their order in the file does not matter; grace notes have
+    no duration and are skipped.
+    """
+    from validation import parse_musicxml, pitch_to_midi
+
+    root = parse_musicxml(path)
+    parts = []
+    for part in root.findall('.//{*}part'):
+        divisions = 1
+        measures = []
+        for measure in part.findall('{*}measure'):
+            divisions_elem = measure.find('{*}attributes/{*}divisions')
+            if divisions_elem is not None and divisions_elem.text:
+                divisions = int(divisions_elem.text)
+
+            onsets: List[List[Token]] = []
+            for note in measure.findall('{*}note'):
+                duration = note.find('{*}duration')
+                if note.find('{*}grace') is not None or duration is None:
+                    continue
+                pitch = note.find('{*}pitch')
+                if pitch is not None:
+                    alter = pitch.find('{*}alter')
+                    value = pitch_to_midi(pitch.find('{*}step').text, int(pitch.find('{*}octave').text),
+                                          int(float(alter.text)) if alter is not None else 0)
+                else:
+                    value = "rest"
+                token = (value, Fraction(int(duration.text), divisions))
+                if note.find('{*}chord') is not None and onsets:
+                    onsets[-1].append(token)
+                else:
+                    onsets.append([token])
+            measures.append([t for chord in onsets for t in sorted(chord, key=str)])
+        parts.append(measures)
+    return parts
+
+
+def align(truth: List[Token], recognized: List[Token]) -> List[Tuple[Optional[int], Optional[int]]]:
+    """
+    Minimum-cost alignment of two token sequences (edit distance with a
+    backtrace). Substituting a note that keeps its pitch or its duration
+    costs 1, one that keeps neither costs 2, so it is never preferred over
+    a deletion plus an insertion.
+
+    Returns:
+        (truth index, recognized index) pairs in order; None on one side
+        marks a deletion or insertion
+    """
+    n, m = len(truth), len(recognized)
+    cost = [[0] * (m + 1) for _ in range(n + 1)]
+    for i in range(1, n + 1):
+        cost[i][0] = i
+    for j in range(1, m + 1):
+        cost[0][j] = j
+    for i in range(1, n + 1):
+        t = truth[i - 1]
+        row, prev = cost[i], cost[i - 1]
+        for j in range(1, m + 1):
+            r = recognized[j - 1]
+            substitution = 0 if t == r else (1 if t[0] == r[0] or t[1] == r[1] else 2)
+            row[j] = min(prev[j - 1] + substitution, prev[j] + 1, row[j - 1] + 1)
+
+    pairs = []
+    i, j = n, m
+    while i > 0 or j > 0:
+        if i > 0 and j > 0:
+            t, r = truth[i - 1], recognized[j - 1]
+            substitution = 0 if t == r else (1 if t[0] == r[0] or t[1] == r[1] else 2)
+            if cost[i][j] == cost[i - 1][j - 1] + substitution:
+                pairs.append((i - 1, j - 1))
+                i, j = i - 1, j - 1
+                continue
+        if i > 0 and cost[i][j] == cost[i - 1][j] + 1:
+            pairs.append((i - 1, None))
+            i -= 1
+        else:
+            pairs.append((None, j - 1))
+            j -= 1
+    pairs.reverse()
+    return pairs
+
+
+def compare_scores(truth_path: str, recognized_path: str) -> Dict:
+    """
+    Note-level comparison of a recognized score with its ground truth.
+
+    Parts are compared in order, each as one note sequence across its
+    measures, so a missed or extra note shifts nothing after it. A truth
+    measure counts as correct when the recognized measure at the same
+    index has exactly the same notes.
+    """
+    truth_parts = score_tokens(truth_path)
+    recognized_parts = score_tokens(recognized_path)
+
+    counts = Counter()
+    for p in range(max(len(truth_parts), len(recognized_parts))):
+        truth_measures = truth_parts[p] if p < len(truth_parts) else []
+        recognized_measures = recognized_parts[p] if p < len(recognized_parts) else []
+        truth = [t for measure in truth_measures for t in measure]
+        recognized = [t for measure in recognized_measures for t in measure]
+
+        counts["truth_notes"] += len(truth)
+        counts["recognized_notes"] += len(recognized)
+        counts["truth_measures"] += len(truth_measures)
+        counts["recognized_measures"] += len(recognized_measures)
+        counts["correct_measures"] += sum(
+            1 for k, measure in enumerate(truth_measures)
+            if k < len(recognized_measures) and recognized_measures[k] == measure
+        )
+
+        for i, j in align(truth, recognized):
+            if i is None:
+                counts["insertions"] += 1
+            elif j is None:
+                counts["deletions"] += 1
+            else:
+                same_pitch = truth[i][0] == recognized[j][0]
+                same_duration = truth[i][1] == recognized[j][1]
+                counts["pitch_correct"] += same_pitch
+                counts["duration_correct"] += same_duration
+                if same_pitch and same_duration:
+                    counts["matched"] += 1
+                else:
+                    counts["substitutions"] += 1
+    return accuracy(counts)
+
+
+def accuracy(counts: Counter) -> Dict:
+    """Counts plus the accuracy metrics derived from them."""
+    truth, recognized = counts["truth_notes"], counts["recognized_notes"]
+    precision = counts["matched"] / recognized if recognized else 0.0
+    recall = counts["matched"] / truth if truth else 0.0
+    errors = counts["substitutions"] + counts["deletions"] + counts["insertions"]
+    return {
+        **{name: counts[name] for name in (
+            "truth_notes", "recognized_notes", "matched", "substitutions", "deletions", "insertions",
+            "pitch_correct", "duration_correct", "truth_measures", "recognized_measures", "correct_measures")},
+        "precision": round(precision, 4),
+        "recall": round(recall, 4),
+        "f1": round(2 * precision * recall / (precision + recall), 4) if precision + recall else 0.0,
+        "pitch_accuracy": round(counts["pitch_correct"] / truth, 4) if truth else 0.0,
+        "duration_accuracy": round(counts["duration_correct"] / truth, 4) if truth else 0.0,
+        "measure_accuracy": round(counts["correct_measures"] / counts["truth_measures"], 4)
+        if counts["truth_measures"] else 0.0,
+        "note_error_rate": round(errors / truth, 4) if truth else None,
+    }
+
+
+def benchmark_image(image: Path, truth: Path, output_dir: Path, engine: str, preprocessing: Dict) -> Dict:
+    """
+    Preprocess, recognize and validate one image, then score it against its
+    ground truth.
+
+    Each image gets a fresh in-memory stage cache (no disk cache), so
+    every stage really runs, as for a first request; recognition can still
+    reuse the image's own stages like it does in the service.
+    """
+    import pipeline
+    from audiveris_client import recognize_score
+    from preprocessor import preprocess_handwritten_music
+    from validation import validate_and_correct_musicxml
+
+    pipeline.stage_cache = pipeline.StageCache(max_bytes=pipeline.PIPELINE_CACHE_MB * 1024 * 1024)
+    record = {"image": str(image), "truth": str(truth), "status": "success", "engine": None}
+    timing = {}
+    try:
+        metadata = {}
+        started = time.perf_counter()
+        preprocessed = preprocess_handwritten_music(str(image), str(output_dir), metadata=metadata,
+                                                    **preprocessing)
+        timing["preprocess"] = time.perf_counter() - started
+        stages = metadata.get("stages", [])
+        # Hits would time a lookup, not the stage; there should be none
+        timing["stages"] = {stage["name"]: stage["seconds"] for stage in stages if not stage["cached"]}
+        record["cached_stages"] = [stage["name"] for stage in stages if stage["cached"]]
+
+        started = time.perf_counter()
+        result = recognize_score(preprocessed, str(output_dir), engine=engine,
+                                 context={"input_path": str(image), "preprocessing": preprocessing})
+        timing["recognition"] = time.perf_counter() - started
+        record["engine"] = result["engine"]["used"]
+        record["fallback_reason"] = result["engine"]["fallback_reason"]
+        musicxml = result["files"]["musicxml"]
+
+        started = time.perf_counter()
+        record["validation_status"] = validate_and_correct_musicxml(musicxml)["status"]
+        timing["validation"] = time.perf_counter() - started
+
+        record["accuracy"] = compare_scores(str(truth), musicxml)
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"
+
+    timing["total"] = sum(timing.get(name, 0.0) for name in ("preprocess", "recognition", "validation"))
+    record["timing"] = {name: round(value, 4) if isinstance(value, float) else value
+                        for name, value in timing.items()}
+    return record
+
+
+def seconds_summary(values: List[float]) -> Dict:
+    values = sorted(values)
+    if not values:
+        return {"mean": 0.0, "p50": 0.0, "max": 0.0}
+    return {"mean": round(statistics.mean(values), 4), "p50": values[len(values) // 2], "max": values[-1]}
+
+
+def summarize(images: List[Dict]) -> Dict:
+    """Corpus accuracy (pooled over all notes and measures) and timing statistics."""
+    succeeded = [record for record in images if record["status"] == "success"]
+    counts = Counter()
+    for record in succeeded:
+        counts.update({k: v for k, v in record["accuracy"].items() if isinstance(v, int)})
+
+    stage_names = list(dict.fromkeys(name for record in succeeded for name in record["timing"]["stages"]))
+    return {
+        "images": len(images),
+        "errors": len(images) - len(succeeded),
+        "engines": dict(Counter(record["engine"] for record in succeeded)),
+        "accuracy": accuracy(counts),
+        "timing": {
+            **{name: seconds_summary([record["timing"][name] for record in succeeded])
+               for name in ("preprocess", "recognition", "validation", "total")},
+            "stages": {name: round(statistics.mean(record["timing"]["stages"][name] for record in succeeded
+                                                   if name in record["timing"]["stages"]), 4)
+                       for name in stage_names},
+            "cached_stages": sum(len(record["cached_stages"]) for record in succeeded),
+        },
+    }
+
+
+def compare_runs(base: Dict, new: Dict, tolerance: float) -> Dict:
+    """
+    Accuracy and timing changes against an earlier run. A corpus metric or
+    an image's F1 that dropped by more than tolerance is a regression.
+    """
+    base_accuracy, new_accuracy = base["summary"]["accuracy"], new["summary"]["accuracy"]
+    metric_deltas = {name: round(new_accuracy[name] - base_accuracy[name], 4) for name in ACCURACY_METRICS}
+
+    base_images = {record["image"]: record for record in base["images"] if record["status"] == "success"}
+    regressed = []
+    for record in new["images"]:
+        old = base_images.get(record["image"])
+        if old is None:
+            continue
+        new_f1 = record["accuracy"]["f1"] if record["status"] == "success" else 0.0
+        if old["accuracy"]["f1"] - new_f1 > tolerance:
+            regressed.append({"image": record["image"], "f1": [old["accuracy"]["f1"], new_f1]})
+
+    base_timing, new_timing = base["summary"]["timing"], new["summary"]["timing"]
+    return {
+        "accuracy_delta": metric_deltas,
+        "regressed_metrics": [name for name, delta in metric_deltas.items() if delta < -tolerance],
+        "regressed_images": regressed,
+        "timing_delta": {name: round(new_timing[name]["mean"] - base_timing[name]["mean"], 4)
+                         for name in ("preprocess", "recognition", "validation", "total")},
+    }
+
+
+def print_summary(report: Dict):
+    print(f"{'Image':<32} {'Engine':<10} {'F1':>6} {'Pitch':>6} {'Dur':>6} {'Meas':>6} "
+          f"{'Prep s':>7} {'Recog s':>8} {'Total s':>8}")
+    for record in report["images"]:
+        name = Path(record["image"]).name[:32]
+        if record["status"] != "success":
+            print(f"{name:<32} {'error':<10} {record['error']}")
+            continue
+        acc, timing = record["accuracy"], record["timing"]
+        print(f"{name:<32} {record['engine']:<10} {acc['f1']:>6.3f} {acc['pitch_accuracy']:>6.3f} "
+              f"{acc['duration_accuracy']:>6.3f} {acc['measure_accuracy']:>6.3f} "
+              f"{timing['preprocess']:>7.3f} {timing['recognition']:>8.3f} {timing['total']:>8.3f}")
+
+    summary = report["summary"]
+    acc = summary["accuracy"]
+    print(f"\n{summary['images']} images, {summary['errors']} errors, engines: "
+          + ", ".join(f"{e}={n}" for e, n in summary["engines"].items()))
+    print(f"Notes: {acc['matched']}/{acc['truth_notes']} matched, precision {acc['precision']:.3f}, "
+          f"recall {acc['recall']:.3f}, F1 {acc['f1']:.3f}, error rate {acc['note_error_rate']}")
+    print(f"Pitch {acc['pitch_accuracy']:.3f}, duration {acc['duration_accuracy']:.3f}, "
+          f"measures {acc['measure_accuracy']:.3f} ({acc['correct_measures']}/{acc['truth_measures']})")
+    timing = summary["timing"]
+    print("Mean seconds: " + ", ".join(f"{name} {timing[name]['mean']:.3f}"
+                                       for name in ("preprocess", "recognition", "validation", "total")))
+    if timing["stages"]:
+        print("Mean stage seconds: " + ", ".join(f"{n} {s:.4f}" for n, s in timing["stages"].items()))
+    if report["audiveris"] == "stub":
+        print("Note: Audiveris is not installed; its results come from the stub and are not meaningful")
+
+
+def print_comparison(comparison: Dict):
+    print("Accuracy delta: " + ", ".join(f"{k} {v:+.4f}" for k, v in comparison["accuracy_delta"].items()))
+    print("Timing delta: " + ", ".join(f"{k} {v:+.4f}s" for k, v in comparison["timing_delta"].items()))
+    if comparison["regressed_metrics"]:
+        print(f"Regressed metrics: {', '.join(comparison['regressed_metrics'])}")
+    for change in comparison["regressed_images"]:
+        print(f"  - {change['image']}: F1 {change['f1'][0]:.3f} -> {change['f1'][1]:.3f}")
+
+
+def main():
+    """Main function to run the accuracy and speed benchmark."""
+    parser = argparse.ArgumentParser(description="Benchmark recognition accuracy and speed against ground truth")
+    parser.add_argument("roots", nargs="+", help="Directories (or files) with score images")
+    parser.add_argument("--truth-dir", help="Directory with the ground-truth MusicXML (default: next to each image)")
+    parser.add_argument("--engine", default="auto", choices=["auto", "audiveris", "native"],
+                        help="Recognition engine")
+    parser.add_argument("--smoothing-engine", help="Smoothing filter passed to preprocessing")
+    parser.add_argument("--binarization-engine", help="Thresholding method passed to preprocessing")
+    parser.add_argument("--no-smoothing", action="store_true", help="Disable smoothing")
+    parser.add_argument("--output-dir", help="Keep recognition outputs here (default: a temporary directory)")
+    parser.add_argument("--json", dest="json_path", help="Write the full report to this file")
+    parser.add_argument("--baseline", help="Report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.005,
+                        help="Accuracy drop tolerated before counting a regression")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="Exit with status 1 if accuracy regressed against the baseline")
+    args = parser.parse_args()
+
+    roots = [Path(p) for p in args.roots]
+    missing = [str(p) for p in roots if not p.exists()]
+    if missing:
+        print(f"Path(s) not found: {', '.join(missing)}")
+        sys.exit(1)
+    pairs, without_truth = find_corpus(roots, Path(args.truth_dir) if args.truth_dir else None)
+    for image in without_truth:
+        print(f"Skipping {image}: no ground truth")
+    if not pairs:
+        print("No images with ground truth found")
+        sys.exit(1)
+
+    stub = args.engine != "native" and use_audiveris_stub()
+    preprocessing = {"apply_smoothing": not args.no_smoothing}
+    if args.smoothing_engine:
+        preprocessing["smoothing_engine"] = args.smoothing_engine
+    if args.binarization_engine:
+        preprocessing["binarization_engine"] = args.binarization_engine
+
+    output_root = Path(args.output_dir or tempfile.mkdtemp(prefix="omr-benchmark-"))
+    images = []
+    try:
+        for n, (image, truth) in enumerate(pairs):
+            output_dir = output_root / f"{n:04d}_{image.stem}"
+            output_dir.mkdir(parents=True, exist_ok=True)
+            images.append(benchmark_image(image, truth, output_dir, args.engine, preprocessing))
+    finally:
+        if not args.output_dir:
+            shutil.rmtree(output_root, ignore_errors=True)
+
+    report = {
+        "roots": [str(r) for r in roots],
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "engine": args.engine,
+        "audiveris": "stub" if stub else ("installed" if args.engine != "native" else "unused"),
+        "preprocessing": preprocessing,
+        "summary": summarize(images),
+        "images": images,
+    }
+    print_summary(report)
+
+    comparison = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            comparison = compare_runs(json.load(f), report, args.tolerance)
+        report["comparison"] = comparison
+        print_comparison(comparison)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"Report written to {args.json_path}")
+
+    if comparison and args.fail_on_regression and (comparison["regressed_metrics"]
+                                                    or comparison["regressed_images"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
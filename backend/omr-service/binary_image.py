@@ -0,0 +1,100 @@
+"""
+Compact binary image representation.
+Stores a black-and-white image as one bit per pixel so binarized pages stay
+small while they sit in the stage cache or between pipeline stages.
+"""
+
+import numpy as np
+from typing import Tuple
+
+from PIL import Image
+
+# Pixels darker than this count as ink when packing a grayscale image
+INK_THRESHOLD = 128
+
+# Set bits of every byte value
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+
+class PackedBinaryImage:
+    """
+    Bit-packed black-and-white image.
+
+    Rows are packed MSB-first with each row padded to a whole byte, with set
+    bits meaning white (paper). That is the raw layout of PIL's mode "1", so
+    saving needs no conversion.
+    """
+
+    def __init__(self, bits: np.ndarray, width: int):
+        if bits.dtype != np.uint8 or bits.ndim != 2:
+            raise ValueError("Packed bits must be a 2-D uint8 array")
+        if bits.shape[1] != (width + 7) // 8:
+            raise ValueError(f"Packed rows of {bits.shape[1]} bytes do not match width {width}")
+        self.bits = bits
+        self.width = width
+
+    @classmethod
+    def from_array(cls, image: np.ndarray) -> "PackedBinaryImage":
+        """Pack a grayscale image (ink is anything below INK_THRESHOLD)."""
+        return cls(np.packbits(image >= INK_THRESHOLD, axis=1), image.shape[1])
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.bits.shape[0], self.width
+
+    @property
+    def height(self) -> int:
+        return self.bits.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+    @property
+    def flags(self):
+        # Lets callers toggle writeability like on an ndarray
+        return self.bits.flags
+
+    def to_array(self, rows: slice = slice(None)) -> np.ndarray:
+        """Unpack (some rows) to a uint8 image with black (0) ink on white (255) paper."""
+        white = np.unpackbits(self.bits[rows], axis=1, count=self.width)
+        return white * np.uint8(255)
+
+    def ink_count(self) -> int:
+        """Number of ink pixels, counted on the packed bytes (row padding bits are 0, so never white)."""
+        white = int(POPCOUNT[self.bits].sum(dtype=np.int64))
+        return self.height * self.width - white
+
+    def horizontal_runs(self, rows: slice = slice(None)) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Horizontal ink runs in a band of rows, sorted by row and start.
+
+        Returns:
+            (rows, starts, lengths) arrays, one entry per run; rows are
+            relative to the start of the band
+        """
+        white = np.unpackbits(self.bits[rows], axis=1, count=self.width)
+        padded = np.ones((white.shape[0], self.width + 2), dtype=np.uint8)
+        padded[:, 1:-1] = white
+        # Colour changes alternate between run starts and ends along each row
+        run_rows, edges = np.nonzero(padded[:, 1:] != padded[:, :-1])
+        return run_rows[0::2], edges[0::2], edges[1::2] - edges[0::2]
+
+    def with_ink_runs(self, rows: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> "PackedBinaryImage":
+        """Copy with the given horizontal runs painted as ink; only their rows are unpacked."""
+        bits = self.bits.copy()
+        for row in np.unique(rows):
+            white = np.unpackbits(bits[row], count=self.width)
+            for start, length in zip(starts[rows == row], lengths[rows == row]):
+                white[start:start + length] = 0
+            bits[row] = np.packbits(white)
+        return PackedBinaryImage(bits, self.width)
+
+    def save(self, path: str):
+        """Write a 1-bit image (PNG or TIFF, picked from the file suffix)."""
+        height, width = self.shape
+        image = Image.frombytes("1", (width, height), np.ascontiguousarray(self.bits).tobytes())
+        if str(path).lower().endswith((".tif", ".tiff")):
+            image.save(path, compression="group4")
+        else:
+            image.save(path, optimize=True)
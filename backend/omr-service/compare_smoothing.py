@@ -0,0 +1,148 @@
+"""
+Smoothing engine comparison tool.
+Runs every smoothing engine on a set of images and compares speed and
+output against the bilateral reference, both as grayscale (PSNR) and after
+binarization (ink agreement, which is what Audiveris actually sees).
+
+    python compare_smoothing.py page1.jpg page2.png --strengths 1,3,5
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import cv2
+import numpy as np
+
+from preprocessor import (
+    SMOOTHING_ENGINES,
+    binarize_image,
+    normalize_image,
+    smooth_handwritten_notation,
+)
+
+REFERENCE_ENGINE = "bilateral"
+
+
+def psnr(reference: np.ndarray, image: np.ndarray) -> float:
+    """Peak signal-to-noise ratio between two uint8 images (dB)."""
+    mse = np.mean((reference.astype(np.float64) - image.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float("inf")
+    return float(10 * np.log10(255.0 ** 2 / mse))
+
+
+def ink_iou(reference: np.ndarray, image: np.ndarray) -> float:
+    """Intersection over union of the ink (black) pixels of two binary images."""
+    ref_ink = reference == 0
+    ink = image == 0
+    union = np.count_nonzero(ref_ink | ink)
+    if union == 0:
+        return 1.0
+    return float(np.count_nonzero(ref_ink & ink) / union)
+
+
+def time_engine(image: np.ndarray, strength: int, engine: str, repeat: int):
+    """Run one engine repeat times; return its output and best time."""
+    best = float("inf")
+    smoothed = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        smoothed = smooth_handwritten_notation(image, strength=strength, engine=engine)
+        best = min(best, time.perf_counter() - started)
+    return smoothed, best
+
+
+def compare_image(path: Path, strengths: List[int], repeat: int) -> List[Dict]:
+    """Compare all engines on one image at each strength."""
+    image = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError(f"Failed to load image: {path}")
+    image = normalize_image(image)
+
+    rows = []
+    for strength in strengths:
+        reference, reference_time = time_engine(image, strength, REFERENCE_ENGINE, repeat)
+        reference_binary = binarize_image(reference)
+
+        for engine in SMOOTHING_ENGINES:
+            if engine == REFERENCE_ENGINE:
+                smoothed, seconds = reference, reference_time
+            else:
+                smoothed, seconds = time_engine(image, strength, engine, repeat)
+            binary = binarize_image(smoothed)
+
+            rows.append({
+                "image": path.name,
+                "strength": strength,
+                "engine": engine,
+                "seconds": round(seconds, 4),
+                "speedup": round(reference_time / seconds, 2) if seconds > 0 else None,
+                "psnr": round(psnr(reference, smoothed), 2),
+                "binary_agreement": round(float(np.mean(binary == reference_binary)), 5),
+                "ink_iou": round(ink_iou(reference_binary, binary), 4),
+            })
+    return rows
+
+
+def summarize(rows: List[Dict]) -> Dict:
+    """Average the comparison per engine and strength over all images."""
+    summary = {}
+    for engine in SMOOTHING_ENGINES:
+        for strength in sorted({r["strength"] for r in rows}):
+            group = [r for r in rows if r["engine"] == engine and r["strength"] == strength]
+            if not group:
+                continue
+            summary.setdefault(engine, {})[str(strength)] = {
+                "seconds": round(float(np.mean([r["seconds"] for r in group])), 4),
+                "speedup": round(float(np.mean([r["speedup"] for r in group])), 2),
+                "psnr": round(float(np.mean([r["psnr"] for r in group])), 2),
+                "binary_agreement": round(float(np.mean([r["binary_agreement"] for r in group])), 5),
+                "ink_iou": round(float(np.mean([r["ink_iou"] for r in group])), 4),
+            }
+    return summary
+
+
+def main():
+    """Main function to run the comparison."""
+    parser = argparse.ArgumentParser(description="Compare smoothing engines")
+    parser.add_argument("images", nargs="+", help="Benchmark images")
+    parser.add_argument("--strengths", default="1,2,3,4,5",
+                        help="Comma separated smoothing strengths")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per measurement (the fastest is reported)")
+    parser.add_argument("--json", dest="json_path", help="Write the full report to this file")
+    args = parser.parse_args()
+
+    images = [Path(p) for p in args.images]
+    missing = [str(p) for p in images if not p.exists()]
+    if missing:
+        print(f"Image file(s) not found: {', '.join(missing)}")
+        sys.exit(1)
+
+    strengths = [int(s) for s in args.strengths.split(",") if s.strip()]
+
+    rows = []
+    for path in images:
+        print(f"Comparing engines on {path.name}...")
+        rows.extend(compare_image(path, strengths, args.repeat))
+
+    summary = summarize(rows)
+    print(f"{'engine':<12} {'strength':>8} {'seconds':>9} {'speedup':>8} "
+          f"{'psnr':>7} {'agree':>8} {'ink_iou':>8}")
+    for engine, by_strength in summary.items():
+        for strength, stats in by_strength.items():
+            print(f"{engine:<12} {strength:>8} {stats['seconds']:>9.4f} {stats['speedup']:>8.2f} "
+                  f"{stats['psnr']:>7.2f} {stats['binary_agreement']:>8.5f} {stats['ink_iou']:>8.4f}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"summary": summary, "images": rows}, f, indent=2)
+        print(f"Report written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""
+Job tracking for OMR requests.
+Keeps status and step-level progress of each recognition so clients can
+follow long Audiveris runs instead of waiting on a blank spinner, and lets
+concurrent identical requests share one running job (single-flight).
+With several workers, job state is also written to the shared job store so
+every worker can report on, join and cancel any job.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from shared_state import OMR_STATE_DIR, SHARED_STATE, JobStore
+
+logger = logging.getLogger(__name__)
+
+# Number of recent progress events kept per job
+MAX_JOB_EVENTS = 50
+# Number of jobs kept in memory before the oldest finished ones are evicted
+MAX_JOBS = 1000
+# How often a worker checks the shared store for cancellation of its jobs
+CANCEL_POLL_INTERVAL = 0.5
+
+# Job fields copied between workers through the shared store
+SNAPSHOT_FIELDS = ("status", "stage", "step", "progress", "result", "error", "log_tail",
+                   "rejection", "event_count", "partials", "preview_path",
+                   "created_at", "updated_at")
+
+FINISHED_STATUSES = {"completed", "failed", "cancelled"}
+
+
+class JobCancelled(Exception):
+    """Raised inside a job's pipeline once the job has been cancelled."""
+
+
+class Job:
+    """State of a single recognition job."""
+
+    def __init__(self, job_id: Optional[str] = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.status = "queued"
+        self.stage = "queued"
+        self.step = None
+        self.progress = 0
+        self.result = None
+        self.error = None
+        self.log_tail = []
+        # Error detail when the job was rejected before its pipeline started
+        self.rejection = None
+        self.events = deque(maxlen=MAX_JOB_EVENTS)
+        # Total events recorded (the deque only keeps the latest), so
+        # streaming readers can tell which ones they have not seen yet
+        self.event_count = 0
+        # Partial results published while the job runs (preview, metadata,
+        # validation, files), in order; kept in full since they are few
+        self.partials = []
+        self.preview_path = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.task = None
+        # Identity of the upload and options while the job is in flight, and
+        # the number of clients waiting on it (the submitter plus coalesced ones)
+        self.key = None
+        self.waiters = 1
+        self.cancel_event = threading.Event()
+        # Remote jobs are snapshots of jobs run by another worker
+        self.remote = False
+        # Called with the job after each change (persists it in shared mode)
+        self.on_change: Optional[Callable[["Job"], None]] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_snapshot(cls, job_id: str, snapshot: Dict) -> "Job":
+        """Read-only view of a job owned by another worker."""
+        job = cls(job_id)
+        job.remote = True
+        job.apply_snapshot(snapshot)
+        return job
+
+    def snapshot(self) -> Dict:
+        """Serializable state of the job (see SNAPSHOT_FIELDS)."""
+        with self._lock:
+            data = {name: getattr(self, name) for name in SNAPSHOT_FIELDS}
+            data["events"] = list(self.events)
+            return data
+
+    def apply_snapshot(self, snapshot: Dict):
+        """Replace the job's state with a snapshot from the shared store."""
+        with self._lock:
+            for name in SNAPSHOT_FIELDS:
+                setattr(self, name, snapshot.get(name, getattr(self, name)))
+            self.events = deque(snapshot.get("events", []), maxlen=MAX_JOB_EVENTS)
+            self.waiters = snapshot.get("waiters", self.waiters)
+            self.key = snapshot.get("key")
+            if snapshot.get("cancel_reason") or self.status == "cancelled":
+                self.cancel_event.set()
+
+    def _changed(self):
+        if self.on_change is not None:
+            try:
+                self.on_change(self)
+            except Exception as e:
+                logger.warning(f"Could not persist job {self.id}: {e}")
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def cancel(self, reason: str = "Cancelled") -> bool:
+        """
+        Request cancellation of the job.
+        
+        Returns:
+            False if the job had already finished
+        """
+        with self._lock:
+            if self.finished:
+                return False
+            self.error = reason
+        self.cancel_event.set()
+        self._changed()
+        return True
+
+    def attach(self) -> bool:
+        """
+        Add a waiter to a running job.
+        
+        Returns:
+            False if the job already finished or is being cancelled
+        """
+        with self._lock:
+            if self.finished or self.cancel_event.is_set():
+                return False
+            self.waiters += 1
+            return True
+
+    def detach(self, reason: str = "Cancelled") -> bool:
+        """
+        Remove a waiter; the job is cancelled once nobody waits on it anymore.
+        
+        Returns:
+            True if the job is (now) being cancelled
+        """
+        with self._lock:
+            if self.finished:
+                return False
+            self.waiters = max(0, self.waiters - 1)
+            if self.waiters == 0 and not self.cancel_event.is_set():
+                self.error = reason
+                self.cancel_event.set()
+            return self.cancel_event.is_set()
+
+    def raise_if_cancelled(self):
+        """Abort the pipeline between stages once cancellation was requested."""
+        if self.cancel_event.is_set():
+            raise JobCancelled(self.error or "Cancelled")
+
+    def update(self, **fields: Any):
+        """Update job fields (thread-safe)."""
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.updated_at = time.time()
+        self._changed()
+
+    def add_event(self, stage: str, progress: int, step: Optional[str] = None, **data: Any):
+        """Record a progress event and advance the job's current stage."""
+        with self._lock:
+            event = {"stage": stage, "step": step, "progress": progress,
+                     "time": round(time.time() - self.created_at, 3)}
+            event.update(data)
+            self.events.append(event)
+            self.event_count += 1
+            self.stage = stage
+            self.step = step
+            # Progress never moves backwards, even if Audiveris revisits a step
+            self.progress = max(self.progress, progress)
+            self.updated_at = time.time()
+        self._changed()
+
+    def publish(self, kind: str, data: Dict):
+        """Record a partial result for streaming clients."""
+        with self._lock:
+            # Remember how many progress events preceded it, to keep streams in order
+            self.partials.append({"event": kind, "data": data, "after": self.event_count})
+            self.updated_at = time.time()
+        self._changed()
+
+    def updates_since(self, event_cursor: int = 0, partial_cursor: int = 0) -> Tuple[List[Tuple[str, Dict]], int, int]:
+        """
+        Progress events and partial results added after the given cursors,
+        merged in the order they happened. Events that already fell out of
+        the bounded event buffer are skipped.
+        
+        Returns:
+            ([(kind, data), ...], new event cursor, new partial cursor),
+            where kind is "progress" or the partial result's kind
+        """
+        with self._lock:
+            first = self.event_count - len(self.events)  # number of the oldest kept event
+            numbered = [(first + i, event) for i, event in enumerate(self.events)
+                        if first + i >= event_cursor]
+            updates = []
+            for partial in self.partials[partial_cursor:]:
+                while numbered and numbered[0][0] < partial["after"]:
+                    updates.append(("progress", numbered.pop(0)[1]))
+                updates.append((partial["event"], partial["data"]))
+            updates.extend(("progress", event) for _, event in numbered)
+            return updates, self.event_count, len(self.partials)
+
+    def to_dict(self) -> Dict:
+        """Serialize the job for the status endpoint."""
+        with self._lock:
+            data = {
+                "job_id": self.id,
+                "status": self.status,
+                "stage": self.stage,
+                "step": self.step,
+                "progress": self.progress,
+                "waiters": self.waiters,
+                "events": list(self.events),
+                "created_at": self.created_at,
+                "updated_at": self.updated_at,
+            }
+            if self.status == "completed":
+                data["result"] = self.result
+            if self.status == "cancelled":
+                data["error"] = self.error
+            if self.status == "failed":
+                data["error"] = self.error
+                data["log_tail"] = self.log_tail
+            return data
+
+
+class JobRegistry:
+    """
+    Registry of recent jobs.
+    Jobs registered under a key (upload hash and options) while they run
+    can be joined by identical requests instead of starting a new pipeline.
+    
+    Jobs run by this process live in memory. With a shared store, their
+    state is written through to it, jobs of other workers are loaded from
+    it as remote snapshots, and waiter counts and cancellation requests go
+    through it; a watcher thread applies cancellations of local jobs.
+    """
+
+    def __init__(self, max_jobs: int = MAX_JOBS, store: Optional[JobStore] = None):
+        self.max_jobs = max_jobs
+        self.store = store
+        self.created = 0
+        self.coalesced = 0
+        self._jobs = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    def create(self) -> Job:
+        job = Job()
+        with self._lock:
+            self._jobs[job.id] = job
+            self.created += 1
+            self._evict()
+        if self.store is not None:
+            self.store.insert(job.id, job.snapshot())
+            job.on_change = self._persist
+            if self.created % 100 == 0:
+                self.store.prune()
+            self._start_watcher()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            snapshot = self.store.load(job_id)
+            if snapshot is not None:
+                job = Job.from_snapshot(job_id, snapshot)
+        return job
+
+    def refresh(self, job: Job) -> Job:
+        """Reload a remote job's state from the shared store."""
+        if job.remote and self.store is not None:
+            snapshot = self.store.load(job.id)
+            if snapshot is not None:
+                job.apply_snapshot(snapshot)
+        return job
+
+    def join_inflight(self, key: str) -> Optional[Job]:
+        """Attach to the running job for key, if there is one that is not being cancelled."""
+        if self.store is not None:
+            job_id = self.store.join(key)
+            job = self.get(job_id) if job_id else None
+            if job is not None:
+                self.refresh_waiters(job)
+        else:
+            with self._lock:
+                job = self._inflight.get(key)
+                if job is not None and not job.attach():
+                    job = None
+        if job is not None:
+            with self._lock:
+                self.coalesced += 1
+        return job
+
+    def register_inflight(self, key: str, job: Job):
+        """Make a started job joinable by identical requests."""
+        with self._lock:
+            job.key = key
+            self._inflight[key] = job
+        if self.store is not None:
+            self.store.set_key(job.id, key)
+
+    def release_inflight(self, job: Job):
+        """Stop routing new requests to a job (it finished or was cancelled)."""
+        with self._lock:
+            if job.key is not None and self._inflight.get(job.key) is job:
+                del self._inflight[job.key]
+        if self.store is not None:
+            self.store.release_key(job.id)
+
+    def detach(self, job: Job, reason: str = "Cancelled") -> bool:
+        """
+        Remove a waiter from a job (see Job.detach), wherever it runs.
+        
+        Returns:
+            True if the job is (now) being cancelled
+        """
+        if self.store is None:
+            return job.detach(reason)
+        cancelling = self.store.detach(job.id, reason)
+        self.refresh_waiters(job)
+        if cancelling:
+            # Local jobs stop right away; remote ones when their owner polls
+            job.cancel(reason)
+        return cancelling
+
+    def refresh_waiters(self, job: Job):
+        snapshot = self.store.load(job.id) if self.store is not None else None
+        if snapshot is not None:
+            job.update(waiters=snapshot["waiters"])
+
+    def stats(self) -> Dict:
+        """Job counters for the metrics endpoint."""
+        with self._lock:
+            statuses = {}
+            for job in self._jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+            data = {
+                "worker": os.getpid(),
+                "created": self.created,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._inflight),
+                "waiters": sum(job.waiters for job in self._inflight.values()),
+                "by_status": statuses,
+            }
+        if self.store is not None:
+            data["shared_by_status"] = self.store.counts()
+        return data
+
+    def _persist(self, job: Job):
+        self.store.save(job.id, job.snapshot())
+
+    def _start_watcher(self):
+        with self._lock:
+            if self._watcher is not None:
+                return
+            self._watcher = threading.Thread(target=self._watch_cancellations, daemon=True)
+        self._watcher.start()
+
+    def _watch_cancellations(self):
+        """Apply cancellations requested through the store (e.g. by another worker)."""
+        while True:
+            time.sleep(CANCEL_POLL_INTERVAL)
+            with self._lock:
+                running = [job_id for job_id, job in self._jobs.items()
+                           if not job.finished and not job.cancelled]
+            try:
+                requests = self.store.cancel_requests(running)
+            except Exception as e:
+                logger.warning(f"Could not poll job cancellations: {e}")
+                continue
+            for job_id, reason in requests.items():
+                job = self.get(job_id)
+                if job is not None and job.cancel(reason):
+                    logger.info(f"Job {job_id} cancelled through the shared store: {reason}")
+
+    def _evict(self):
+        """Drop the oldest finished jobs once the registry is full."""
+        if len(self._jobs) <= self.max_jobs:
+            return
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.max_jobs:
+                break
+            if self._jobs[job_id].finished:
+                del self._jobs[job_id]
+
+
+jobs = JobRegistry(
+    store=JobStore(str(Path(OMR_STATE_DIR) / "jobs.sqlite3"), max_jobs=MAX_JOBS) if SHARED_STATE else None
+)
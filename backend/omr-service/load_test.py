@@ -0,0 +1,183 @@
+"""
+Load test tool for the OMR Service.
+Drives /recognize with configurable concurrency and request mix and
+reports throughput and latency percentiles.
+
+Pair it with stub_audiveris.py to benchmark the service without Java:
+
+    JAVA_PATH=$PWD/stub_audiveris.py AUDIVERIS_JAR=$PWD/stub_audiveris.py python main.py
+    python load_test.py sample.png --requests 200 --concurrency 16 --mix musicxml=3,midi=1
+"""
+
+import argparse
+import json
+import math
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import requests
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """Parse a weighted output format mix such as "musicxml=3,midi=1"."""
+    weights = {}
+    for item in mix.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight) if weight else 1.0
+    if not weights:
+        raise ValueError("Request mix must contain at least one output format")
+    return weights
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Return the pct-th percentile of values (nearest-rank)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def run_request(session: requests.Session, args, image_path: Path, output_format: str,
+                strength: int) -> Dict:
+    """Send one recognition request (plus optional downloads) and time it."""
+    data = {
+        "apply_smoothing": "true",
+        "apply_alignment": "true",
+        "apply_normalization": "true",
+        "smoothing_strength": str(strength),
+        "output_format": output_format,
+    }
+
+    started = time.perf_counter()
+    record = {
+        "image": image_path.name,
+        "output_format": output_format,
+        "smoothing_strength": strength,
+    }
+
+    try:
+        with open(image_path, "rb") as f:
+            response = session.post(
+                f"{args.url}/recognize",
+                files={"image": (image_path.name, f)},
+                data=data,
+                timeout=args.timeout,
+            )
+        record["status_code"] = response.status_code
+
+        if response.status_code == 200 and args.download:
+            for url in response.json().get("download_urls", {}).values():
+                session.get(f"{args.url}{url}", timeout=args.timeout)
+    except requests.exceptions.Timeout:
+        record["status_code"] = "timeout"
+    except requests.exceptions.RequestException as e:
+        record["status_code"] = f"error: {type(e).__name__}"
+
+    record["latency"] = time.perf_counter() - started
+    return record
+
+
+def summarize(records: List[Dict], wall_time: float) -> Dict:
+    """Aggregate per-request records into a load test report."""
+    latencies = [r["latency"] for r in records]
+    ok = [r["latency"] for r in records if r["status_code"] == 200]
+
+    by_format = {}
+    for fmt in sorted({r["output_format"] for r in records}):
+        fmt_latencies = [r["latency"] for r in records
+                         if r["output_format"] == fmt and r["status_code"] == 200]
+        by_format[fmt] = {
+            "requests": len([r for r in records if r["output_format"] == fmt]),
+            "p50": round(percentile(fmt_latencies, 50), 3),
+            "p95": round(percentile(fmt_latencies, 95), 3),
+        }
+
+    return {
+        "requests": len(records),
+        "succeeded": len(ok),
+        "wall_time": round(wall_time, 3),
+        "throughput_rps": round(len(records) / wall_time, 3) if wall_time > 0 else 0.0,
+        "status_codes": {str(k): v for k, v in Counter(r["status_code"] for r in records).items()},
+        "latency": {
+            "mean": round(statistics.mean(latencies), 3) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50), 3),
+            "p90": round(percentile(latencies, 90), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "max": round(max(latencies), 3) if latencies else 0.0,
+        },
+        "by_format": by_format,
+    }
+
+
+def main():
+    """Main function to run the load test."""
+    parser = argparse.ArgumentParser(description="Load test the OMR service")
+    parser.add_argument("images", nargs="+", help="Image files to upload (picked at random)")
+    parser.add_argument("--url", default="http://localhost:8001", help="Service URL")
+    parser.add_argument("--requests", type=int, default=50, help="Total number of requests")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent clients")
+    parser.add_argument("--mix", default="musicxml=1",
+                        help="Weighted output formats, e.g. musicxml=3,midi=1,pdf=1")
+    parser.add_argument("--strengths", default="2",
+                        help="Comma separated smoothing strengths to pick from")
+    parser.add_argument("--download", action="store_true",
+                        help="Also fetch every returned download URL")
+    parser.add_argument("--timeout", type=float, default=300, help="Per-request timeout (seconds)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for the request mix")
+    parser.add_argument("--json", dest="json_path", help="Write the full report to this file")
+    args = parser.parse_args()
+    args.url = args.url.rstrip("/")
+
+    images = [Path(p) for p in args.images]
+    missing = [str(p) for p in images if not p.exists()]
+    if missing:
+        print(f"Image file(s) not found: {', '.join(missing)}")
+        sys.exit(1)
+
+    mix = parse_mix(args.mix)
+    strengths = [int(s) for s in args.strengths.split(",") if s.strip()]
+    rng = random.Random(args.seed)
+    plan = [
+        (rng.choice(images), rng.choices(list(mix), weights=list(mix.values()))[0],
+         rng.choice(strengths))
+        for _ in range(args.requests)
+    ]
+
+    print(f"Running {args.requests} requests against {args.url} "
+          f"with concurrency {args.concurrency}")
+
+    local = threading.local()
+
+    def worker(job):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return run_request(local.session, args, *job)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        records = list(pool.map(worker, plan))
+    wall_time = time.perf_counter() - started
+
+    report = summarize(records, wall_time)
+    print(json.dumps(report, indent=2))
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"summary": report, "requests": records}, f, indent=2)
+        print(f"Report written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
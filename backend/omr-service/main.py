@@ -1,20 +1,65 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request, Depends, Body
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+import asyncio
+import hashlib
+import json
 import tempfile
+import time
 import os
 import shutil
 from pathlib import Path
-from preprocessor import preprocess_handwritten_music
-from audiveris_client import process_with_audiveris
-from validation import validate_and_correct_musicxml
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import asynccontextmanager
+from audiveris_client import AUDIVERIS_MAX_CONCURRENCY, OMR_ENGINE, OMR_ENGINES, recognize_score
+from validation import (
+    StaleRevision,
+    revalidate_measures,
+    score_validation_report,
+    validate_and_correct_musicxml,
+    write_corrected_musicxml,
+)
+from jobs import Job, jobs
+from shared_state import OMR_WORKERS
+from admission import (
+    AdmissionRejected,
+    Ticket,
+    client_identity,
+    estimate_cost,
+    scheduler,
+    upload_megapixels,
+)
+from artifacts import (
+    ARTIFACT_CACHE_CONTROL,
+    MEDIA_TYPES,
+    compressed_variant,
+    content_etag,
+    etag_matches,
+    inline_artifacts,
+    negotiate_encoding,
+    resolve_artifact,
+    variant_etag,
+)
+from pipeline import stage_cache
+from warmup import start_warmup, warmup_state
 import logging
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="OMR Service - Handwritten Music Recognition", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # OpenCV, the pipeline modules and music21 load in the background while
+    # the service already answers /health; /ready reports when they are done
+    start_warmup()
+    yield
+
+
+app = FastAPI(title="OMR Service - Handwritten Music Recognition", version="1.0.0",
+              lifespan=lifespan)
 
 # Enable CORS
 app.add_middleware(
@@ -25,6 +70,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# How often a waiting /recognize request checks whether its client disconnected
+DISCONNECT_POLL_INTERVAL = 1.0
+# Event streams: how often the job is checked for updates, and the idle
+# time after which a keep-alive comment is sent (so proxies keep the stream)
+STREAM_POLL_INTERVAL = 0.2
+STREAM_KEEPALIVE_INTERVAL = 15.0
+
+# Speculative mode: alternate preprocessing options tried next to the
+# requested ones, and how many variants may run per request
+SPECULATIVE_VARIANTS = [
+    {"apply_smoothing": False},
+    {"apply_smoothing": True, "smoothing_strength": 4},
+    {"apply_smoothing": True, "smoothing_strength": 1},
+]
+SPECULATIVE_MAX_VARIANTS = int(os.getenv("SPECULATIVE_MAX_VARIANTS", "3"))
+
+# Options that only shape the response, not the recognition result
+# (identical requests differing in these still share one job)
+RESPONSE_OPTIONS = ("inline",)
+
 # Create necessary directories
 UPLOAD_DIR = Path("uploads")
 PROCESSED_DIR = Path("processed")
@@ -43,7 +108,17 @@ async def root():
         "provider": "Audiveris Open-Source OMR",
         "endpoints": {
             "recognize": "/recognize (POST)",
+            "jobs": "/jobs (POST)",
+            "job_status": "/jobs/{job_id} (GET)",
+            "job_cancel": "/jobs/{job_id}/cancel (POST)",
+            "recognize_stream": "/recognize/stream (POST, Server-Sent Events)",
+            "job_stream": "/jobs/{job_id}/stream (GET, Server-Sent Events)",
+            "job_preview": "/jobs/{job_id}/preview (GET)",
+            "job_corrected": "/jobs/{job_id}/corrected (GET)",
+            "job_validate": "/jobs/{job_id}/validate (POST, edited measures)",
             "health": "/health (GET)",
+            "ready": "/ready (GET)",
+            "metrics": "/metrics (GET)",
             "download": "/download/{filename} (GET)"
         }
     }
@@ -67,143 +142,910 @@ async def health():
             "error": str(e)
         }
 
-@app.post("/recognize")
-async def recognize_handwritten_music(
-    image: UploadFile = File(...),
-    apply_smoothing: bool = Form(default=True),
-    apply_alignment: bool = Form(default=True),
-    apply_normalization: bool = Form(default=True),
-    smoothing_strength: int = Form(default=2),
-    output_format: str = Form(default="musicxml")  # musicxml, midi, pdf
-):
+@app.get("/ready")
+async def ready():
+    """Readiness check: 200 once the warm-up is done, 503 until then"""
+    state = warmup_state.to_dict()
+    return JSONResponse(state, status_code=200 if state["ready"] else 503)
+
+@app.get("/metrics")
+async def metrics():
+    """Job counters (including coalesced duplicate requests) and stage cache statistics"""
+    return {
+        "jobs": jobs.stats(),
+        "admission": scheduler.stats(),
+        "stage_cache": stage_cache.stats()
+    }
+
+def recognize_variant(
+    job: Job,
+    input_path: Path,
+    preprocessing: Dict,
+    output_format: str,
+    output_suffix: str = "",
+    report_progress: bool = True,
+    engine: str = OMR_ENGINE
+) -> Dict:
     """
-    Recognize handwritten music notation from an image.
+    Preprocess, recognize and validate the input with one set of
+    preprocessing options. With report_progress, partial results (preview,
+    files, metadata, validation) are also published to the job as they
+    become available.
     
-    Preprocessing steps:
-    1. Smoothing - Remove noise and clean up hand-drawn lines
-    2. Alignment - Straighten staff lines and correct rotation
-    3. Normalization - Adjust contrast, brightness, and scale
-    4. Validation - Verify and correct recognized notation
+    Returns:
+        Dictionary with the preprocessing options, preprocessed image path,
+        preprocessing metadata and the recognition result (with validation)
+    """
+    def progress(stage: str, percent: int, **data):
+        if report_progress:
+            job.add_event(stage, percent, **data)
     
-    Parameters:
-    - image: Image file (PNG, JPG, JPEG, TIFF)
-    - apply_smoothing: Enable noise reduction and line smoothing
-    - apply_alignment: Enable staff line alignment and rotation correction
-    - apply_normalization: Enable contrast/brightness optimization
-    - smoothing_strength: Intensity of smoothing (1-5)
-    - output_format: Output format (musicxml, midi, pdf)
+    def publish(kind: str, data: Dict):
+        if not report_progress:
+            return
+        if kind == "file":
+            data = file_event(data["type"], data["path"])
+        job.publish(kind, data)
+    
+    from preprocessor import preprocess_handwritten_music
+    
+    # Step 1: Preprocess the image
+    logger.info("Starting preprocessing...")
+    progress("preprocessing", 5)
+    preprocessing_metadata = {}
+    preprocessed_path = preprocess_handwritten_music(
+        input_path=str(input_path),
+        output_dir=str(PROCESSED_DIR),
+        metadata=preprocessing_metadata,
+        output_suffix=output_suffix,
+        **preprocessing
+    )
+    logger.info(f"Preprocessing complete: {preprocessed_path}")
+    if report_progress:
+        publish_preview(job, preprocessed_path, preprocessing_metadata)
+    
+    job.raise_if_cancelled()
+    
+    # Step 2: Recognize (engine progress 0-100 maps onto 20-90). The native
+    # engine re-reads the cached preprocessing stages through the context.
+    logger.info(f"Recognizing with engine '{engine}'...")
+    progress("recognition", 20)
+    omr_result = recognize_score(
+        image_path=preprocessed_path,
+        output_dir=str(OUTPUT_DIR),
+        output_format=output_format,
+        progress_callback=lambda event: progress(
+            "recognition", 20 + event["percent"] * 70 // 100,
+            step=event["stage"], audiveris_step=event["step"]
+        ),
+        cancel_event=job.cancel_event,
+        engine=engine,
+        context={"input_path": str(input_path), "preprocessing": preprocessing, "publish": publish}
+    )
+    logger.info(f"Recognition complete ({omr_result['engine']['used']})")
+    
+    job.raise_if_cancelled()
+    
+    # Step 3: Validate and correct the output
+    musicxml_path = omr_result.get("files", {}).get("musicxml")
+    if musicxml_path:
+        logger.info("Validating and correcting MusicXML...")
+        progress("validation", 90)
+        omr_result["validation"] = validate_and_correct_musicxml(musicxml_path=musicxml_path)
+        publish("validation", omr_result["validation"])
+    
+    return {
+        "preprocessing": preprocessing,
+        "preprocessed_path": preprocessed_path,
+        "preprocessing_metadata": preprocessing_metadata,
+        "omr_result": omr_result
+    }
+
+
+def file_event(file_type: str, path: str) -> Dict:
+    """Partial result announcing a generated file by its download URL."""
+    return {"type": file_type, "url": f"/download/{Path(path).name}"}
+
+
+def publish_preview(job: Job, preprocessed_path: str, preprocessing_metadata: Dict):
+    """Make the preprocessed image available as the job's preview."""
+    job.update(preview_path=preprocessed_path)
+    job.publish("preview", {
+        "url": f"/jobs/{job.id}/preview",
+        "preprocessing_metadata": preprocessing_metadata
+    })
+
+
+def publish_variant(job: Job, variant: Dict):
+    """Publish the partial results of a finished variant all at once."""
+    publish_preview(job, variant["preprocessed_path"], variant["preprocessing_metadata"])
+    omr_result = variant["omr_result"]
+    for file_type, path in omr_result.get("files", {}).items():
+        job.publish("file", file_event(file_type, path))
+    job.publish("metadata", omr_result.get("metadata", {}))
+    if "validation" in omr_result:
+        job.publish("validation", omr_result["validation"])
+
+
+def speculative_variants(preprocessing: Dict) -> List[Dict]:
     """
-    logger.info(f"OMR request received for file: {image.filename}")
+    Preprocessing options tried in speculative mode: the requested options
+    first, then the alternates from SPECULATIVE_VARIANTS, without duplicates.
+    The count is bounded by SPECULATIVE_MAX_VARIANTS and the Audiveris pool size.
+    """
+    variants = [dict(preprocessing)]
+    for overrides in SPECULATIVE_VARIANTS:
+        variant = {**preprocessing, **overrides}
+        if variant not in variants:
+            variants.append(variant)
     
-    try:
-        # Validate file type
-        allowed_extensions = {'.png', '.jpg', '.jpeg', '.tiff', '.tif', '.bmp'}
-        file_ext = Path(image.filename).suffix.lower()
-        if file_ext not in allowed_extensions:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Invalid file type. Allowed: {', '.join(allowed_extensions)}"
-            )
-        
-        # Save uploaded image
-        temp_input = UPLOAD_DIR / f"input_{image.filename}"
-        with open(temp_input, "wb") as f:
-            content = await image.read()
-            f.write(content)
-        
-        logger.info(f"Saved input image: {temp_input}")
-        
-        # Step 1: Preprocess the image
-        logger.info("Starting preprocessing...")
-        preprocessed_path = preprocess_handwritten_music(
-            input_path=str(temp_input),
-            output_dir=str(PROCESSED_DIR),
-            apply_smoothing=apply_smoothing,
-            apply_alignment=apply_alignment,
-            apply_normalization=apply_normalization,
-            smoothing_strength=smoothing_strength
-        )
-        logger.info(f"Preprocessing complete: {preprocessed_path}")
-        
-        # Step 2: Process with Audiveris
-        logger.info("Processing with Audiveris...")
-        omr_result = process_with_audiveris(
-            image_path=preprocessed_path,
-            output_dir=str(OUTPUT_DIR),
-            output_format=output_format
+    limit = max(1, min(SPECULATIVE_MAX_VARIANTS, AUDIVERIS_MAX_CONCURRENCY))
+    return variants[:limit]
+
+
+def run_speculative_variants(
+    job: Job,
+    input_path: Path,
+    preprocessing: Dict,
+    output_format: str,
+    engine: str = OMR_ENGINE
+) -> Dict:
+    """
+    Recognize several preprocessing variants concurrently and pick the one
+    with the best validation score.
+    
+    Returns:
+        The best variant, with a "speculative" summary of all variants' scores
+    """
+    variants = speculative_variants(preprocessing)
+    logger.info(f"Running {len(variants)} speculative preprocessing variants")
+    job.add_event("recognition", 20, step="variants", variants=len(variants))
+    
+    outcomes = [None] * len(variants)
+    
+    def run(index: int) -> Dict:
+        return recognize_variant(
+            job, input_path, variants[index], output_format,
+            output_suffix=f"_v{index}", report_progress=False, engine=engine
         )
-        logger.info(f"Audiveris processing complete")
-        
-        # Step 3: Validate and correct the output
-        if output_format == "musicxml" and omr_result.get("musicxml_path"):
-            logger.info("Validating and correcting MusicXML...")
-            validated_result = validate_and_correct_musicxml(
-                musicxml_path=omr_result["musicxml_path"]
+    
+    # Variants share the cached upstream stages, so only the stages after
+    # the first differing parameter (and Audiveris) run per variant
+    with ThreadPoolExecutor(max_workers=len(variants)) as executor:
+        futures = {executor.submit(run, index): index for index in range(len(variants))}
+        for done_count, future in enumerate(as_completed(futures), start=1):
+            index = futures[future]
+            try:
+                outcome = future.result()
+                report = outcome["omr_result"].get("validation", {"status": "error"})
+                outcome["score"] = score_validation_report(report)
+                outcome["status"] = "success"
+            except Exception as e:
+                outcome = {"preprocessing": variants[index], "status": "failed", "error": str(e)}
+            outcomes[index] = outcome
+            job.add_event(
+                "recognition", 20 + 70 * done_count // len(variants),
+                step="variants", completed=done_count, variants=len(variants)
             )
-            omr_result["validation"] = validated_result
+    
+    job.raise_if_cancelled()
+    
+    succeeded = [i for i, outcome in enumerate(outcomes) if outcome["status"] == "success"]
+    if not succeeded:
+        raise RuntimeError(f"All preprocessing variants failed: {outcomes[0]['error']}")
+    
+    # Lowest penalty wins; ties go to the variant listed first (the requested options)
+    best_index = min(succeeded, key=lambda i: (outcomes[i]["score"]["penalty"], i))
+    best = outcomes[best_index]
+    best["speculative"] = {
+        "selected": best_index,
+        "variants": [
+            {
+                "preprocessing": outcome["preprocessing"],
+                "status": outcome["status"],
+                "score": outcome.get("score"),
+                "error": outcome.get("error")
+            }
+            for outcome in outcomes
+        ]
+    }
+    logger.info(f"Selected speculative variant {best_index}: {best['score']}")
+    publish_variant(job, best)
+    return best
+
+
+def run_recognition_pipeline(
+    job: Job,
+    input_path: Path,
+    original_filename: str,
+    preprocessing: Dict,
+    output_format: str,
+    quality: Optional[Dict] = None,
+    speculative: bool = False,
+    engine: str = OMR_ENGINE
+) -> Dict:
+    """
+    Run preprocessing, recognition and validation for one job.
+    Runs in a worker thread; progress is reported through the job.
+    
+    Args:
+        preprocessing: Keyword options for preprocess_handwritten_music
+        output_format: Output format (musicxml, midi, pdf)
+        quality: Pre-flight quality report, included in the response
+        speculative: Try several preprocessing variants and return the best
+        engine: Recognition engine (auto, audiveris, native)
+    """
+    job.update(status="running")
+    
+    try:
+        job.raise_if_cancelled()
         
-        # Cleanup temp input file
-        temp_input.unlink(missing_ok=True)
+        if speculative:
+            variant = run_speculative_variants(job, input_path, preprocessing, output_format, engine)
+        else:
+            variant = recognize_variant(job, input_path, preprocessing, output_format, engine=engine)
+        
+        omr_result = variant["omr_result"]
+        applied = variant["preprocessing"]
         
         # Prepare response
         response = {
             "status": "success",
-            "original_filename": image.filename,
-            "preprocessed_image": str(preprocessed_path),
+            "job_id": job.id,
+            "original_filename": original_filename,
+            "preprocessed_image": str(variant["preprocessed_path"]),
             "preprocessing_applied": {
-                "smoothing": apply_smoothing,
-                "alignment": apply_alignment,
-                "normalization": apply_normalization,
-                "smoothing_strength": smoothing_strength
+                "smoothing": applied["apply_smoothing"],
+                "alignment": applied["apply_alignment"],
+                "normalization": applied["apply_normalization"],
+                "cropping": applied["apply_cropping"],
+                "smoothing_strength": applied["smoothing_strength"],
+                "smoothing_engine": applied["smoothing_engine"],
+                "binarization_engine": applied["binarization_engine"]
             },
+            "preprocessing_metadata": variant["preprocessing_metadata"],
+            "quality": quality,
             "output_format": output_format,
             "files": omr_result.get("files", {}),
             "download_urls": {},
             "metadata": omr_result.get("metadata", {}),
+            "engine": omr_result.get("engine", {}),
             "validation": omr_result.get("validation", {})
         }
+        if speculative:
+            response["speculative"] = variant["speculative"]
         
         # Add download URLs for generated files
         for file_type, file_path in omr_result.get("files", {}).items():
             if file_path and Path(file_path).exists():
                 filename = Path(file_path).name
                 response["download_urls"][file_type] = f"/download/{filename}"
+        # Validation returns measure patches; the full corrected file is built on request
+        if response["validation"].get("patches"):
+            response["download_urls"]["musicxml_corrected"] = f"/jobs/{job.id}/corrected"
         
+        job.update(status="completed", result=response)
+        job.add_event("completed", 100)
         logger.info("OMR recognition complete")
-        return JSONResponse(response)
+        return response
         
     except Exception as e:
+        if job.cancelled:
+            logger.info(f"OMR job {job.id} cancelled: {job.error}")
+            job.update(status="cancelled", log_tail=getattr(e, "log_tail", []))
+            raise
+        
         import traceback
         logger.error(f"OMR recognition failed: {e}")
         logger.error(traceback.format_exc())
+        job.update(
+            status="failed",
+            error=str(e),
+            log_tail=getattr(e, "log_tail", [])
+        )
+        raise
+    
+    finally:
+        # Identical requests arriving from now on start a new job
+        jobs.release_inflight(job)
+        # Cleanup temp input file
+        input_path.unlink(missing_ok=True)
+
+
+def recognition_options(
+    apply_smoothing: bool = Form(default=True),
+    apply_alignment: bool = Form(default=True),
+    apply_normalization: bool = Form(default=True),
+    apply_cropping: bool = Form(default=True),
+    smoothing_strength: int = Form(default=2),
+    smoothing_engine: Optional[str] = Form(default=None),  # bilateral, guided, auto
+    binarization_engine: Optional[str] = Form(default=None),  # gaussian, sauvola, wolf
+    output_format: str = Form(default="musicxml"),  # musicxml, midi, pdf
+    quality_check: bool = Form(default=True),
+    speculative: bool = Form(default=False),
+    engine: str = Form(default=OMR_ENGINE),  # auto, audiveris, native
+    inline: bool = Form(default=False)
+) -> Dict:
+    """Form parameters shared by the recognition endpoints."""
+    # Engine defaults come from the preprocessor, which is loaded on first use
+    from preprocessor import (
+        BINARIZATION_ENGINE,
+        BINARIZATION_ENGINES,
+        SMOOTHING_ENGINE,
+        SMOOTHING_ENGINES,
+    )
+    
+    smoothing_engine = smoothing_engine or SMOOTHING_ENGINE
+    binarization_engine = binarization_engine or BINARIZATION_ENGINE
+    if smoothing_engine not in SMOOTHING_ENGINES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid smoothing engine. Allowed: {', '.join(SMOOTHING_ENGINES)}"
+        )
+    if binarization_engine not in BINARIZATION_ENGINES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid binarization engine. Allowed: {', '.join(BINARIZATION_ENGINES)}"
+        )
+    if engine not in OMR_ENGINES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid engine. Allowed: {', '.join(OMR_ENGINES)}"
+        )
+    
+    return {
+        "preprocessing": {
+            "apply_smoothing": apply_smoothing,
+            "apply_alignment": apply_alignment,
+            "apply_normalization": apply_normalization,
+            "apply_cropping": apply_cropping,
+            "smoothing_strength": smoothing_strength,
+            "smoothing_engine": smoothing_engine,
+            "binarization_engine": binarization_engine
+        },
+        "output_format": output_format,
+        "quality_check": quality_check,
+        "speculative": speculative,
+        "engine": engine,
+        "inline": inline
+    }
+
+
+def request_fingerprint(content: bytes, options: Dict) -> str:
+    """Key identifying identical requests: upload content plus the recognition options."""
+    recognition = {k: v for k, v in options.items() if k not in RESPONSE_OPTIONS}
+    digest = hashlib.sha256(content)
+    digest.update(json.dumps(recognition, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+async def submit_recognition_job(image: UploadFile, options: Dict, client: str) -> Job:
+    """
+    Validate and store an upload, then queue its pipeline with admission control.
+    An identical upload with identical options that is still being processed
+    is joined instead (the returned job then has more than one waiter).
+    
+    Raises:
+        HTTPException: 429 with Retry-After when the client's or the server's
+            queue budget is exhausted
+    """
+    # Validate file type
+    allowed_extensions = {'.png', '.jpg', '.jpeg', '.tiff', '.tif', '.bmp'}
+    file_ext = Path(image.filename).suffix.lower()
+    if file_ext not in allowed_extensions:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type. Allowed: {', '.join(allowed_extensions)}"
+        )
+    
+    content = await image.read()
+    key = request_fingerprint(content, options)
+    running = jobs.join_inflight(key)
+    if running is not None:
+        logger.info(f"Coalesced {image.filename} into running job {running.id} "
+                    f"({running.waiters} waiters)")
+        return running
+    
+    # Admission: cost in estimated engine seconds, queued fairly per client
+    variants = len(speculative_variants(options["preprocessing"])) if options["speculative"] else 1
+    # Header read only, and no await before the job is registered: a concurrent
+    # identical upload must find it in flight
+    cost = estimate_cost(upload_megapixels(content),
+                         options["output_format"], options["engine"], variants)
+    try:
+        ticket = scheduler.admit(client, cost)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail={"reason": e.reason, "message": str(e), "retry_after": e.retry_after},
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    
+    job = jobs.create()
+    # Joinable right away, so a burst of identical uploads shares the quality gate too
+    jobs.register_inflight(key, job)
+    # Save uploaded image under the job id so concurrent uploads never collide
+    temp_input = UPLOAD_DIR / f"input_{job.id}{file_ext}"
+    
+    # Until the task exists nothing else releases the ticket or the in-flight
+    # key, so any failure (disk full, request cancelled) must do it here
+    try:
+        await run_in_threadpool(temp_input.write_bytes, content)
+        logger.info(f"Saved input image: {temp_input} (job {job.id})")
+        
+        # Pre-flight quality gate: reject junk before spending a full Audiveris run on it
+        quality = None
+        if options["quality_check"]:
+            from quality import ImageQualityError, check_image_quality
+            
+            try:
+                quality = await run_in_threadpool(check_image_quality, str(temp_input))
+            except ImageQualityError as e:
+                logger.info(f"Job {job.id} rejected by quality gate: {e.reason}")
+                reject_job(job, temp_input, str(e),
+                           {"reason": e.reason, "message": str(e), "quality": e.report})
+            except Exception as e:
+                logger.warning(f"Job {job.id}: could not read image: {e}")
+                reject_job(job, temp_input, "Could not read image",
+                           {"reason": "unreadable", "message": "Could not read image"})
+        
+        job.add_event("queued", 0, client=client, cost=cost, position=scheduler.position(ticket))
+        job.task = asyncio.create_task(run_admitted_pipeline(
+            ticket,
+            job,
+            temp_input,
+            image.filename,
+            options["preprocessing"],
+            options["output_format"],
+            quality,
+            options["speculative"],
+            options["engine"]
+        ))
+    except BaseException as e:
+        scheduler.release(ticket)
+        if not job.finished:
+            logger.error(f"Job {job.id} could not be started: {e!r}")
+            temp_input.unlink(missing_ok=True)
+            jobs.release_inflight(job)
+            job.update(status="failed", error=f"Could not start job: {e!r}")
+        raise
+    # Failures are reported through the job; mark them retrieved for background jobs
+    job.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+    return job
+
+
+def request_client(request: Request) -> str:
+    """Identity of the caller for admission control."""
+    return client_identity(request.headers, request.client.host if request.client else None)
+
+
+async def run_admitted_pipeline(ticket: Ticket, job: Job, *args) -> Dict:
+    """
+    Run a job's pipeline in the thread pool once the scheduler lets it start.
+    A job cancelled while queued still enters the pipeline, which stops at
+    its first cancellation check and cleans up like any cancelled job.
+    """
+    try:
+        if await scheduler.wait_turn(ticket, job.cancel_event):
+            logger.info(f"Job {job.id} admitted ({ticket.client}, cost {ticket.cost}s)")
+        return await run_in_threadpool(run_recognition_pipeline, job, *args)
+    finally:
+        scheduler.release(ticket)
+
+
+def reject_job(job: Job, temp_input: Path, error: str, detail: Dict):
+    """Fail a job before its pipeline started (422 for it and every joined request)."""
+    temp_input.unlink(missing_ok=True)
+    jobs.release_inflight(job)
+    job.update(status="failed", error=error, rejection=detail)
+    raise HTTPException(status_code=422, detail=detail)
+
+
+async def wait_until_started(job: Job, poll_interval: float = 0.05):
+    """Wait for a joined job to pass the quality gate and start its pipeline."""
+    while job.task is None and not job.remote:
+        if job.rejection is not None:
+            raise HTTPException(status_code=422, detail=job.rejection)
+        if job.finished:
+            raise RuntimeError(job.error or f"Job {job.status}")
+        await asyncio.sleep(poll_interval)
+
+
+async def wait_for_job(job: Job, request: Request) -> Dict:
+    """
+    Wait for a job on behalf of a connected client.
+    If the client disconnects first, it stops waiting; once no client waits
+    anymore the job is cancelled so Audiveris stops working on a result
+    nobody will read.
+    
+    Jobs run by another worker are followed through the shared job store.
+    """
+    await wait_until_started(job)
+    while True:
+        if job.remote:
+            jobs.refresh(job)
+            if job.finished:
+                return remote_job_result(job)
+            await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+        else:
+            done, _ = await asyncio.wait({job.task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return job.task.result()
+        
+        if await request.is_disconnected():
+            if jobs.detach(job, "Client disconnected"):
+                logger.info(f"Client disconnected, cancelling job {job.id}")
+            else:
+                logger.info(f"Client disconnected, job {job.id} still has {job.waiters} waiters")
+            raise HTTPException(status_code=499, detail="Client disconnected")
+
+
+def remote_job_result(job: Job) -> Dict:
+    """Result of a finished job run by another worker, raising its failure like a local one."""
+    if job.status == "completed":
+        return job.result
+    if job.rejection is not None:
+        raise HTTPException(status_code=422, detail=job.rejection)
+    raise RuntimeError(job.error or f"Job {job.status}")
+
+
+@app.post("/recognize")
+async def recognize_handwritten_music(
+    request: Request,
+    image: UploadFile = File(...),
+    options: Dict = Depends(recognition_options)
+):
+    """
+    Recognize handwritten music notation from an image.
+    
+    Preprocessing steps:
+    1. Smoothing - Remove noise and clean up hand-drawn lines
+    2. Alignment - Straighten staff lines and correct rotation
+    3. Normalization - Adjust contrast, brightness, and scale
+    4. Cropping - Crop to the detected staff systems
+    5. Validation - Verify and correct recognized notation
+    
+    Parameters:
+    - image: Image file (PNG, JPG, JPEG, TIFF)
+    - apply_smoothing: Enable noise reduction and line smoothing
+    - apply_alignment: Enable staff line alignment and rotation correction
+    - apply_normalization: Enable contrast/brightness optimization
+    - apply_cropping: Crop to the staff systems (offsets are returned in
+      preprocessing_metadata.crop so coordinates can be mapped back)
+    - smoothing_strength: Intensity of smoothing (1-5)
+    - smoothing_engine: Smoothing filter: bilateral (reference), guided
+      (fast guided filter, cheaper at strength 4-5) or auto (guided only
+      where it is faster)
+    - binarization_engine: Thresholding method: gaussian (fixed window) or
+      sauvola/wolf (window sized from the staff spacing; cleaner on uneven
+      lighting, so smoothing can often be weakened or disabled)
+    - output_format: Output format (musicxml, midi, pdf)
+    - quality_check: Run the pre-flight quality gate; images that are blurry,
+      blank or show no staff lines are rejected with 422 and a reason
+    - speculative: Recognize several preprocessing variants in parallel and
+      return the one with the best validation score (alternates' scores are
+      listed under "speculative")
+    - engine: Recognition engine: audiveris, native (in-process recognizer
+      for simple single-staff melodies, well under a second) or auto (native
+      when its confidence is high enough, otherwise Audiveris; the choice is
+      reported under "engine")
+    - inline: Embed the MusicXML (gzip, base64) and MIDI in the response
+      under "inline_files" when they are at most INLINE_MAX_BYTES; larger
+      files are only linked in download_urls
+    
+    Jobs are admitted per client (X-API-Key or X-Client-Id header, else the
+    remote address) in weighted fair order; when a queue budget is exceeded
+    the request gets 429 with a Retry-After header.
+    
+    Identical concurrent requests (same image and parameters) share one
+    recognition run; see /metrics for how many were coalesced.
+    """
+    logger.info(f"OMR request received for file: {image.filename}")
+    
+    job = await submit_recognition_job(image, options, request_client(request))
+    
+    try:
+        response = await wait_for_job(job, request)
+        if options["inline"]:
+            response = await with_inline_files(response)
+        return JSONResponse(response)
+    except HTTPException:
+        raise
+    except Exception as e:
+        if job.cancelled:
+            raise HTTPException(status_code=409, detail=f"OMR job cancelled: {job.error}")
         raise HTTPException(
             status_code=500,
             detail=f"OMR recognition failed: {str(e)}"
         )
 
+
+def sse_event(event: str, data) -> str:
+    """Format one Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def job_event_stream(job: Job, request: Request, owns_waiter: bool, inline: bool = False):
+    """
+    Stream a job's progress and partial results as Server-Sent Events.
+    
+    Events: job (id, once), progress (stage events, including Audiveris
+    steps), preview, file, metadata, validation, then done (the full
+    response) or error. If owns_waiter, a client leaving before the end
+    detaches from the job like a disconnected /recognize client.
+    """
+    def finished() -> bool:
+        if job.remote:
+            return jobs.refresh(job).finished
+        if job.task is None:
+            # Failed before its pipeline started
+            return job.finished
+        return job.task.done()
+    
+    event_cursor = partial_cursor = 0
+    last_sent = time.monotonic()
+    done = False
+    try:
+        yield sse_event("job", {"job_id": job.id, "status_url": f"/jobs/{job.id}",
+                                "coalesced": job.waiters > 1})
+        while True:
+            done = finished()
+            updates, event_cursor, partial_cursor = job.updates_since(event_cursor, partial_cursor)
+            for kind, data in updates:
+                yield sse_event(kind, data)
+            if updates:
+                last_sent = time.monotonic()
+            
+            if done:
+                break
+            if job.task is None and job.rejection is not None:
+                yield sse_event("error", {"status": "failed", "status_code": 422, "error": job.rejection})
+                return
+            if await request.is_disconnected():
+                return
+            if time.monotonic() - last_sent > STREAM_KEEPALIVE_INTERVAL:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            await asyncio.sleep(STREAM_POLL_INTERVAL)
+        
+        # The pipeline stores its final status and response on the job
+        if job.status == "completed":
+            response = job.result
+            if inline:
+                response = await with_inline_files(response)
+            yield sse_event("done", response)
+        elif job.rejection is not None:
+            yield sse_event("error", {"status": "failed", "status_code": 422, "error": job.rejection})
+        else:
+            yield sse_event("error", {"status": job.status, "error": job.error or "Cancelled"})
+    finally:
+        if owns_waiter and not done:
+            if jobs.detach(job, "Client disconnected"):
+                logger.info(f"Stream client left, cancelling job {job.id}")
+
+
+def event_stream_response(stream) -> StreamingResponse:
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        # Proxies must pass events through as they are produced
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.post("/recognize/stream")
+async def recognize_stream(
+    request: Request,
+    image: UploadFile = File(...),
+    options: Dict = Depends(recognition_options)
+):
+    """
+    Recognize with the parameters of /recognize, streaming Server-Sent Events
+    as stages complete: the cleaned preview image (preview), Audiveris
+    progress (progress), score metadata (metadata), the validation report
+    (validation), each generated format (file) and finally the same
+    response /recognize returns (done), or error.
+    
+    Validation errors, 422 quality rejections and 429 admission rejections
+    are returned as plain HTTP errors before the stream starts.
+    """
+    logger.info(f"OMR stream request received for file: {image.filename}")
+    job = await submit_recognition_job(image, options, request_client(request))
+    return event_stream_response(job_event_stream(job, request, owns_waiter=True, inline=options["inline"]))
+
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str, request: Request, inline: bool = False):
+    """
+    Follow an existing job as Server-Sent Events (same events as
+    /recognize/stream). Leaving the stream does not cancel the job.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return event_stream_response(job_event_stream(job, request, owns_waiter=False, inline=inline))
+
+
+@app.get("/jobs/{job_id}/preview")
+async def get_job_preview(job_id: str):
+    """The job's preprocessed (cleaned, binarized) image, once preprocessing is done"""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not job.preview_path or not Path(job.preview_path).is_file():
+        raise HTTPException(status_code=404, detail="Preview not available yet")
+    return FileResponse(
+        path=str(job.preview_path),
+        media_type="image/png",
+        headers={"Cache-Control": ARTIFACT_CACHE_CONTROL}
+    )
+
+
+@app.get("/jobs/{job_id}/corrected")
+async def get_corrected_musicxml(job_id: str, request: Request):
+    """
+    The job's MusicXML with the validation patches applied. Validation only
+    returns the corrected measures; the full file is written on the first
+    request and then served like any download.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != "completed" or not job.result:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    
+    musicxml_path = job.result.get("files", {}).get("musicxml")
+    patches = job.result.get("validation", {}).get("patches")
+    if not musicxml_path or not patches:
+        raise HTTPException(status_code=404, detail="No corrections for this job")
+    
+    corrected_path = await run_in_threadpool(write_corrected_musicxml, musicxml_path, patches)
+    return await download_file(Path(corrected_path).name, request)
+
+
+@app.post("/jobs/{job_id}/validate")
+async def revalidate_job(job_id: str, payload: Dict = Body(...)):
+    """
+    Re-validate a job's score after measures were edited.
+    
+    The body lists the edited measures in the format of the validation
+    patches, {"measures": [{"part", "measure_index", "xml"}], "revision"}.
+    Only those measures, and following ones whose time signature, divisions
+    or clef changed with them, are checked again; the updated report is
+    returned with the new revision. Its patches are corrections to the
+    re-validated measures. A revision that does not match the server's
+    (e.g. after a restart) gives 409: send all edits again without a
+    revision, which re-indexes the score from the recognized file first.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != "completed" or not job.result:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    musicxml_path = job.result.get("files", {}).get("musicxml")
+    if not musicxml_path or not Path(musicxml_path).is_file():
+        raise HTTPException(status_code=404, detail="No MusicXML for this job")
+    
+    measures = payload.get("measures")
+    if not isinstance(measures, list) or not measures:
+        raise HTTPException(status_code=400, detail="Expected a non-empty list of measures")
+    
+    try:
+        return await run_in_threadpool(revalidate_measures, musicxml_path, measures,
+                                       payload.get("revision"))
+    except StaleRevision as e:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": "Score was re-indexed; send all edits again", "revision": e.revision}
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def with_inline_files(response: Dict) -> Dict:
+    """Copy of a job result with its small artifacts embedded (see inline_artifacts)."""
+    inline = await run_in_threadpool(inline_artifacts, response.get("files", {}))
+    return {**response, "inline_files": inline}
+
+
+@app.post("/jobs", status_code=202)
+async def create_recognition_job(
+    request: Request,
+    image: UploadFile = File(...),
+    options: Dict = Depends(recognition_options)
+):
+    """
+    Start a recognition job in the background.
+    
+    Takes the same parameters as /recognize and returns immediately with a
+    job id; poll /jobs/{job_id} for progress and the final result.
+    """
+    logger.info(f"OMR job submitted for file: {image.filename}")
+    
+    job = await submit_recognition_job(image, options, request_client(request))
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "coalesced": job.waiters > 1
+    }
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, inline: bool = False):
+    """
+    Get status, step-level progress and (when finished) the result of a job.
+    With inline=true a completed result embeds its small artifacts, as with
+    the inline option of /recognize.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    data = job.to_dict()
+    if inline and data.get("result"):
+        data["result"] = await with_inline_files(data["result"])
+    return data
+
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """
+    Cancel a running job, killing its Audiveris process.
+    A job shared by coalesced requests keeps running for the others; the
+    caller just stops waiting on it.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    if job.finished:
+        raise HTTPException(status_code=409, detail=f"Job already {job.status}")
+    
+    if not jobs.detach(job, "Cancelled by client"):
+        logger.info(f"Client left job {job_id}, {job.waiters} waiters remain")
+        return {"job_id": job.id, "status": "detached", "waiters": job.waiters}
+    
+    jobs.release_inflight(job)
+    logger.info(f"Job {job_id} cancelled via API")
+    return {"job_id": job.id, "status": "cancelling"}
+
 @app.get("/download/{filename}")
-async def download_file(filename: str):
-    """Download processed files (MusicXML, MIDI, PDF)"""
-    file_path = OUTPUT_DIR / filename
+async def download_file(filename: str, request: Request):
+    """
+    Download processed files (MusicXML, MIDI, PDF).
     
-    if not file_path.exists():
+    Artifacts are immutable, so responses carry a content-hash ETag
+    (If-None-Match gives 304) and long-lived Cache-Control. MusicXML is sent
+    from stored gzip/brotli variants when Accept-Encoding allows, and byte
+    ranges are supported (e.g. for large PDFs).
+    """
+    file_path = resolve_artifact(OUTPUT_DIR, filename)
+    if file_path is None:
         raise HTTPException(status_code=404, detail="File not found")
     
-    # Determine media type
-    media_types = {
-        '.xml': 'application/xml',
-        '.musicxml': 'application/vnd.recordare.musicxml+xml',
-        '.mid': 'audio/midi',
-        '.midi': 'audio/midi',
-        '.pdf': 'application/pdf'
+    encoding = negotiate_encoding(file_path, request.headers.get("accept-encoding", ""))
+    etag = variant_etag(await run_in_threadpool(content_etag, file_path), encoding)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": ARTIFACT_CACHE_CONTROL,
+        "Vary": "Accept-Encoding"
     }
     
-    media_type = media_types.get(file_path.suffix.lower(), 'application/octet-stream')
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    
+    serve_path = file_path
+    if encoding:
+        serve_path = await run_in_threadpool(compressed_variant, file_path, encoding)
+        headers["Content-Encoding"] = encoding
+    
+    media_type = MEDIA_TYPES.get(file_path.suffix.lower(), 'application/octet-stream')
     
     return FileResponse(
-        path=str(file_path),
+        path=str(serve_path),
         media_type=media_type,
-        filename=filename
+        filename=filename,
+        headers=headers
     )
 
 @app.delete("/cleanup")
@@ -221,4 +1063,5 @@ async def cleanup_files():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    # Several workers coordinate through the shared store under OMR_STATE_DIR
+    uvicorn.run("main:app", host="0.0.0.0", port=8001, workers=OMR_WORKERS)
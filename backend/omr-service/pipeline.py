@@ -0,0 +1,276 @@
+"""
+Declarative image pipeline with per-stage memoization.
+Each stage's output is cached under a key chained from the input hash and
+the names and parameters of every stage up to it, so a re-run only
+recomputes the stages downstream of the first changed parameter.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from binary_image import PackedBinaryImage
+from shared_state import OMR_STATE_DIR, SHARED_STATE
+
+logger = logging.getLogger(__name__)
+
+# In-memory stage cache budget
+PIPELINE_CACHE_MB = float(os.getenv("PIPELINE_CACHE_MB", "256"))
+# Optional on-disk cache (disabled when empty) and its budget. Workers share
+# it in multi-worker mode, where it is on by default.
+PIPELINE_CACHE_DIR = os.getenv("PIPELINE_CACHE_DIR", "") or (
+    os.path.join(OMR_STATE_DIR, "stages") if SHARED_STATE else ""
+)
+PIPELINE_DISK_CACHE_MB = float(os.getenv("PIPELINE_DISK_CACHE_MB", "2048"))
+
+# Stage images are arrays, or PackedBinaryImage once binarized
+StageOutput = Tuple[Any, Optional[Dict]]
+
+
+class Stage:
+    """
+    A named pipeline step.
+
+    Args:
+        name: Stage name (part of the cache key and reported timings)
+        func: Called as func(image, **params); returns the output image and
+            an optional dictionary merged into the pipeline metadata
+            (which must be JSON-serializable for the disk cache)
+        params: Parameters that determine the stage's output
+        enabled: Disabled stages are skipped and excluded from cache keys
+        uses_context: Also pass the metadata accumulated by the upstream
+            stages as func(image, context=..., **params). It is fully
+            determined by the upstream cache key, so it needs no key of its own.
+    """
+
+    def __init__(self, name: str, func: Callable[..., StageOutput],
+                 params: Optional[Dict[str, Any]] = None, enabled: bool = True,
+                 uses_context: bool = False):
+        self.name = name
+        self.func = func
+        self.params = params or {}
+        self.enabled = enabled
+        self.uses_context = uses_context
+
+    def cache_key(self, upstream_key: str) -> str:
+        payload = json.dumps([upstream_key, self.name, self.params], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class StageCache:
+    """
+    Bounded LRU cache of stage outputs.
+    Entries evicted from memory stay available on disk when a cache
+    directory is configured.
+    """
+
+    def __init__(self, max_bytes: float, disk_dir: Optional[str] = None,
+                 disk_max_bytes: float = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str) -> Optional[StageOutput]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._store_memory(key, entry)
+        return entry
+
+    def put(self, key: str, image: Any, meta: Optional[Dict]):
+        # Cached arrays are shared between requests and must never be mutated
+        if isinstance(image, np.ndarray):
+            image = np.ascontiguousarray(image)
+        image.flags.writeable = False
+        entry = (image, meta)
+        self._store_memory(key, entry)
+        self._write_disk(key, entry)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _store_memory(self, key: str, entry: StageOutput):
+        size = entry[0].nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._size -= evicted.nbytes
+
+    def _read_disk(self, key: str) -> Optional[StageOutput]:
+        if not self.disk_dir:
+            return None
+        data_path = self.disk_dir / f"{key}.npy"
+        meta_path = self.disk_dir / f"{key}.json"
+        try:
+            record = json.loads(meta_path.read_text())
+            image = np.load(data_path, allow_pickle=False)
+            meta = record["meta"]
+            if record.get("packed_width") is not None:
+                image = PackedBinaryImage(image, record["packed_width"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        image.flags.writeable = False
+        try:
+            os.utime(data_path)  # keep recently used entries on disk
+        except FileNotFoundError:
+            pass  # pruned by another worker meanwhile
+        return image, meta
+
+    def _write_disk(self, key: str, entry: StageOutput):
+        if not self.disk_dir:
+            return
+        image, meta = entry
+        record = {"meta": meta, "packed_width": None}
+        if isinstance(image, PackedBinaryImage):
+            record["packed_width"] = image.width
+            image = image.bits
+        try:
+            # Write to temporary names and rename so readers never see partial files
+            suffix = f"{os.getpid()}-{threading.get_ident()}.tmp"
+            tmp_data = self.disk_dir / f"{key}.{suffix}.npy"
+            tmp_meta = self.disk_dir / f"{key}.{suffix}.json"
+            np.save(tmp_data, image, allow_pickle=False)
+            tmp_meta.write_text(json.dumps(record))
+            os.replace(tmp_meta, self.disk_dir / f"{key}.json")
+            os.replace(tmp_data, self.disk_dir / f"{key}.npy")
+            self._prune_disk()
+        except (OSError, TypeError) as e:
+            logger.warning(f"Could not write stage cache entry {key}: {e}")
+
+    def _prune_disk(self):
+        """Delete least recently used disk entries beyond the disk budget."""
+        entries = []
+        for data_path in self.disk_dir.glob("*.npy"):
+            if ".tmp." in data_path.name:
+                continue  # still being written
+            try:
+                stat = data_path.stat()
+            except FileNotFoundError:
+                continue  # pruned by another worker
+            entries.append((stat.st_mtime, stat.st_size, data_path))
+        entries.sort(key=lambda entry: entry[0])
+        total = sum(size for _, size, _ in entries)
+        for _, size, data_path in entries:
+            if total <= self.disk_max_bytes:
+                break
+            total -= size
+            data_path.unlink(missing_ok=True)
+            data_path.with_suffix(".json").unlink(missing_ok=True)
+
+
+stage_cache = StageCache(
+    max_bytes=PIPELINE_CACHE_MB * 1024 * 1024,
+    disk_dir=PIPELINE_CACHE_DIR or None,
+    disk_max_bytes=PIPELINE_DISK_CACHE_MB * 1024 * 1024
+)
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """Content hash of a file, used as the root of the stage cache keys."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def run_stages(
+    stages: List[Stage],
+    input_key: str,
+    cache: Optional[StageCache] = None,
+    metadata: Optional[Dict] = None
+) -> Any:
+    """
+    Run a chain of stages, resuming from the deepest cached output.
+
+    Args:
+        stages: Stages in execution order; the first receives None as input
+        input_key: Hash identifying the pipeline input
+        cache: Stage cache (the shared module cache by default)
+        metadata: Optional dictionary receiving each stage's metadata and
+            per-stage timings under "stages"
+
+    Returns:
+        Output image of the last stage
+    """
+    if cache is None:
+        cache = stage_cache
+    if metadata is None:
+        metadata = {}
+
+    active = [stage for stage in stages if stage.enabled]
+    keys = []
+    key = input_key
+    for stage in active:
+        key = stage.cache_key(key)
+        keys.append(key)
+
+    # Find the deepest stage whose output is already cached. Entries carry the
+    # metadata accumulated up to their stage, so a hit restores all of it.
+    start = 0
+    image = None
+    accumulated = {}
+    stage_stats = []
+    for index in range(len(active) - 1, -1, -1):
+        cached = cache.get(keys[index])
+        if cached is not None:
+            image, accumulated = cached[0], dict(cached[1] or {})
+            start = index + 1
+            stage_stats = [{"name": stage.name, "cached": True, "seconds": 0.0}
+                           for stage in active[:start]]
+            logger.info(f"Resuming pipeline after cached stage '{active[index].name}'")
+            break
+
+    for index in range(start, len(active)):
+        stage = active[index]
+        started = time.perf_counter()
+        if stage.uses_context:
+            image, meta = stage.func(image, context=dict(accumulated), **stage.params)
+        else:
+            image, meta = stage.func(image, **stage.params)
+        elapsed = time.perf_counter() - started
+        if meta:
+            accumulated.update(meta)
+        cache.put(keys[index], image, dict(accumulated))
+        stage_stats.append({"name": stage.name, "cached": False, "seconds": round(elapsed, 4)})
+
+    metadata.update(accumulated)
+    metadata["stages"] = stage_stats
+    return image
@@ -7,10 +7,40 @@ import cv2
 import numpy as np
 from pathlib import Path
 import logging
-from typing import Tuple, Optional
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from binary_image import PackedBinaryImage
+from pipeline import Stage, hash_file, run_stages
 
 logger = logging.getLogger(__name__)
 
+# Images above this size are decoded at reduced size where the format allows
+# it and scaled down the rest of the way in the deskew warp
+PREPROCESS_MAX_MEGAPIXELS = float(os.getenv("PREPROCESS_MAX_MEGAPIXELS", "16"))
+
+# Edge-preserving filters available to smooth_handwritten_notation:
+# bilateral (reference), guided (box-filter guided filter whose cost does not
+# grow with strength) and auto (guided from GUIDED_MIN_STRENGTH up, where it
+# beats bilateral; compare with compare_smoothing.py)
+SMOOTHING_ENGINES = ("bilateral", "guided", "auto")
+SMOOTHING_ENGINE = os.getenv("SMOOTHING_ENGINE", "bilateral")
+GUIDED_MIN_STRENGTH = 4
+# Guided filter regularization relative to the bilateral range sigma
+GUIDED_EPS_FACTOR = 0.25
+
+# Thresholding methods available to binarize_image: gaussian (fixed 15px
+# adaptive threshold) or the Sauvola/Wolf local-statistics thresholds with a
+# window sized from the staff spacing
+BINARIZATION_ENGINES = ("gaussian", "sauvola", "wolf")
+BINARIZATION_ENGINE = os.getenv("BINARIZATION_ENGINE", "gaussian")
+SAUVOLA_K = 0.2
+SAUVOLA_R = 128.0
+WOLF_K = 0.5
+
 
 def preprocess_handwritten_music(
     input_path: str,
@@ -18,7 +48,12 @@ def preprocess_handwritten_music(
     apply_smoothing: bool = True,
     apply_alignment: bool = True,
     apply_normalization: bool = True,
-    smoothing_strength: int = 2
+    smoothing_strength: int = 2,
+    apply_cropping: bool = True,
+    metadata: Optional[Dict] = None,
+    output_suffix: str = "",
+    smoothing_engine: str = SMOOTHING_ENGINE,
+    binarization_engine: str = BINARIZATION_ENGINE
 ) -> str:
     """
     Main preprocessing pipeline for handwritten music notation.
@@ -30,55 +65,279 @@ def preprocess_handwritten_music(
         apply_alignment: Enable alignment correction
         apply_normalization: Enable normalization
         smoothing_strength: Smoothing intensity (1-5)
+        apply_cropping: Crop to the detected staff systems
+        metadata: Optional dictionary filled with details of the applied
+            steps (e.g. crop offsets)
+        output_suffix: Appended to the output file stem, to keep variants
+            of the same input apart
+        smoothing_engine: Smoothing filter, one of SMOOTHING_ENGINES
+        binarization_engine: Thresholding method, one of BINARIZATION_ENGINES
     
     Returns:
-        Path to processed image
+        Path to processed image (1-bit PNG)
     """
-    logger.info(f"Loading image: {input_path}")
+    if metadata is None:
+        metadata = {}
     
-    # Load image
-    image = cv2.imread(input_path)
-    if image is None:
-        raise ValueError(f"Failed to load image: {input_path}")
+    stages = build_preprocessing_stages(
+        input_path,
+        apply_smoothing=apply_smoothing,
+        apply_alignment=apply_alignment,
+        apply_normalization=apply_normalization,
+        smoothing_strength=smoothing_strength,
+        apply_cropping=apply_cropping,
+        smoothing_engine=smoothing_engine,
+        binarization_engine=binarization_engine
+    )
+    processed = run_stages(stages, hash_file(input_path), metadata=metadata)
     
-    original_image = image.copy()
+    # Save processed image (binary, so a 1-bit PNG is lossless and compact)
+    input_name = Path(input_path)
+    output_path = Path(output_dir) / f"preprocessed_{input_name.stem}{output_suffix}.png"
+    processed.save(str(output_path))
     
-    # Convert to grayscale for processing
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    logger.info(f"Preprocessing complete: {output_path}")
+    return str(output_path)
+
+
+def preprocessed_grayscale(input_path: str, until: str = "binarize", **options) -> Tuple[np.ndarray, Dict]:
+    """
+    Grayscale image as it is right before a stage (binarization by default),
+    for consumers that threshold it themselves. Takes the same options as
+    preprocess_handwritten_music; after a preprocessing run every stage is
+    a cache hit.
     
-    # Step 1: Normalization (do this first for better results)
-    if apply_normalization:
-        logger.info("Applying normalization...")
-        gray = normalize_image(gray)
+    Returns:
+        Tuple of (image, metadata including the staff model)
+    """
+    options = {k: v for k, v in options.items() if k not in ("metadata", "output_suffix")}
+    stages = build_preprocessing_stages(input_path, **options)
+    names = [stage.name for stage in stages]
+    metadata = {}
+    image = run_stages(stages[:names.index(until)], hash_file(input_path), metadata=metadata)
+    return image, metadata
+
+
+def build_preprocessing_stages(
+    input_path: str,
+    apply_smoothing: bool = True,
+    apply_alignment: bool = True,
+    apply_normalization: bool = True,
+    smoothing_strength: int = 2,
+    apply_cropping: bool = True,
+    smoothing_engine: str = SMOOTHING_ENGINE,
+    binarization_engine: str = BINARIZATION_ENGINE
+) -> List[Stage]:
+    """
+    Declare the preprocessing pipeline.
     
-    # Step 2: Alignment (straighten staff lines)
-    if apply_alignment:
+    Stage parameters are part of the stage cache keys, so re-running with a
+    different smoothing strength resumes from the cached crop output.
+    Stages from binarization on pass PackedBinaryImage (1 bit per pixel).
+    The staff model measured after alignment sizes the crop padding, the
+    binarization window, the line kernels and the noise threshold.
+    """
+    return [
+        # Step 0: Load straight to grayscale, upright and no larger than
+        # needed (the cache key comes from the file hash, not the path)
+        Stage("load", lambda _, **params: _load_stage(input_path, **params), {
+            "max_megapixels": PREPROCESS_MAX_MEGAPIXELS
+        }),
+        # Step 1: Normalization (do this first for better results)
+        Stage("normalize", _normalize_stage, enabled=apply_normalization),
+        # Step 2: Alignment (straighten staff lines); oversized images are
+        # scaled down in the same warp
+        Stage("align", _align_stage, {
+            "rotate": apply_alignment,
+            "max_megapixels": PREPROCESS_MAX_MEGAPIXELS
+        }),
+        # Step 3: Staff model (line positions, thickness, interline, systems)
+        Stage("staves", _staves_stage),
+        # Step 4: Crop to the staff systems (removes desk, margins, hands)
+        Stage("crop", _crop_stage, enabled=apply_cropping, uses_context=True),
+        # Step 5: Smoothing (clean up noise and hand-drawn imperfections)
+        Stage("smooth", _smooth_stage, {
+            "strength": smoothing_strength,
+            "engine": smoothing_engine
+        }, enabled=apply_smoothing),
+        # Step 6: Binarization (convert to black and white for better OMR)
+        Stage("binarize", _binarize_stage, {"engine": binarization_engine}, uses_context=True),
+        # Step 7: Staff line enhancement
+        Stage("enhance", _enhance_stage, uses_context=True),
+        # Step 8: Remove small noise
+        Stage("denoise", _denoise_stage, uses_context=True),
+    ]
+
+
+def _load_stage(input_path: str, max_megapixels: float):
+    logger.info(f"Loading image: {input_path}")
+    decode = {}
+    image = decode_grayscale(input_path, max_megapixels=max_megapixels, metadata=decode)
+    return image, {"decode": decode}
+
+
+def _normalize_stage(image: np.ndarray):
+    logger.info("Applying normalization...")
+    return normalize_image(image), None
+
+
+def _align_stage(image: np.ndarray, rotate: bool, max_megapixels: float):
+    scale = processing_scale(image.shape, max_megapixels)
+    meta = {"scale": scale}
+    if rotate:
         logger.info("Applying alignment...")
-        gray = align_staff_lines(gray)
+        alignment = {}
+        image = align_staff_lines(image, scale=scale, metadata=alignment)
+        meta["alignment"] = alignment
+    elif scale < 1.0:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return image, meta
+
+
+def _staff_parameters(context: Dict) -> Dict:
+    """Staff-derived stage parameters, or {} when no staves were found."""
+    model = context.get("staff_model")
+    return model["parameters"] if model else {}
+
+
+def _staves_stage(image: np.ndarray):
+    logger.info("Measuring staff lines...")
+    return image, {"staff_model": build_staff_model(image)}
+
+
+def _crop_stage(image: np.ndarray, context: Dict):
+    logger.info("Detecting score region...")
+    model = context.get("staff_model")
+    region = detect_score_region(image, staff_model=model) if model else None
+    meta = {"crop": region}
+    if region is not None:
+        image = crop_to_region(image, region)
+        # Keep the model in the coordinates of the output image
+        meta["staff_model"] = shift_staff_model(model, region["x"], region["y"])
+    return image, meta
+
+
+def _smooth_stage(image: np.ndarray, strength: int, engine: str):
+    logger.info(f"Applying smoothing (strength: {strength}, engine: {engine})...")
+    return smooth_handwritten_notation(image, strength=strength, engine=engine), None
+
+
+def _binarize_stage(image: np.ndarray, context: Dict, engine: str):
+    logger.info(f"Applying adaptive binarization (engine: {engine})...")
+    window = _staff_parameters(context).get("binarization_window")
+    return PackedBinaryImage.from_array(binarize_image(image, engine=engine, window=window)), None
+
+
+def _enhance_stage(image: PackedBinaryImage, context: Dict):
+    logger.info("Enhancing staff lines...")
+    parameters = _staff_parameters(context)
+    enhanced = enhance_staff_lines(
+        image,
+        line_length=parameters.get("line_kernel", 40),
+        max_gap=parameters.get("line_gap", 40)
+    )
+    return enhanced, None
+
+
+def _denoise_stage(image: PackedBinaryImage, context: Dict):
+    logger.info("Removing noise...")
+    min_size = _staff_parameters(context).get("noise_min_size", 5)
+    return remove_small_noise(image, min_size=min_size), None
+
+
+# Decoder flags for each power-of-two reduction (DCT-domain scaling for JPEG)
+REDUCED_GRAYSCALE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+# EXIF orientation tag and the transform that makes each value upright
+EXIF_ORIENTATION = 0x0112
+ORIENTATION_TRANSFORMS = {
+    2: lambda img: cv2.flip(img, 1),
+    3: lambda img: cv2.rotate(img, cv2.ROTATE_180),
+    4: lambda img: cv2.flip(img, 0),
+    5: lambda img: cv2.transpose(img),
+    6: lambda img: cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE),
+    7: lambda img: cv2.flip(cv2.transpose(img), -1),
+    8: lambda img: cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE),
+}
+
+
+def decode_grayscale(
+    image_path: str,
+    max_megapixels: Optional[float] = None,
+    max_dimension: Optional[int] = None,
+    metadata: Optional[Dict] = None
+) -> np.ndarray:
+    """
+    Decode an image straight to upright grayscale.
     
-    # Step 3: Smoothing (clean up noise and hand-drawn imperfections)
-    if apply_smoothing:
-        logger.info(f"Applying smoothing (strength: {smoothing_strength})...")
-        gray = smooth_handwritten_notation(gray, strength=smoothing_strength)
+    The size and EXIF orientation are read from the file header first. Images
+    far above the target are decoded at 1/2, 1/4 or 1/8 size (DCT scaling
+    for JPEG, so the full-resolution pixels are never produced); the largest
+    reduction that stays at or above the target is used, leaving the final
+    resize to the caller.
     
-    # Step 4: Binarization (convert to black and white for better OMR)
-    logger.info("Applying adaptive binarization...")
-    processed = binarize_image(gray)
+    Args:
+        image_path: Path to the image
+        max_megapixels: Target size in megapixels
+        max_dimension: Target length of the longest side
+        metadata: Optional dictionary receiving source size, reduction,
+            orientation and decode time
     
-    # Step 5: Staff line enhancement
-    logger.info("Enhancing staff lines...")
-    processed = enhance_staff_lines(processed)
+    Returns:
+        Grayscale uint8 image
+    """
+    started = time.perf_counter()
+    try:
+        with Image.open(image_path) as img:
+            width, height = img.size
+            orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+    except Exception as e:
+        raise ValueError(f"Failed to load image: {image_path} ({e})")
     
-    # Step 6: Remove small noise
-    logger.info("Removing noise...")
-    processed = remove_small_noise(processed)
+    reduction = 1
+    if max_megapixels is not None or max_dimension is not None:
+        for factor in (8, 4, 2):
+            if max_megapixels is not None and (width // factor) * (height // factor) / 1e6 < max_megapixels:
+                continue
+            if max_dimension is not None and max(width, height) // factor < max_dimension:
+                continue
+            reduction = factor
+            break
+    
+    # Orientation is applied below from the header, the same way on every build
+    image = cv2.imread(image_path, REDUCED_GRAYSCALE_FLAGS[reduction] | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        raise ValueError(f"Failed to load image: {image_path}")
     
-    # Save processed image
-    output_path = Path(output_dir) / f"preprocessed_{Path(input_path).name}"
-    cv2.imwrite(str(output_path), processed)
+    transform = ORIENTATION_TRANSFORMS.get(orientation)
+    if transform is not None:
+        image = transform(image)
     
-    logger.info(f"Preprocessing complete: {output_path}")
-    return str(output_path)
+    elapsed = time.perf_counter() - started
+    if metadata is not None:
+        metadata.update({
+            "source_size": [width, height],
+            "reduction": reduction,
+            "orientation": orientation,
+            "size": [image.shape[1], image.shape[0]],
+            "seconds": round(elapsed, 4)
+        })
+    logger.info(f"Decoded {width}x{height} image at 1/{reduction} scale "
+                f"(orientation {orientation}) in {elapsed:.3f}s")
+    return image
+
+
+def processing_scale(shape: Tuple[int, ...], max_megapixels: float = PREPROCESS_MAX_MEGAPIXELS) -> float:
+    """Scale factor that brings an image within the processing pixel budget."""
+    megapixels = shape[0] * shape[1] / 1_000_000
+    if max_megapixels <= 0 or megapixels <= max_megapixels:
+        return 1.0
+    return round(float(np.sqrt(max_megapixels / megapixels)), 4)
 
 
 def normalize_image(image: np.ndarray) -> np.ndarray:
@@ -96,101 +355,536 @@ def normalize_image(image: np.ndarray) -> np.ndarray:
     return normalized
 
 
-def align_staff_lines(image: np.ndarray) -> np.ndarray:
+def estimate_skew(
+    image: np.ndarray,
+    max_dimension: int = 1000,
+    max_angle: float = 15.0,
+    coarse_step: float = 0.5,
+    fine_step: float = 0.05,
+    max_points: int = 200000
+) -> Tuple[float, float]:
     """
-    Detect and correct rotation to align staff lines horizontally.
-    Uses Hough Line Transform to detect dominant line angle.
-    """
-    # Edge detection for line detection
-    edges = cv2.Canny(image, 50, 150, apertureSize=3)
-    
-    # Hough Line Transform to detect lines
-    lines = cv2.HoughLinesP(
-        edges,
-        rho=1,
-        theta=np.pi/180,
-        threshold=100,
-        minLineLength=100,
-        maxLineGap=10
+    Estimate the rotation of staff lines by a projection-profile search.
+    
+    Ink pixels of a downsampled, binarized copy are projected onto the
+    vertical axis along candidate angles; the angle giving the sharpest
+    profile (largest sum of squared bin counts) aligns the staff lines.
+    A coarse search is refined around the best coarse angle.
+    
+    Args:
+        image: Grayscale image
+        max_dimension: Longest side of the analysis copy
+        max_angle: Largest skew considered, in degrees
+        coarse_step: Angle step of the coarse search
+        fine_step: Angle step of the refinement
+        max_points: Ink pixels sampled for the projections
+    
+    Returns:
+        Tuple of (angle in degrees, confidence 0-1). The angle is that of
+        the lines in image coordinates (positive = descending to the right),
+        matching cv2.getRotationMatrix2D's convention for the correction.
+    """
+    height, width = image.shape[:2]
+    scale = min(1.0, max_dimension / max(height, width))
+    small = image
+    if scale < 1.0:
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    
+    ink = cv2.adaptiveThreshold(
+        small, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 10
     )
+    ys, xs = np.nonzero(ink)
+    if len(ys) < 100:
+        return 0.0, 0.0
     
-    if lines is None or len(lines) == 0:
-        logger.warning("No lines detected for alignment")
-        return image
+    if len(ys) > max_points:
+        stride = len(ys) // max_points + 1
+        ys, xs = ys[::stride], xs[::stride]
     
-    # Calculate angles of detected lines
-    angles = []
-    for line in lines:
-        x1, y1, x2, y2 = line[0]
-        angle = np.degrees(np.arctan2(y2 - y1, x2 - x1))
-        # Filter out vertical lines (we want horizontal staff lines)
-        if -45 < angle < 45:
-            angles.append(angle)
-    
-    if not angles:
-        logger.warning("No horizontal lines detected")
-        return image
+    ys = ys.astype(np.float32)
+    xs = xs.astype(np.float32) - small.shape[1] / 2
+    offset = small.shape[1] * np.tan(np.radians(max_angle))
     
-    # Calculate median angle for robustness
-    median_angle = np.median(angles)
-    logger.info(f"Detected rotation angle: {median_angle:.2f} degrees")
+    def profile_sharpness(angle: float) -> float:
+        projected = ys - xs * np.tan(np.radians(angle)) + offset
+        counts = np.bincount(projected.astype(np.int32))
+        return float(np.dot(counts, counts))
     
-    # Only rotate if angle is significant (> 0.5 degrees)
-    if abs(median_angle) > 0.5:
-        # Rotate image to correct alignment
-        height, width = image.shape
-        center = (width // 2, height // 2)
-        rotation_matrix = cv2.getRotationMatrix2D(center, median_angle, 1.0)
-        
-        # Calculate new dimensions to avoid cropping
-        cos = np.abs(rotation_matrix[0, 0])
-        sin = np.abs(rotation_matrix[0, 1])
-        new_width = int((height * sin) + (width * cos))
-        new_height = int((height * cos) + (width * sin))
-        
-        # Adjust rotation matrix for new dimensions
-        rotation_matrix[0, 2] += (new_width / 2) - center[0]
-        rotation_matrix[1, 2] += (new_height / 2) - center[1]
-        
-        rotated = cv2.warpAffine(
+    coarse_angles = np.arange(-max_angle, max_angle + coarse_step / 2, coarse_step)
+    coarse_scores = np.array([profile_sharpness(a) for a in coarse_angles])
+    best_coarse = coarse_angles[int(np.argmax(coarse_scores))]
+    
+    fine_angles = np.arange(best_coarse - coarse_step, best_coarse + coarse_step + fine_step / 2, fine_step)
+    fine_scores = np.array([profile_sharpness(a) for a in fine_angles])
+    best_index = int(np.argmax(fine_scores))
+    best_angle = float(fine_angles[best_index])
+    
+    # How much the best profile stands out from a typical angle
+    best_score = fine_scores[best_index]
+    confidence = float((best_score - np.median(coarse_scores)) / best_score) if best_score > 0 else 0.0
+    
+    # Adding 0.0 turns a rounded -0.0 into 0.0
+    return round(best_angle, 3) + 0.0, round(max(0.0, confidence), 3)
+
+
+def align_staff_lines(
+    image: np.ndarray,
+    scale: float = 1.0,
+    min_angle: float = 0.5,
+    min_confidence: float = 0.1,
+    metadata: Optional[Dict] = None
+) -> np.ndarray:
+    """
+    Detect and correct rotation to align staff lines horizontally.
+    Rotation and any rescale are applied in a single affine warp.
+    
+    Args:
+        image: Grayscale image
+        scale: Resize factor fused into the same warp
+        min_angle: Smallest rotation worth correcting, in degrees
+        min_confidence: Skew estimates below this confidence are ignored
+        metadata: Optional dictionary receiving angle, confidence and the
+            applied 2x3 transform (original -> aligned coordinates)
+    """
+    angle, confidence = estimate_skew(image)
+    logger.info(f"Detected rotation angle: {angle:.2f} degrees (confidence {confidence:.2f})")
+    
+    rotate = abs(angle) > min_angle and confidence >= min_confidence
+    if not rotate and confidence < min_confidence:
+        logger.warning("Skew estimate not confident, skipping rotation")
+    
+    height, width = image.shape[:2]
+    
+    if not rotate:
+        angle = 0.0
+        if abs(scale - 1.0) < 1e-3:
+            if metadata is not None:
+                metadata.update({"angle": 0.0, "confidence": confidence, "scale": 1.0, "transform": None})
+            return image
+    
+    center = (width / 2, height / 2)
+    rotation_matrix = cv2.getRotationMatrix2D(center, angle, scale)
+    
+    # Calculate new dimensions to avoid cropping
+    cos = np.abs(rotation_matrix[0, 0])
+    sin = np.abs(rotation_matrix[0, 1])
+    new_width = int(round((height * sin) + (width * cos)))
+    new_height = int(round((height * cos) + (width * sin)))
+    
+    # Adjust rotation matrix for new dimensions
+    rotation_matrix[0, 2] += (new_width / 2) - center[0]
+    rotation_matrix[1, 2] += (new_height / 2) - center[1]
+    
+    if metadata is not None:
+        metadata.update({
+            "angle": angle,
+            "confidence": confidence,
+            "scale": scale,
+            "transform": np.round(rotation_matrix, 6).tolist()
+        })
+    
+    if not rotate:
+        # Pure rescale: a resize is cheaper than a general warp
+        return cv2.resize(
             image,
-            rotation_matrix,
             (new_width, new_height),
-            flags=cv2.INTER_CUBIC,
-            borderMode=cv2.BORDER_REPLICATE
+            interpolation=cv2.INTER_CUBIC if scale > 1 else cv2.INTER_AREA
         )
+    
+    rotated = cv2.warpAffine(
+        image,
+        rotation_matrix,
+        (new_width, new_height),
+        flags=cv2.INTER_CUBIC if scale > 1 else cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_REPLICATE
+    )
+    
+    logger.info("Image rotation applied")
+    return rotated
+
+
+def find_staff_line_rows(line_mask: np.ndarray, min_fraction: float = 0.3) -> List[Tuple[int, int]]:
+    """
+    Find rows covered by staff lines using a horizontal projection profile.
+    
+    Args:
+        line_mask: Binary mask (1 = horizontal line pixel)
+        min_fraction: Minimum row coverage relative to the strongest row
+    
+    Returns:
+        List of (first_row, last_row) spans, one per detected line
+    """
+    projection = line_mask.sum(axis=1)
+    if projection.max() == 0:
+        return []
+    
+    is_line = projection >= projection.max() * min_fraction
+    
+    # Merge consecutive line rows into (start, end) spans
+    edges = np.diff(np.concatenate(([0], is_line.astype(np.int8), [0])))
+    starts = np.where(edges == 1)[0]
+    ends = np.where(edges == -1)[0] - 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def group_staves(centers: List[float], min_lines: int = 4, tolerance: float = 0.35) -> List[List[float]]:
+    """
+    Group staff line centers into staves of evenly spaced lines.
+    
+    Lines belong to the same staff while the gap to the next line stays
+    within tolerance of the staff's first gap.
+    """
+    staves = []
+    current = []
+    spacing = None
+    
+    for center in centers:
+        if not current:
+            current = [center]
+            continue
         
-        logger.info("Image rotation applied")
-        return rotated
+        gap = center - current[-1]
+        if spacing is None and len(current) == 1:
+            spacing = gap
+            current.append(center)
+        elif spacing and abs(gap - spacing) <= tolerance * spacing:
+            current.append(center)
+        else:
+            if len(current) >= min_lines:
+                staves.append(current)
+            current = [center]
+            spacing = None
     
-    return image
+    if len(current) >= min_lines:
+        staves.append(current)
+    
+    return staves
+
+
+def heaviest_run(profile: np.ndarray, max_gap: int = 0) -> Tuple[int, int]:
+    """
+    Find the run of nonzero profile entries with the largest total.
+    Gaps of up to max_gap zero entries do not end a run.
+    
+    Returns:
+        (first_index, last_index) of the run
+    """
+    nonzero = np.nonzero(profile)[0]
+    if len(nonzero) == 0:
+        return 0, len(profile) - 1
+    
+    # Split wherever consecutive nonzero entries are too far apart
+    breaks = np.where(np.diff(nonzero) > max_gap + 1)[0]
+    runs = np.split(nonzero, breaks + 1)
+    best = max(runs, key=lambda run: profile[run[0]:run[-1] + 1].sum())
+    return int(best[0]), int(best[-1])
+
+
+def detect_staves(image: np.ndarray) -> Tuple[List[List[float]], np.ndarray]:
+    """
+    Detect staves in a (preferably downsampled) grayscale image.
+    
+    Local thresholding and a long horizontal opening keep only line-like
+    strokes; a horizontal projection profile then finds the staff lines.
+    
+    Returns:
+        Tuple of (staves as lists of line center rows, horizontal line mask)
+    """
+    # Local threshold marks ink without flagging large dark areas (desk, shadows)
+    ink = cv2.adaptiveThreshold(
+        image, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 10
+    )
+    # Thicken slightly so wavy hand-drawn lines survive the horizontal opening
+    ink = cv2.dilate(ink, np.ones((3, 1), np.uint8))
+    kernel_length = max(15, image.shape[1] // 25)
+    line_mask = cv2.morphologyEx(
+        ink, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_length, 1))
+    )
+    
+    spans = find_staff_line_rows(line_mask)
+    centers = [(start + end) / 2 for start, end in spans]
+    return group_staves(centers), line_mask
+
+
+def build_staff_model(
+    image: np.ndarray,
+    max_dimension: int = 1000,
+    sample_columns: int = 64
+) -> Optional[Dict]:
+    """
+    Measure the staff geometry of a deskewed grayscale image once, for all
+    later stages.
+    
+    Staves and their horizontal extent are found on a downsampled copy with
+    detect_staves(); line thickness and interline are then measured at full
+    resolution from vertical run lengths in a sample of columns through the
+    staves (the most common black run is the line thickness, the most common
+    distance between consecutive black runs the interline).
+    
+    Returns:
+        Dictionary with interline, line_thickness, staves (line rows and
+        left/right extent), systems (lists of staff indices) and the stage
+        parameters derived from them, or None if no staves were found
+    """
+    height, width = image.shape[:2]
+    scale = min(1.0, max_dimension / max(height, width))
+    small = image
+    if scale < 1.0:
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    
+    staves, line_mask = detect_staves(small)
+    if not staves:
+        logger.warning("No staff lines detected, staff model unavailable")
+        return None
+    
+    small_interline = float(np.median([np.median(np.diff(staff)) for staff in staves]))
+    model_staves = []
+    for staff in staves:
+        # Horizontal extent: heaviest run of columns with staff line pixels
+        # (skips streaks from replicated borders of rotated images)
+        column_mass = line_mask[int(staff[0]):int(staff[-1]) + 1].sum(axis=0)
+        first, last = heaviest_run(column_mass, max_gap=int(2 * small_interline))
+        model_staves.append({
+            "lines": [round(y / scale, 1) for y in staff],
+            "left": int(first / scale),
+            "right": min(width, int(np.ceil(last / scale)) + 1),
+        })
+    
+    thickness, interline = measure_staff_runs(image, model_staves, small_interline / scale, sample_columns)
+    
+    model = {
+        "interline": interline,
+        "line_thickness": thickness,
+        "staves": model_staves,
+        "systems": group_systems(model_staves),
+    }
+    model["parameters"] = staff_stage_parameters(model)
+    logger.info(f"Staff model: {len(model_staves)} staves, interline {interline}, "
+                f"line thickness {thickness}")
+    return model
+
+
+def measure_staff_runs(
+    image: np.ndarray,
+    staves: List[Dict],
+    rough_interline: float,
+    sample_columns: int = 64
+) -> Tuple[int, float]:
+    """
+    Line thickness and interline from vertical run lengths.
+    
+    Args:
+        image: Full-resolution grayscale image
+        staves: Staves with line rows and horizontal extent
+        rough_interline: Interline estimate used to bound the search
+        sample_columns: Columns sampled per staff
+    
+    Returns:
+        (line thickness in pixels, interline in pixels)
+    """
+    height = image.shape[0]
+    margin = int(np.ceil(rough_interline))
+    thicknesses = []
+    distances = []
+    
+    for staff in staves:
+        top = max(0, int(staff["lines"][0]) - margin)
+        bottom = min(height, int(staff["lines"][-1]) + margin + 1)
+        columns = np.linspace(staff["left"], staff["right"] - 1, sample_columns).astype(int)
+        strip = np.ascontiguousarray(image[top:bottom, columns].T)
+        
+        # Lighting is close to uniform across a single staff, so Otsu suffices
+        _, ink = cv2.threshold(strip, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+        padded = np.zeros((ink.shape[0], ink.shape[1] + 2), dtype=np.int8)
+        padded[:, 1:-1] = ink
+        edges = np.diff(padded, axis=1)
+        rows, starts = np.nonzero(edges == 1)
+        _, ends = np.nonzero(edges == -1)
+        
+        thicknesses.append(ends - starts)
+        same_column = rows[1:] == rows[:-1]
+        distances.append(np.diff(starts)[same_column])
+    
+    thickness = _run_mode(np.concatenate(thicknesses), 1, max(2, int(rough_interline / 2)))
+    interline = _run_mode(np.concatenate(distances), int(rough_interline * 0.6), int(rough_interline * 1.4) + 1)
+    
+    thickness = int(round(thickness)) if thickness else 1
+    interline = round(interline, 2) if interline else round(rough_interline, 2)
+    return max(1, thickness), interline
+
+
+def _run_mode(values: np.ndarray, low: int, high: int) -> Optional[float]:
+    """Most common value in [low, high], refined by its two neighbours."""
+    values = values[(values >= low) & (values <= high)]
+    if len(values) == 0:
+        return None
+    counts = np.bincount(values)
+    mode = int(np.argmax(counts))
+    window = np.arange(max(0, mode - 1), min(len(counts), mode + 2))
+    return float(np.dot(window, counts[window]) / counts[window].sum())
+
+
+def group_systems(staves: List[Dict], min_ratio: float = 1.5) -> List[List[int]]:
+    """
+    Group staves into systems by the vertical gaps between them.
+    
+    Gaps inside a system (e.g. the two staves of a piano part) are clearly
+    shorter than gaps between systems; if the gaps do not split into short
+    and long ones, every staff is its own system.
+    """
+    if len(staves) < 3:
+        return [[index] for index in range(len(staves))]
+    
+    gaps = [staves[i + 1]["lines"][0] - staves[i]["lines"][-1] for i in range(len(staves) - 1)]
+    if max(gaps) < min_ratio * min(gaps):
+        return [[index] for index in range(len(staves))]
+    
+    threshold = (max(gaps) + min(gaps)) / 2
+    systems = [[0]]
+    for index, gap in enumerate(gaps, start=1):
+        if gap < threshold:
+            systems[-1].append(index)
+        else:
+            systems.append([index])
+    return systems
+
+
+def staff_stage_parameters(model: Dict) -> Dict:
+    """
+    Size-dependent parameters of the later stages, in proportion to the
+    staff geometry (the fixed defaults assume an interline of about 20px).
+    """
+    interline = model["interline"]
+    return {
+        # About two staff spaces: a note head plus surrounding paper
+        "binarization_window": max(15, min(151, int(round(2 * interline)) | 1)),
+        # Staff line segments are much longer than note heads (about one
+        # interline wide); breaks up to an interline get bridged
+        "line_kernel": max(15, int(round(2 * interline))),
+        "line_gap": max(5, int(round(interline))),
+        # Noise: specks well below an augmentation dot
+        "noise_min_size": max(3, min(100, int(round((interline / 4) ** 2)))),
+    }
+
+
+def shift_staff_model(model: Dict, dx: int, dy: int) -> Dict:
+    """Translate a staff model into the coordinates of a cropped image."""
+    shifted = dict(model)
+    shifted["staves"] = [
+        {
+            "lines": [round(y - dy, 1) for y in staff["lines"]],
+            "left": staff["left"] - dx,
+            "right": staff["right"] - dx,
+        }
+        for staff in model["staves"]
+    ]
+    return shifted
+
+
+def detect_score_region(
+    image: np.ndarray,
+    staff_model: Optional[Dict] = None,
+    padding_interlines: float = 4.0,
+    min_reduction: float = 0.05
+) -> Optional[Dict]:
+    """
+    Locate the staff systems in a grayscale image.
+    
+    Args:
+        image: Grayscale image
+        staff_model: Staff model of the image (built when omitted)
+        padding_interlines: Padding around the staves, in staff spaces
+            (room for ledger lines, stems, lyrics)
+        min_reduction: Minimum fraction of pixels a crop must remove to be used
+    
+    Returns:
+        Crop box in the input image's coordinates (x, y, width, height),
+        the source size and the number of staves, or None if no staves were
+        found or cropping would not remove enough
+    """
+    height, width = image.shape[:2]
+    if staff_model is None:
+        staff_model = build_staff_model(image)
+    
+    if not staff_model:
+        logger.warning("No staff systems detected, skipping crop")
+        return None
+    
+    staves = staff_model["staves"]
+    padding = padding_interlines * staff_model["interline"]
+    
+    x0 = max(0, int(min(staff["left"] for staff in staves) - padding))
+    y0 = max(0, int(min(staff["lines"][0] for staff in staves) - padding))
+    x1 = min(width, int(np.ceil(max(staff["right"] for staff in staves) + padding)) + 1)
+    y1 = min(height, int(np.ceil(max(staff["lines"][-1] for staff in staves) + padding)) + 1)
+    
+    reduction = 1 - ((x1 - x0) * (y1 - y0)) / (width * height)
+    if reduction < min_reduction:
+        logger.info(f"Score fills the image ({reduction:.0%} removable), skipping crop")
+        return None
+    
+    region = {
+        "x": x0,
+        "y": y0,
+        "width": x1 - x0,
+        "height": y1 - y0,
+        "source_width": width,
+        "source_height": height,
+        "staves": len(staves),
+        "removed_fraction": round(reduction, 3)
+    }
+    logger.info(f"Detected score region: {region}")
+    return region
+
 
+def crop_to_region(image: np.ndarray, region: Dict) -> np.ndarray:
+    """Crop an image to a region returned by detect_score_region."""
+    x, y = region["x"], region["y"]
+    return image[y:y + region["height"], x:x + region["width"]]
 
-def smooth_handwritten_notation(image: np.ndarray, strength: int = 2) -> np.ndarray:
+
+def smooth_handwritten_notation(image: np.ndarray, strength: int = 2,
+                                engine: str = "bilateral") -> np.ndarray:
     """
     Smooth hand-drawn lines while preserving musical notation structure.
     
     Args:
         image: Input grayscale image
         strength: Smoothing strength (1-5)
+        engine: Edge-preserving filter, one of SMOOTHING_ENGINES
     
     Returns:
         Smoothed image
     """
+    if engine not in SMOOTHING_ENGINES:
+        raise ValueError(f"Unknown smoothing engine: {engine}")
+    
     # Clamp strength to valid range
     strength = max(1, min(5, strength))
     
     # Calculate kernel size based on strength
     kernel_size = 2 * strength + 1
+    sigma = 75 + (strength * 10)
     
-    # Apply bilateral filter to smooth while preserving edges
+    if engine == "auto":
+        engine = "guided" if strength >= GUIDED_MIN_STRENGTH else "bilateral"
+    
+    # Apply an edge-preserving filter to smooth while keeping strokes sharp
     # This is crucial for handwritten notation
-    smoothed = cv2.bilateralFilter(
-        image,
-        d=kernel_size,
-        sigmaColor=75 + (strength * 10),
-        sigmaSpace=75 + (strength * 10)
-    )
+    if engine == "guided":
+        smoothed = guided_filter(
+            image,
+            radius=strength,
+            eps=(sigma / 255) ** 2 * GUIDED_EPS_FACTOR,
+            subsample=2 if strength >= 2 else 1
+        )
+    else:
+        smoothed = cv2.bilateralFilter(
+            image,
+            d=kernel_size,
+            sigmaColor=sigma,
+            sigmaSpace=sigma
+        )
     
     # Apply morphological operations to clean up lines
     kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2, 2))
@@ -205,20 +899,78 @@ def smooth_handwritten_notation(image: np.ndarray, strength: int = 2) -> np.ndar
     return smoothed
 
 
-def binarize_image(image: np.ndarray) -> np.ndarray:
+def guided_filter(image: np.ndarray, radius: int, eps: float, subsample: int = 1) -> np.ndarray:
+    """
+    Self-guided edge-preserving filter (He et al.) built from box filters.
+    Runs in constant time per pixel whatever the radius; with subsample > 1
+    the linear coefficients are computed on a reduced copy and upsampled
+    (the "fast guided filter"), while the output keeps full-resolution edges.
+    
+    Args:
+        image: Grayscale uint8 image (also used as the guide)
+        radius: Window radius in full-resolution pixels
+        eps: Regularization on the [0, 1] intensity scale; regions with a
+            variance well below eps are flattened, edges above it are kept
+        subsample: Reduction factor for computing the coefficients
+    """
+    height, width = image.shape[:2]
+    
+    small = image
+    if subsample > 1:
+        small = cv2.resize(image, (max(1, width // subsample), max(1, height // subsample)),
+                           interpolation=cv2.INTER_AREA)
+        radius = max(1, radius // subsample)
+    small = small.astype(np.float32) / 255.0
+    window = (2 * radius + 1, 2 * radius + 1)
+    
+    mean = cv2.boxFilter(small, -1, window)
+    variance = cv2.sqrBoxFilter(small, cv2.CV_32F, window) - mean * mean
+    
+    a = variance / (variance + eps)
+    b = mean - a * mean
+    a = cv2.boxFilter(a, -1, window)
+    b = cv2.boxFilter(b, -1, window) * 255.0
+    
+    if subsample > 1:
+        a = cv2.resize(a, (width, height), interpolation=cv2.INTER_LINEAR)
+        b = cv2.resize(b, (width, height), interpolation=cv2.INTER_LINEAR)
+    
+    # a * image + b, in place; a and b are non-negative so the saturating
+    # conversion only needs to clip at 255
+    a *= image
+    a += b
+    return cv2.convertScaleAbs(a)
+
+
+def binarize_image(image: np.ndarray, engine: str = "gaussian",
+                   window: Optional[int] = None) -> np.ndarray:
     """
     Convert to binary (black and white) using adaptive thresholding.
     This works better for handwritten notation with varying lighting.
+    
+    Args:
+        image: Grayscale image
+        engine: Thresholding method, one of BINARIZATION_ENGINES
+        window: Window size for sauvola/wolf (derived from the staff
+            spacing when omitted)
     """
-    # Apply adaptive thresholding
-    binary = cv2.adaptiveThreshold(
-        image,
-        255,
-        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-        cv2.THRESH_BINARY,
-        blockSize=15,
-        C=8
-    )
+    if engine not in BINARIZATION_ENGINES:
+        raise ValueError(f"Unknown binarization engine: {engine}")
+    
+    if engine == "gaussian":
+        # Apply adaptive thresholding
+        binary = cv2.adaptiveThreshold(
+            image,
+            255,
+            cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+            cv2.THRESH_BINARY,
+            blockSize=15,
+            C=8
+        )
+    else:
+        if window is None:
+            window = binarization_window(image)
+        binary = local_statistics_threshold(image, window, method=engine)
     
     # Invert if needed (OMR expects black notation on white background)
     # Check which color is more dominant
@@ -232,49 +984,132 @@ def binarize_image(image: np.ndarray) -> np.ndarray:
     return binary
 
 
-def enhance_staff_lines(image: np.ndarray) -> np.ndarray:
+def binarization_window(image: np.ndarray, min_window: int = 15,
+                        max_window: int = 151, default: int = 31) -> int:
     """
-    Enhance and strengthen staff lines for better recognition.
+    Pick a thresholding window of about two staff spaces, so a window holds
+    a note head and the paper around it whatever the photo's resolution.
     """
-    # Create kernel for horizontal line detection
-    horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (40, 1))
+    height, width = image.shape[:2]
+    scale = min(1.0, 1000 / max(height, width))
+    small = image
+    if scale < 1.0:
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
     
-    # Detect horizontal lines (staff lines)
-    detected_lines = cv2.morphologyEx(
-        image,
-        cv2.MORPH_OPEN,
-        horizontal_kernel,
-        iterations=2
-    )
+    staves, _ = detect_staves(small)
+    if not staves:
+        return default
+    
+    interline = float(np.median([np.median(np.diff(staff)) for staff in staves])) / scale
+    window = int(round(2 * interline)) | 1
+    return max(min_window, min(max_window, window))
+
+
+def local_statistics_threshold(image: np.ndarray, window: int, method: str = "sauvola") -> np.ndarray:
+    """
+    Sauvola or Wolf-Jolion thresholding.
+    
+    Local means and variances come from box filters, which OpenCV evaluates
+    with running sums (integral-image style), so the cost per pixel does not
+    depend on the window size.
+    
+    Returns:
+        Binary image with 255 for paper and 0 for ink
+    """
+    pixels = image.astype(np.float32)
+    size = (window, window)
+    mean = cv2.boxFilter(pixels, -1, size, borderType=cv2.BORDER_REFLECT)
+    variance = cv2.sqrBoxFilter(pixels, cv2.CV_32F, size, borderType=cv2.BORDER_REFLECT) - mean * mean
+    std = np.sqrt(np.maximum(variance, 0, out=variance), out=variance)
+    
+    if method == "wolf":
+        # Normalized by the image's darkest value and largest local contrast
+        darkest = float(pixels.min())
+        max_std = max(float(std.max()), 1e-6)
+        threshold = mean - WOLF_K * (1 - std / max_std) * (mean - darkest)
+    else:
+        threshold = mean * (1 + SAUVOLA_K * (std / SAUVOLA_R - 1))
+    
+    return cv2.compare(pixels, threshold, cv2.CMP_GT)
+
+
+def enhance_staff_lines(image: PackedBinaryImage, line_length: int = 40, max_gap: int = 40,
+                        band_rows: int = 256) -> PackedBinaryImage:
+    """
+    Enhance and strengthen staff lines for better recognition.
+    Bridges short breaks in long horizontal ink runs, working on the runs of
+    one band of rows at a time so the page is never unpacked whole.
     
-    # Strengthen detected staff lines
-    # Use a weighted addition to enhance staff lines
-    enhanced = cv2.addWeighted(image, 0.7, detected_lines, 0.3, 0)
+    Args:
+        image: Packed binary image
+        line_length: Minimum length of a horizontal run treated as a line
+        max_gap: Gaps shorter than this between two line runs are bridged
+        band_rows: Rows unpacked at a time
+    """
+    bridge_rows, bridge_starts, bridge_lengths = [], [], []
+    for top in range(0, image.height, band_rows):
+        rows, starts, lengths = image.horizontal_runs(slice(top, top + band_rows))
+        # Line runs, and the gap from each to the next one in the same row
+        line = lengths >= line_length
+        rows, starts, ends = rows[line], starts[line], starts[line] + lengths[line]
+        gaps = starts[1:] - ends[:-1]
+        bridge = (rows[1:] == rows[:-1]) & (gaps < max_gap)
+        bridge_rows.append(rows[1:][bridge] + top)
+        bridge_starts.append(ends[:-1][bridge])
+        bridge_lengths.append(gaps[bridge])
     
-    return enhanced
+    if not any(len(rows) for rows in bridge_rows):
+        return image
+    return image.with_ink_runs(np.concatenate(bridge_rows), np.concatenate(bridge_starts),
+                               np.concatenate(bridge_lengths))
 
 
-def remove_small_noise(image: np.ndarray, min_size: int = 5) -> np.ndarray:
+def remove_small_noise(image: PackedBinaryImage, min_size: int = 5) -> PackedBinaryImage:
     """
     Remove small isolated noise pixels that might interfere with OMR.
+    
+    Components are labelled in overlapping horizontal bands narrow enough for
+    16-bit labels, instead of one 32-bit label image the size of the page;
+    only the current band is unpacked. A component smaller than min_size
+    fits inside the band overlap, so it is always seen whole by some band;
+    components cut by a band edge are left for the neighbouring band.
     """
-    # Find connected components
-    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(
-        cv2.bitwise_not(image),
-        connectivity=8
-    )
+    height, width = image.shape
+    cleaned = image.bits.copy()
     
-    # Create output image
-    cleaned = image.copy()
+    # At most one 8-connected component per 2x2 block, so this band height
+    # can never produce more than 65535 labels
+    overlap = min_size + 2
+    band_height = max(2 * overlap, 2 * (65535 // ((width + 1) // 2)) - 1)
+    step = band_height - overlap
     
-    # Remove small components (noise)
-    for i in range(1, num_labels):  # Skip background (label 0)
-        area = stats[i, cv2.CC_STAT_AREA]
-        if area < min_size:
-            # Remove this component
-            cleaned[labels == i] = 255
+    for top in range(0, height, step):
+        bottom = min(top + band_height, height)
+        ink = cv2.bitwise_not(image.to_array(slice(top, bottom)))
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(
+            ink, connectivity=8, ltype=cv2.CV_16U
+        )
+        
+        # Small components that do not touch a band edge cut through the page
+        band_top = stats[:, cv2.CC_STAT_TOP]
+        band_bottom = band_top + stats[:, cv2.CC_STAT_HEIGHT]
+        small = stats[:, cv2.CC_STAT_AREA] < min_size
+        if top > 0:
+            small &= band_top > 0
+        if bottom < height:
+            small &= band_bottom < bottom - top
+        small[0] = False  # background
+        
+        if small.any():
+            # Earlier bands may already have cleaned the overlap rows
+            band = np.unpackbits(cleaned[top:bottom], axis=1, count=width)
+            band[small[labels]] = 1
+            cleaned[top:bottom] = np.packbits(band, axis=1)
+        
+        if bottom == height:
+            break
     
-    return cleaned
+    return PackedBinaryImage(cleaned, width)
 
 
 def estimate_staff_line_spacing(image: np.ndarray) -> Optional[int]:
@@ -282,22 +1117,12 @@ def estimate_staff_line_spacing(image: np.ndarray) -> Optional[int]:
     Estimate the spacing between staff lines.
     Useful for scaling and normalization.
     """
-    # Use horizontal projection to find staff lines
-    horizontal_projection = np.sum(image == 0, axis=1)
-    
-    # Find peaks (staff lines)
-    from scipy.signal import find_peaks
-    peaks, _ = find_peaks(horizontal_projection, distance=5, prominence=50)
-    
-    if len(peaks) < 2:
+    model = build_staff_model(image)
+    if model is None:
         return None
     
-    # Calculate average spacing
-    spacings = np.diff(peaks)
-    avg_spacing = np.median(spacings)
-    
-    logger.info(f"Estimated staff line spacing: {avg_spacing:.1f} pixels")
-    return int(avg_spacing)
+    logger.info(f"Estimated staff line spacing: {model['interline']:.1f} pixels")
+    return int(round(model["interline"]))
 
 
 def scale_to_standard_size(image: np.ndarray, target_spacing: int = 20) -> np.ndarray:
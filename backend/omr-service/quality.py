@@ -0,0 +1,138 @@
+"""
+Pre-flight image quality checks.
+Runs a cheap analysis on a downsampled copy of an upload so blurry, blank
+or non-music images are rejected before preprocessing and Audiveris.
+"""
+
+import cv2
+import numpy as np
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+from preprocessor import decode_grayscale, detect_staves
+
+logger = logging.getLogger(__name__)
+
+# Thresholds (all measured on the downsampled analysis copy)
+QUALITY_MIN_SHARPNESS = float(os.getenv("QUALITY_MIN_SHARPNESS", "20"))
+QUALITY_MIN_CONTRAST = float(os.getenv("QUALITY_MIN_CONTRAST", "50"))
+QUALITY_MIN_STAVES = int(os.getenv("QUALITY_MIN_STAVES", "1"))
+# Longest side of the analysis copy
+QUALITY_ANALYSIS_SIZE = int(os.getenv("QUALITY_ANALYSIS_SIZE", "800"))
+# Vertical strips searched for staves, so moderately skewed photos still pass
+QUALITY_STAFF_STRIPS = 6
+
+
+class ImageQualityError(ValueError):
+    """Image failed the pre-flight quality gate."""
+
+    def __init__(self, reason: str, message: str, report: Dict):
+        super().__init__(message)
+        self.reason = reason
+        self.report = report
+
+
+def load_analysis_image(image_path: str, max_dimension: int = QUALITY_ANALYSIS_SIZE) -> np.ndarray:
+    """
+    Load a small, upright grayscale copy of an image.
+    Uses the decoder's reduced-size modes (DCT scaling for JPEG) so large
+    photos are never decoded at full resolution.
+    """
+    image = decode_grayscale(image_path, max_dimension=max_dimension)
+
+    scale = max_dimension / max(image.shape[:2])
+    if scale < 1.0:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return image
+
+
+def count_staves(image: np.ndarray, strips: int = QUALITY_STAFF_STRIPS) -> Dict:
+    """
+    Count staves using projection peaks in vertical strips.
+    Narrow strips keep staff lines within a few rows even when the photo is skewed.
+    """
+    width = image.shape[1]
+    best = {"staves": 0, "staff_lines": 0}
+
+    for i in range(strips):
+        strip = image[:, i * width // strips:(i + 1) * width // strips]
+        staves, _ = detect_staves(strip)
+        lines = sum(len(staff) for staff in staves)
+        if (len(staves), lines) > (best["staves"], best["staff_lines"]):
+            best = {"staves": len(staves), "staff_lines": lines}
+
+    return best
+
+
+def assess_image_quality(image: np.ndarray) -> Dict:
+    """
+    Score an analysis image.
+
+    Returns:
+        Dictionary with sharpness (variance of the Laplacian), contrast
+        (1st-99th percentile intensity range) and detected staves/lines
+    """
+    sharpness = float(cv2.Laplacian(image, cv2.CV_64F).var())
+    low, high = np.percentile(image, [1, 99])
+
+    scores = {
+        "sharpness": round(sharpness, 1),
+        "contrast": round(float(high - low), 1),
+    }
+    scores.update(count_staves(image))
+    return scores
+
+
+def check_image_quality(image_path: str, thresholds: Optional[Dict] = None) -> Dict:
+    """
+    Run the pre-flight quality gate on an image file.
+
+    Args:
+        image_path: Path to the uploaded image
+        thresholds: Optional overrides for min_sharpness, min_contrast, min_staves
+
+    Returns:
+        Quality report with scores, thresholds and analysis time
+
+    Raises:
+        ImageQualityError: If the image fails any check
+    """
+    limits = {
+        "min_sharpness": QUALITY_MIN_SHARPNESS,
+        "min_contrast": QUALITY_MIN_CONTRAST,
+        "min_staves": QUALITY_MIN_STAVES,
+    }
+    if thresholds:
+        limits.update(thresholds)
+
+    started = time.perf_counter()
+    image = load_analysis_image(image_path)
+    scores = assess_image_quality(image)
+
+    report = {
+        "passed": True,
+        "scores": scores,
+        "thresholds": limits,
+        "analysis_size": [image.shape[1], image.shape[0]],
+        "elapsed": round(time.perf_counter() - started, 4)
+    }
+    logger.info(f"Image quality: {scores} ({report['elapsed']}s)")
+
+    # Ordered from cheapest explanation to most specific
+    failures = [
+        ("low_contrast", scores["contrast"] < limits["min_contrast"],
+         "Image has too little contrast (blank page or very poor lighting)"),
+        ("blurry", scores["sharpness"] < limits["min_sharpness"],
+         "Image is too blurry to recognize notation"),
+        ("no_staff_lines", scores["staves"] < limits["min_staves"],
+         "No staff lines detected; make sure the photo shows music notation"),
+    ]
+    for reason, failed, message in failures:
+        if failed:
+            report["passed"] = False
+            report["reason"] = reason
+            raise ImageQualityError(reason, message, report)
+
+    return report
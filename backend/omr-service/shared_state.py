@@ -0,0 +1,279 @@
+"""
+Shared state for multi-worker deployments.
+When the service runs as several uvicorn worker processes (OMR_WORKERS > 1),
+jobs, in-flight coalescing and the Audiveris pool coordinate through a
+SQLite database in WAL mode and lock files under OMR_STATE_DIR, so any
+worker can answer for a job another worker is running.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Number of uvicorn worker processes; shared state is used when above one
+OMR_WORKERS = int(os.getenv("OMR_WORKERS", "1"))
+OMR_STATE_DIR = os.getenv("OMR_STATE_DIR", "state")
+SHARED_STATE = OMR_WORKERS > 1
+
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+
+
+def pid_alive(pid: int) -> bool:
+    """Whether a process with this id exists (on this machine)."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def process_identity(pid: int) -> Optional[str]:
+    """
+    Boot id, pid and start time of a process, or None if it does not exist.
+
+    PIDs are reused (from low numbers again after a container restart),
+    but not with the same start time within one boot. Without /proc (not
+    Linux) the identity is the pid alone.
+    """
+    try:
+        stat = Path(f"/proc/{pid}/stat").read_text()
+    except (FileNotFoundError, ProcessLookupError):
+        if Path("/proc/self/stat").exists():
+            return None
+        return str(pid) if pid_alive(pid) else None
+    try:
+        boot_id = Path("/proc/sys/kernel/random/boot_id").read_text().strip()
+    except OSError:
+        boot_id = ""
+    # The command name may contain spaces; the start time is field 22
+    start_time = stat[stat.rindex(")") + 2:].split()[19]
+    return f"{boot_id}:{pid}:{start_time}"
+
+
+def owner_alive(pid: int, identity: Optional[str]) -> bool:
+    """Whether the process that owns a job is still the one running as pid."""
+    if identity is None:
+        # Rows written before identities were stored
+        return pid_alive(pid)
+    return process_identity(pid) == identity
+
+
+class FileLockSemaphore:
+    """
+    Counting semaphore shared by processes: one lock file per slot, held
+    with flock while in use. The kernel drops the locks of a process that
+    dies, so crashed workers never leak slots. Acquire and release must
+    happen on the same thread (like the pool usage around one Audiveris run).
+    """
+
+    def __init__(self, directory: str, size: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.size = max(1, size)
+        self._held = threading.local()
+
+    def acquire(self, timeout: Optional[float] = None, poll_interval: float = 0.05) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # Start at a per-process offset so workers do not all contend for slot 0
+        offset = os.getpid() % self.size
+        while True:
+            for i in range(self.size):
+                path = self.directory / f"slot-{(offset + i) % self.size}.lock"
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    continue
+                self._held.fds = getattr(self._held, "fds", []) + [fd]
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(poll_interval)
+
+    def release(self):
+        fds = getattr(self._held, "fds", [])
+        if not fds:
+            raise ValueError("Semaphore released too many times")
+        fd = fds.pop()
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class JobStore:
+    """
+    SQLite table of job snapshots shared by all workers.
+
+    Each job row holds its serialized state (written through by the owning
+    worker on every change), plus the columns other workers update: the
+    number of waiting clients and the cancellation request. The owner polls
+    for cancellation requests of its running jobs.
+    """
+
+    def __init__(self, path: str, max_jobs: int = 1000):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_jobs = max_jobs
+        self._local = threading.local()
+        self._identity = {}
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    key TEXT,
+                    status TEXT NOT NULL,
+                    owner INTEGER NOT NULL,
+                    owner_identity TEXT,
+                    waiters INTEGER NOT NULL DEFAULT 1,
+                    cancel_reason TEXT,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            columns = {row[1] for row in db.execute("PRAGMA table_info(jobs)")}
+            if "owner_identity" not in columns:
+                try:
+                    db.execute("ALTER TABLE jobs ADD COLUMN owner_identity TEXT")
+                except sqlite3.OperationalError:
+                    pass  # added by another worker starting at the same time
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, status)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread; autocommit, with explicit transactions where needed
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA busy_timeout=30000")
+            self._local.db = db
+        return db
+
+    def _own_identity(self) -> Optional[str]:
+        # Looked up per pid, as the store may be created before workers fork
+        pid = os.getpid()
+        if pid not in self._identity:
+            self._identity[pid] = process_identity(pid)
+        return self._identity[pid]
+
+    def insert(self, job_id: str, snapshot: Dict):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO jobs (id, status, owner, owner_identity, waiters, data, updated_at) "
+            "VALUES (?, ?, ?, ?, 1, ?, ?)",
+            (job_id, snapshot["status"], os.getpid(), self._own_identity(),
+             json.dumps(snapshot), time.time())
+        )
+
+    def save(self, job_id: str, snapshot: Dict):
+        self._connect().execute(
+            "UPDATE jobs SET status = ?, data = ?, updated_at = ? WHERE id = ?",
+            (snapshot["status"], json.dumps(snapshot), time.time(), job_id)
+        )
+
+    def load(self, job_id: str) -> Optional[Dict]:
+        """
+        Snapshot of a job with its shared columns (owner, waiters, key,
+        cancel_reason). A job whose owner process is gone (or whose pid now
+        belongs to another process) is marked failed.
+        """
+        row = self._connect().execute(
+            "SELECT data, owner, waiters, key, cancel_reason, owner_identity FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        snapshot = json.loads(row[0])
+        snapshot.update(owner=row[1], waiters=row[2], key=row[3], cancel_reason=row[4])
+
+        if snapshot["status"] not in FINISHED_STATUSES and not owner_alive(row[1], row[5]):
+            snapshot.update(status="failed", error="Worker process exited")
+            self.save(job_id, {k: v for k, v in snapshot.items()
+                               if k not in ("owner", "waiters", "key", "cancel_reason")})
+            self.release_key(job_id)
+        return snapshot
+
+    def set_key(self, job_id: str, key: str):
+        self._connect().execute("UPDATE jobs SET key = ? WHERE id = ?", (key, job_id))
+
+    def release_key(self, job_id: str):
+        self._connect().execute("UPDATE jobs SET key = NULL WHERE id = ?", (job_id,))
+
+    def join(self, key: str) -> Optional[str]:
+        """Add a waiter to the running job for key; returns its id."""
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute(
+                "SELECT id, owner, owner_identity FROM jobs WHERE key = ? AND cancel_reason IS NULL "
+                f"AND status NOT IN {FINISHED_STATUSES} ORDER BY updated_at DESC",
+                (key,)
+            ).fetchall()
+            for job_id, owner, identity in rows:
+                if owner_alive(owner, identity):
+                    db.execute("UPDATE jobs SET waiters = waiters + 1 WHERE id = ?", (job_id,))
+                    db.execute("COMMIT")
+                    return job_id
+            db.execute("COMMIT")
+            return None
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def detach(self, job_id: str, reason: str) -> bool:
+        """
+        Remove a waiter; with none left the job is flagged for cancellation.
+
+        Returns:
+            True if the job is (now) flagged for cancellation
+        """
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT waiters, status, cancel_reason FROM jobs WHERE id = ?",
+                             (job_id,)).fetchone()
+            if row is None or row[1] in FINISHED_STATUSES:
+                db.execute("COMMIT")
+                return False
+            waiters = max(0, row[0] - 1)
+            reason = row[2] or (reason if waiters == 0 else None)
+            db.execute("UPDATE jobs SET waiters = ?, cancel_reason = ? WHERE id = ?",
+                       (waiters, reason, job_id))
+            db.execute("COMMIT")
+            return reason is not None
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def cancel_requests(self, job_ids: List[str]) -> Dict[str, str]:
+        """Cancellation reasons of those jobs that have been flagged."""
+        if not job_ids:
+            return {}
+        marks = ",".join("?" * len(job_ids))
+        rows = self._connect().execute(
+            f"SELECT id, cancel_reason FROM jobs WHERE id IN ({marks}) AND cancel_reason IS NOT NULL",
+            job_ids
+        ).fetchall()
+        return dict(rows)
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    def prune(self):
+        """Drop the oldest finished jobs beyond max_jobs."""
+        self._connect().execute(
+            f"DELETE FROM jobs WHERE status IN {FINISHED_STATUSES} AND id NOT IN "
+            "(SELECT id FROM jobs ORDER BY updated_at DESC LIMIT ?)",
+            (self.max_jobs,)
+        )
@@ -0,0 +1,625 @@
+"""
+In-process recognizer for simple single-staff melodies.
+Finds note heads, stems, flags and bar lines on a deskewed grayscale image
+with a known staff model and writes MusicXML, without starting Audiveris.
+Anything it cannot explain lowers its confidence so callers can fall back;
+clefs other than treble, key signatures and accidentals, which would change
+the pitches it reads, make it decline the image outright. So do rests and
+augmentation dots, which it does not read: unexplained glyphs inside the
+staff, measures without notes and a short final measure decline the image
+instead of yielding a score with beats missing.
+"""
+
+import cv2
+import numpy as np
+import logging
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional, Tuple
+
+from preprocessor import local_statistics_threshold
+
+logger = logging.getLogger(__name__)
+
+# Diatonic steps upwards from the bottom line of a treble staff (E4)
+TREBLE_STEPS = ["E", "F", "G", "A", "B", "C", "D"]
+
+# Durations in quarter notes
+NOTE_TYPES = {"whole": 4.0, "half": 2.0, "quarter": 1.0, "eighth": 0.5}
+# MusicXML divisions per quarter note (enough for eighths)
+DIVISIONS = 2
+
+# Head size limits, in interlines
+HEAD_WIDTH = (0.9, 2.2)
+HEAD_HEIGHT = (0.6, 1.5)
+# Ink fraction of a head blob above which the head counts as filled
+FILLED_RATIO = 0.75
+
+
+class NotSimpleScore(ValueError):
+    """Image is outside what the simple recognizer handles."""
+
+
+def recognize_simple_score(image: np.ndarray, staff_model: Optional[Dict], title: str = "") -> Dict:
+    """
+    Recognize a single-staff melody.
+
+    Args:
+        image: Deskewed grayscale image (before binarization)
+        staff_model: Staff model of the image (see build_staff_model)
+        title: Work title written to the MusicXML
+
+    Returns:
+        Dictionary with the MusicXML document, confidence (0-1), notes,
+        measures and time signature
+
+    Raises:
+        NotSimpleScore: If the image does not show exactly one five-line
+            staff with a treble clef, has a key signature or accidentals,
+            or shows rests or dots (unexplained glyphs in the staff, empty
+            or short measures)
+    """
+    if not staff_model:
+        raise NotSimpleScore("No staff detected")
+    if len(staff_model["staves"]) != 1:
+        raise NotSimpleScore(f"{len(staff_model['staves'])} staves found, expected one")
+    staff = staff_model["staves"][0]
+    if len(staff["lines"]) != 5:
+        raise NotSimpleScore(f"Staff has {len(staff['lines'])} lines, expected five")
+
+    interline = float(staff_model["interline"])
+    thickness = int(staff_model["line_thickness"])
+    window = staff_model["parameters"]["binarization_window"]
+
+    # Work on a band around the staff (room for ledger lines and stems)
+    lines = sorted(staff["lines"])
+    top = max(0, int(lines[0] - 5 * interline))
+    bottom = min(image.shape[0], int(lines[-1] + 5 * interline) + 1)
+    left = max(0, staff["left"] - int(interline))
+    right = min(image.shape[1], staff["right"] + int(interline))
+    band = image[top:bottom, left:right]
+    band_lines = [y - top for y in lines]
+
+    ink = (local_statistics_threshold(band, window, method="sauvola") == 0).astype(np.uint8)
+    symbols = remove_staff_lines(ink, band_lines, interline, thickness)
+    symbols = drop_specks(symbols, staff_model["parameters"]["noise_min_size"])
+
+    stems = find_vertical_strokes(symbols, interline)
+    clef_end = find_treble_clef(symbols, band_lines, interline)
+    # Time signature digits right after the clef are not note heads
+    heads = find_note_heads(symbols, interline, clef_end + int(2.5 * interline))
+    body_start = heads[0]["x"] if heads else symbols.shape[1]
+    header_end = check_header(symbols, band_lines, interline, clef_end, body_start)
+
+    notes, used_stems, explained = classify_notes(symbols, stems, heads, band_lines, interline, thickness)
+    barlines = find_barlines(stems, used_stems, band_lines, interline, header_end)
+    for barline in barlines:
+        explained[barline["mask"]] = 1
+    accidentals = count_accidentals(symbols, stems, explained, heads, used_stems, barlines, interline)
+    if accidentals:
+        raise NotSimpleScore(f"Accidentals next to note heads ({accidentals} marks)")
+    # Rests and augmentation dots are not read; a score without them would
+    # silently lose beats, so leave such images to Audiveris
+    glyphs = count_unexplained_glyphs(symbols, explained, band_lines, interline, header_end)
+    if glyphs:
+        raise NotSimpleScore(f"Unexplained symbols inside the staff ({glyphs}), such as rests or dots")
+
+    beats, measures, consistency = build_measures(notes, [b["x"] for b in barlines])
+
+    body = symbols.copy()
+    body[:, :header_end] = 0
+    ink_pixels = int(body.sum())
+    explained_pixels = int((body & explained).sum())
+    explained_fraction = explained_pixels / ink_pixels if ink_pixels else 0.0
+
+    confidence = explained_fraction * consistency
+    if not notes:
+        confidence = 0.0
+    if any(note["chord"] for note in notes):
+        confidence *= 0.5
+
+    logger.info(f"Simple recognizer: {len(notes)} notes, {len(barlines)} bar lines, "
+                f"explained {explained_fraction:.2f}, consistency {consistency:.2f}")
+
+    return {
+        "musicxml": build_musicxml(measures, beats, title),
+        "confidence": round(confidence, 3),
+        "explained_fraction": round(explained_fraction, 3),
+        "measure_consistency": round(consistency, 3),
+        "notes": len(notes),
+        "measures": len(measures),
+        "time_signature": f"{beats}/4",
+    }
+
+
+def remove_staff_lines(ink: np.ndarray, lines: List[float], interline: float, thickness: int) -> np.ndarray:
+    """
+    Erase staff lines (and ledger line positions) where nothing crosses them.
+
+    A column keeps its line pixels only if there is ink right above or below
+    the line, i.e. a symbol overlaps it.
+    """
+    symbols = ink.copy()
+    height = ink.shape[0]
+    half = thickness / 2 + 1
+    # Ledger lines sit on the same grid above and below the staff
+    positions = list(lines)
+    positions += [lines[0] - k * interline for k in (1, 2, 3)]
+    positions += [lines[-1] + k * interline for k in (1, 2, 3)]
+
+    for y in positions:
+        y0 = max(0, int(np.floor(y - half)))
+        y1 = min(height - 1, int(np.ceil(y + half)))
+        if y0 <= 0 or y1 >= height - 1:
+            continue
+        crossed = (ink[y0 - 1] > 0) | (ink[y1 + 1] > 0)
+        symbols[y0:y1 + 1, ~crossed] = 0
+    return symbols
+
+
+def drop_specks(mask: np.ndarray, min_size: int) -> np.ndarray:
+    """Remove connected components smaller than min_size pixels."""
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    small = stats[:, cv2.CC_STAT_AREA] < min_size
+    small[0] = False
+    cleaned = mask.copy()
+    cleaned[small[labels]] = 0
+    return cleaned
+
+
+def find_vertical_strokes(symbols: np.ndarray, interline: float) -> np.ndarray:
+    """Mask of vertical strokes at least two interlines long (stems, bar lines)."""
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(3, int(2 * interline))))
+    return cv2.morphologyEx(symbols, cv2.MORPH_OPEN, kernel)
+
+
+def find_treble_clef(symbols: np.ndarray, lines: List[float], interline: float) -> int:
+    """
+    Column where the treble clef ends.
+
+    The clef is the leftmost component taller than the staff; a treble clef
+    reaches past both the top and the bottom line, unlike bass and C clefs,
+    which pitches read with TREBLE_STEPS would get wrong.
+
+    Raises:
+        NotSimpleScore: If there is no treble clef at the start of the staff
+    """
+    staff_height = lines[-1] - lines[0]
+    count, _, stats, _ = cv2.connectedComponentsWithStats(symbols, connectivity=8)
+    clefs = [stats[i] for i in range(1, count) if stats[i, cv2.CC_STAT_HEIGHT] > 1.1 * staff_height
+             and stats[i, cv2.CC_STAT_LEFT] < 6 * interline]
+    if not clefs:
+        raise NotSimpleScore("No treble clef found")
+    clef = min(clefs, key=lambda s: s[cv2.CC_STAT_LEFT])
+    clef_top = clef[cv2.CC_STAT_TOP]
+    clef_bottom = clef_top + clef[cv2.CC_STAT_HEIGHT]
+    if clef_top > lines[0] - 0.5 * interline or clef_bottom < lines[-1] + 0.5 * interline:
+        raise NotSimpleScore("Clef is not a treble clef")
+
+    # Pieces the clef broke into (loop, dot) start inside its box
+    clef_end = clef[cv2.CC_STAT_LEFT] + clef[cv2.CC_STAT_WIDTH]
+    grown = True
+    while grown:
+        grown = False
+        for i in range(1, count):
+            x, y, w, h, _ = stats[i]
+            if x < clef_end < x + w and y >= clef_top and y + h <= clef_bottom:
+                clef_end, grown = x + w, True
+    return int(clef_end)
+
+
+def check_header(symbols: np.ndarray, lines: List[float], interline: float,
+                 clef_end: int, body_start: int) -> int:
+    """
+    Column where the header (clef and time signature) ends.
+
+    Between the clef and the first note head only a time signature is
+    allowed: glyphs that each fit in the upper or the lower half of the
+    staff, both halves used, within 2.5 interlines. Key signature
+    accidentals are taller than half the staff, so a key is never read as
+    C major.
+
+    Raises:
+        NotSimpleScore: If anything else sits between clef and first note
+    """
+    body_start = int(body_start - 0.3 * interline)
+    if body_start <= clef_end:
+        return clef_end
+    count, _, stats, _ = cv2.connectedComponentsWithStats(
+        np.ascontiguousarray(symbols[:, clef_end:body_start]), connectivity=8
+    )
+    glyphs = [stats[i] for i in range(1, count)
+              if stats[i, cv2.CC_STAT_AREA] >= 0.2 * interline * interline]
+    if not glyphs:
+        return clef_end
+
+    tolerance = 0.25 * interline
+    halves = set()
+    for x, y, w, h, _ in glyphs:
+        if y >= lines[0] - tolerance and y + h <= lines[2] + tolerance:
+            halves.add("upper")
+        elif y >= lines[2] - tolerance and y + h <= lines[-1] + tolerance:
+            halves.add("lower")
+        else:
+            raise NotSimpleScore("Key signature or other symbols between clef and first note")
+    left = min(g[cv2.CC_STAT_LEFT] for g in glyphs)
+    right = max(g[cv2.CC_STAT_LEFT] + g[cv2.CC_STAT_WIDTH] for g in glyphs)
+    if halves != {"upper", "lower"} or right - left > 2.5 * interline:
+        raise NotSimpleScore("Key signature or other symbols between clef and first note")
+    return clef_end + int(right)
+
+
+def find_note_heads(symbols: np.ndarray, interline: float, header_end: int) -> List[Dict]:
+    """
+    Note head candidates: blobs that survive an elliptical opening once
+    holes are filled (so hollow heads count too).
+    """
+    # Seal small breaks in hollow heads (pen gaps, erased staff line crossings)
+    seal = max(3, int(0.3 * interline)) | 1
+    sealed = cv2.morphologyEx(symbols, cv2.MORPH_CLOSE,
+                              cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (seal, seal)))
+    contours, _ = cv2.findContours(sealed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    filled = np.zeros_like(symbols)
+    cv2.drawContours(filled, contours, -1, 1, thickness=cv2.FILLED)
+
+    kernel = cv2.getStructuringElement(
+        cv2.MORPH_ELLIPSE, (max(3, int(0.8 * interline)), max(3, int(0.55 * interline)))
+    )
+    blobs = cv2.morphologyEx(filled, cv2.MORPH_OPEN, kernel)
+
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(blobs, connectivity=8)
+    heads = []
+    for i in range(1, count):
+        x, y, w, h, area = stats[i]
+        if x < header_end:
+            continue
+        if not (HEAD_WIDTH[0] * interline <= w <= HEAD_WIDTH[1] * interline):
+            continue
+        if not (HEAD_HEIGHT[0] * interline <= h <= HEAD_HEIGHT[1] * interline):
+            continue
+        mask = labels[y:y + h, x:x + w] == i
+        ink_ratio = float(symbols[y:y + h, x:x + w][mask].mean())
+        heads.append({
+            "x": int(x), "y": int(y), "width": int(w), "height": int(h),
+            "cx": float(centroids[i][0]), "cy": float(centroids[i][1]),
+            "filled": ink_ratio >= FILLED_RATIO,
+            "mask": (slice(y, y + h), slice(x, x + w), mask),
+        })
+    heads.sort(key=lambda head: head["cx"])
+    return heads
+
+
+def classify_notes(
+    symbols: np.ndarray,
+    stems: np.ndarray,
+    heads: List[Dict],
+    lines: List[float],
+    interline: float,
+    thickness: int
+) -> Tuple[List[Dict], set, np.ndarray]:
+    """
+    Attach stems and flags to heads and derive pitch and duration.
+
+    Returns:
+        (notes, labels of the stem components used, mask of explained ink)
+    """
+    count, stem_labels, stem_stats, _ = cv2.connectedComponentsWithStats(stems, connectivity=8)
+    explained = np.zeros_like(symbols)
+    used_stems = set()
+    notes = []
+    reach = int(0.35 * interline)
+    grow = cv2.getStructuringElement(cv2.MORPH_RECT, (2 * thickness + 1, 2 * thickness + 1))
+
+    for head in heads:
+        # A stem runs past the head's left or right edge and overlaps it vertically
+        stem = None
+        for label in range(1, count):
+            sx, sy, sw, sh, _ = stem_stats[label]
+            if sw > 0.5 * interline:
+                continue
+            near_x = head["x"] - reach <= sx + sw / 2 <= head["x"] + head["width"] + reach
+            near_y = sy - reach <= head["cy"] <= sy + sh + reach
+            if near_x and near_y and sh >= 2 * interline:
+                stem = label
+                break
+
+        flagged = False
+        if stem is not None:
+            used_stems.add(stem)
+            explained[stem_labels == stem] = 1
+            sx, sy, sw, sh, _ = stem_stats[stem]
+            up = sy + sh / 2 < head["cy"]
+            flagged, flag_region = find_flag(symbols, stems, sx, sw, sy, sh, up, interline)
+            if flagged:
+                explained[flag_region] |= symbols[flag_region]
+
+        if stem is None:
+            note_type = None if head["filled"] else "whole"
+        elif head["filled"]:
+            note_type = "eighth" if flagged else "quarter"
+        else:
+            note_type = "half"
+        if note_type is None:
+            continue  # filled head without a stem: not a note we understand (a rest?)
+
+        rows, cols, mask = head["mask"]
+        head_mask = np.zeros_like(symbols)
+        head_mask[rows, cols][mask] = 1
+        explained |= cv2.dilate(head_mask, grow)
+
+        # Half-interline steps above the bottom line (E4 on a treble staff,
+        # checked by find_treble_clef; no key signature, see check_header)
+        position = int(round((lines[-1] - head["cy"]) / (interline / 2)))
+        step = TREBLE_STEPS[position % 7]
+        octave = 4 + (position + 2) // 7
+        notes.append({
+            "x": head["cx"],
+            "step": step,
+            "octave": octave,
+            "type": note_type,
+            "stem": None if stem is None else ("up" if up else "down"),
+            "stem_label": stem,
+            "chord": False,
+        })
+
+    # Heads sharing a stem form a chord, which simple melodies do not have
+    by_stem = {}
+    for note in notes:
+        if note["stem_label"] is not None:
+            by_stem.setdefault(note["stem_label"], []).append(note)
+    for group in by_stem.values():
+        if len(group) > 1:
+            for note in group:
+                note["chord"] = True
+
+    return notes, used_stems, explained
+
+
+def count_accidentals(
+    symbols: np.ndarray,
+    stems: np.ndarray,
+    explained: np.ndarray,
+    heads: List[Dict],
+    used_stems: set,
+    barlines: List[Dict],
+    interline: float
+) -> int:
+    """
+    Accidentals found around the note heads:
+
+    - unexplained glyphs shaped like one (at least 1.5 interlines tall,
+      0.4 to 1.5 wide, so wider than a stray stroke) just left of a head
+      and level with it
+    - vertical strokes there that are neither a stem nor a bar line (the
+      uprights of sharps, naturals and flats)
+    - "heads" crossed by a vertical stroke that runs well past both sides,
+      which is the middle of a sharp or natural rather than a head with a stem
+    """
+    def left_of_head(x: float, y: float, height: float) -> bool:
+        return any(0 <= head["x"] - x <= 1.5 * interline and y <= head["cy"] <= y + height
+                   for head in heads)
+
+    found = 0
+    count, _, stats, _ = cv2.connectedComponentsWithStats(symbols & (1 - explained), connectivity=8)
+    for i in range(1, count):
+        x, y, w, h, _ = stats[i]
+        if h >= 1.5 * interline and 0.4 * interline <= w <= 1.5 * interline and left_of_head(x + w, y, h):
+            found += 1
+
+    barline_xs = [x for barline in barlines for x in barline["strokes"]]
+    count, _, stats, centroids = cv2.connectedComponentsWithStats(stems, connectivity=8)
+    for label in range(1, count):
+        sx, sy, sw, sh, _ = stats[label]
+        if label in used_stems or any(abs(centroids[label][0] - x) < 1 for x in barline_xs):
+            continue
+        if sw <= 0.5 * interline and left_of_head(sx + sw, sy, sh):
+            found += 1
+        for head in heads:
+            if (head["x"] <= sx + sw / 2 <= head["x"] + head["width"]
+                    and sy < head["cy"] - 1.2 * interline and sy + sh > head["cy"] + 1.2 * interline):
+                found += 1
+    return found
+
+
+def count_unexplained_glyphs(
+    symbols: np.ndarray,
+    explained: np.ndarray,
+    lines: List[float],
+    interline: float,
+    header_end: int
+) -> int:
+    """
+    Glyphs inside the staff that are neither notes, flags nor bar lines,
+    such as rests and augmentation dots.
+
+    Unexplained ink is opened first so thin leftovers of the staff lines
+    (rotation, uneven line thickness) do not count; a dot survives the
+    opening, a sliver of line does not.
+    """
+    size = max(3, int(0.25 * interline))
+    loose = cv2.morphologyEx(symbols & (1 - explained), cv2.MORPH_OPEN,
+                             cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size)))
+    count, _, stats, _ = cv2.connectedComponentsWithStats(loose, connectivity=8)
+    found = 0
+    for i in range(1, count):
+        x, y, w, h, area = stats[i]
+        if x < header_end or area < 0.03 * interline * interline:
+            continue
+        if y + h > lines[0] - 0.5 * interline and y < lines[-1] + 0.5 * interline:
+            found += 1
+    return found
+
+
+def find_flag(
+    symbols: np.ndarray,
+    stems: np.ndarray,
+    sx: int, sw: int, sy: int, sh: int,
+    up: bool,
+    interline: float
+) -> Tuple[bool, Tuple[slice, slice]]:
+    """
+    Look for a flag or beam leaving the far end of a stem.
+
+    Returns:
+        (found, region the flag may occupy: the stem's length beside it,
+        short of the head, where staff line removal can cut off the tip)
+    """
+    length = int(2 * interline)
+    if up:
+        rows = slice(max(0, sy - 2), sy + length)
+        reach = slice(max(0, sy - 2), max(sy + length, sy + sh - int(interline)))
+    else:
+        rows = slice(max(0, sy + sh - length), sy + sh + 2)
+        reach = slice(min(sy + sh - length, sy + int(interline)), sy + sh + 2)
+    cols = slice(max(0, sx - int(1.5 * interline)), sx + sw + int(1.5 * interline))
+
+    region = symbols[rows, cols] & (1 - stems[rows, cols])
+    return int(region.sum()) >= 0.25 * interline * interline, (reach, cols)
+
+
+def find_barlines(
+    stems: np.ndarray,
+    used_stems: set,
+    lines: List[float],
+    interline: float,
+    header_end: int
+) -> List[Dict]:
+    """
+    Vertical strokes spanning exactly the staff and not attached to a head.
+    Strokes closer than 1.5 interlines (double and final bar lines) make
+    one bar line; "strokes" keeps the x of each.
+    """
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(stems, connectivity=8)
+    tolerance = 0.5 * interline
+    strokes = []
+    for label in range(1, count):
+        if label in used_stems:
+            continue
+        x, y, w, h, _ = stats[label]
+        if x < header_end or w > 0.5 * interline:
+            continue
+        if abs(y - lines[0]) <= tolerance and abs(y + h - lines[-1]) <= tolerance:
+            strokes.append((float(centroids[label][0]), label))
+    strokes.sort()
+
+    barlines = []
+    for x, label in strokes:
+        if barlines and x - barlines[-1]["strokes"][-1] < 1.5 * interline:
+            barlines[-1]["strokes"].append(x)
+            barlines[-1]["mask"] |= labels == label
+        else:
+            barlines.append({"x": x, "strokes": [x], "mask": labels == label})
+    return barlines
+
+
+def build_measures(notes: List[Dict], barline_xs: List[float]) -> Tuple[int, List[List[Dict]], float]:
+    """
+    Split notes into measures and infer the time signature.
+
+    With bar lines, the most common measure length (in quarters) gives the
+    time signature and the consistency is the share of measures matching
+    it. Without bar lines 4/4 is assumed and measures are cut every four
+    beats. Rests are not read, so a measure without notes or a short final
+    measure (other than one completing a pickup) means beats are missing.
+
+    Returns:
+        (beats per measure, measures, consistency 0-1)
+
+    Raises:
+        NotSimpleScore: If a measure has no notes or the final measure is short
+    """
+    if not notes:
+        return 4, [], 0.0
+
+    if barline_xs:
+        measures = [[] for _ in range(len(barline_xs) + 1)]
+        for note in notes:
+            measures[int(np.searchsorted(barline_xs, note["x"]))].append(note)
+        # Nothing follows the final bar line
+        if not measures[-1]:
+            measures.pop()
+        for index, measure in enumerate(measures):
+            if not measure:
+                raise NotSimpleScore(f"Measure {index + 1} has no notes (a rest?)")
+        lengths = [sum(NOTE_TYPES[n["type"]] for n in measure) for measure in measures]
+
+        # Leave out the final measure and a pickup, which may be short
+        inner = lengths[1:-1] if len(lengths) > 2 and lengths[0] < max(lengths[1:-1]) else lengths[:-1]
+        candidates = [length for length in inner or lengths if float(length).is_integer()]
+        beats = int(max(set(candidates), key=candidates.count)) if candidates else 4
+        if beats not in (2, 3, 4, 5, 6):
+            return 4, measures, 0.0
+        return beats, measures, count_full_measures(lengths, beats) / len(lengths)
+
+    beats = 4
+    measures = [[]]
+    filled = 0.0
+    for note in notes:
+        if filled >= beats:
+            measures.append([])
+            filled = 0.0
+        measures[-1].append(note)
+        filled += NOTE_TYPES[note["type"]]
+    # Notes straddling a cut point mean the 4/4 guess does not fit
+    lengths = [sum(NOTE_TYPES[n["type"]] for n in measure) for measure in measures]
+    return beats, measures, count_full_measures(lengths, beats, pickup=False) / len(lengths)
+
+
+def count_full_measures(lengths: List[float], beats: int, pickup: bool = True) -> int:
+    """
+    Measures lasting exactly `beats` quarters. A short first measure (a
+    pickup) and the short final measure completing it count as full.
+
+    Raises:
+        NotSimpleScore: If the final measure is short and does not complete
+            a pickup, which is where a rest the recognizer skipped would be
+    """
+    full = sum(1 for length in lengths if length == beats)
+    if lengths[-1] < beats:
+        if pickup and len(lengths) > 1 and lengths[0] + lengths[-1] == beats:
+            return full + 2
+        raise NotSimpleScore(f"Final measure lasts {lengths[-1]:g} of {beats} beats (a rest?)")
+    return full
+
+
+def build_musicxml(measures: List[List[Dict]], beats: int, title: str = "") -> str:
+    """Write the recognized measures as a partwise MusicXML document."""
+    root = ET.Element("score-partwise", version="3.1")
+    work = ET.SubElement(root, "work")
+    ET.SubElement(work, "work-title").text = title or "Untitled"
+    part_list = ET.SubElement(root, "part-list")
+    score_part = ET.SubElement(part_list, "score-part", id="P1")
+    ET.SubElement(score_part, "part-name").text = "Melody"
+    part = ET.SubElement(root, "part", id="P1")
+
+    for number, notes in enumerate(measures, start=1):
+        measure = ET.SubElement(part, "measure", number=str(number))
+        if number == 1:
+            attributes = ET.SubElement(measure, "attributes")
+            ET.SubElement(attributes, "divisions").text = str(DIVISIONS)
+            key = ET.SubElement(attributes, "key")
+            ET.SubElement(key, "fifths").text = "0"
+            time_elem = ET.SubElement(attributes, "time")
+            ET.SubElement(time_elem, "beats").text = str(beats)
+            ET.SubElement(time_elem, "beat-type").text = "4"
+            clef = ET.SubElement(attributes, "clef")
+            ET.SubElement(clef, "sign").text = "G"
+            ET.SubElement(clef, "line").text = "2"
+
+        for note in notes:
+            note_elem = ET.SubElement(measure, "note")
+            pitch = ET.SubElement(note_elem, "pitch")
+            ET.SubElement(pitch, "step").text = note["step"]
+            ET.SubElement(pitch, "octave").text = str(note["octave"])
+            ET.SubElement(note_elem, "duration").text = str(int(NOTE_TYPES[note["type"]] * DIVISIONS))
+            ET.SubElement(note_elem, "type").text = note["type"]
+            if note["stem"]:
+                ET.SubElement(note_elem, "stem").text = note["stem"]
+
+    ET.indent(root)
+    body = ET.tostring(root, encoding="unicode")
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+        '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 3.1 Partwise//EN" '
+        '"http://www.musicxml.org/dtds/partwise.dtd">\n'
+        + body + "\n"
+    )
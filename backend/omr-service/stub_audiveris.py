@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Stand-in Audiveris engine for local testing and load testing.
+Mimics the Audiveris command line closely enough for audiveris_client.py,
+emitting canned MusicXML with a controllable delay and failure rate.
+
+Select it by pointing both Audiveris settings at this script (absolute path,
+since Audiveris runs inside the output directory):
+
+    JAVA_PATH=$PWD/stub_audiveris.py AUDIVERIS_JAR=$PWD/stub_audiveris.py
+
+Behaviour is tuned through environment variables:
+    STUB_AUDIVERIS_DELAY         Seconds spent "recognizing" each image (default 1.0)
+    STUB_AUDIVERIS_JITTER        Random +/- fraction applied to the delay (default 0.2)
+    STUB_AUDIVERIS_FAILURE_RATE  Probability (0-1) that a run fails (default 0.0)
+    STUB_AUDIVERIS_MUSICXML      Optional MusicXML file to emit instead of the built-in score
+"""
+
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+# Processing steps reported by Audiveris, in pipeline order
+STEPS = ["LOAD", "BINARY", "SCALE", "GRID", "HEADERS", "STEM_SEEDS", "BEAMS",
+         "LEDGERS", "HEADS", "STEMS", "REDUCTION", "MEASURES", "CHORDS",
+         "SYMBOLS", "RHYTHMS", "PAGE"]
+
+CANNED_MUSICXML = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 3.1 Partwise//EN" "http://www.musicxml.org/dtds/partwise.dtd">
+<score-partwise version="3.1">
+  <work>
+    <work-title>{title}</work-title>
+  </work>
+  <identification>
+    <creator type="composer">Stub Audiveris</creator>
+  </identification>
+  <part-list>
+    <score-part id="P1">
+      <part-name>Piano</part-name>
+    </score-part>
+  </part-list>
+  <part id="P1">
+{measures}
+  </part>
+</score-partwise>
+"""
+
+MELODY = [
+    [("C", 4), ("D", 4), ("E", 4), ("F", 4)],
+    [("G", 4), ("A", 4), ("B", 4), ("C", 5)],
+    [("C", 5), ("B", 4), ("A", 4), ("G", 4)],
+    [("F", 4), ("E", 4), ("D", 4), ("C", 4)],
+]
+
+
+def build_measure(number: int, pitches) -> str:
+    """Build one 4/4 measure of quarter notes."""
+    lines = [f'    <measure number="{number}">']
+    if number == 1:
+        lines.append(
+            "      <attributes><divisions>1</divisions>"
+            "<key><fifths>0</fifths><mode>major</mode></key>"
+            "<time><beats>4</beats><beat-type>4</beat-type></time>"
+            "<clef><sign>G</sign><line>2</line></clef></attributes>"
+        )
+        lines.append('      <sound tempo="120"/>')
+    for step, octave in pitches:
+        lines.append(
+            f"      <note><pitch><step>{step}</step><octave>{octave}</octave></pitch>"
+            "<duration>1</duration><type>quarter</type></note>"
+        )
+    lines.append("    </measure>")
+    return "\n".join(lines)
+
+
+def canned_score(title: str) -> str:
+    """Return the MusicXML document written for every recognized image."""
+    custom = os.getenv("STUB_AUDIVERIS_MUSICXML")
+    if custom:
+        return Path(custom).read_text(encoding="utf-8")
+
+    measures = "\n".join(
+        build_measure(i + 1, pitches) for i, pitches in enumerate(MELODY)
+    )
+    return CANNED_MUSICXML.format(title=title, measures=measures)
+
+
+def parse_args(argv):
+    """Split an Audiveris-style command line into inputs and output directory."""
+    inputs = []
+    output_dir = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in ("-jar", "-output"):
+            if arg == "-output" and i + 1 < len(argv):
+                output_dir = argv[i + 1]
+            i += 2
+            continue
+        if not arg.startswith("-"):
+            inputs.append(arg)
+        i += 1
+    return inputs, output_dir
+
+
+def main() -> int:
+    argv = sys.argv[1:]
+
+    # `java -version` is used as an installation check
+    if "-version" in argv:
+        print('openjdk version "17.0.0" (stub audiveris)', file=sys.stderr)
+        return 0
+
+    inputs, output_dir = parse_args(argv)
+    if not inputs:
+        print("ERROR No input file given", file=sys.stderr)
+        return 1
+
+    delay = float(os.getenv("STUB_AUDIVERIS_DELAY", "1.0"))
+    jitter = float(os.getenv("STUB_AUDIVERIS_JITTER", "0.2"))
+    failure_rate = float(os.getenv("STUB_AUDIVERIS_FAILURE_RATE", "0.0"))
+
+    output_path = Path(output_dir) if output_dir else Path.cwd()
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    for image in inputs:
+        stem = Path(image).stem
+        run_time = max(0.0, delay * (1 + random.uniform(-jitter, jitter)))
+        fail_at = random.randrange(len(STEPS)) if random.random() < failure_rate else None
+
+        for index, step in enumerate(STEPS):
+            print(f"INFO  [{stem}] Step {step} starting", flush=True)
+            time.sleep(run_time / len(STEPS))
+            if index == fail_at:
+                print(f"ERROR [{stem}] Step {step} failed (simulated)", file=sys.stderr, flush=True)
+                return 1
+
+        # Audiveris normally writes compressed .mxl; plain MusicXML keeps the stub dependency-free
+        target = output_path / f"{stem}.musicxml"
+        print(f"INFO  [{stem}] Exporting score to {target}", flush=True)
+        target.write_text(canned_score(stem), encoding="utf-8")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
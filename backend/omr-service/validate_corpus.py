@@ -0,0 +1,288 @@
+"""
+Batch validation tool for regression corpora of recognized scores.
+Validates every MusicXML/MXL file under one or more directories in a
+process pool, aggregates finding codes, statistics and timings, and
+compares two runs, e.g. Audiveris outputs before and after an engine
+upgrade:
+
+    python validate_corpus.py run outputs/old --json old.json
+    python validate_corpus.py run outputs/new --json new.json --csv new.csv --baseline old.json
+    python validate_corpus.py diff old.json new.json --fail-on-regression
+"""
+
+import argparse
+import csv
+import json
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from validation import FINDING_CODES, ScoreIndex, finding_code, parse_musicxml, score_validation_report
+
+SCORE_SUFFIXES = {".musicxml", ".xml", ".mxl"}
+# Corrected copies written by the service are not recognition outputs
+SKIPPED_SUFFIX = "_corrected"
+FINDING_KINDS = ("errors", "warnings", "corrections")
+# Worse statuses sort higher
+STATUS_RANK = {"valid": 0, "valid_with_warnings": 1, "invalid": 2, "error": 3}
+
+
+def find_scores(roots: List[Path]) -> List[Path]:
+    """MusicXML files under the given directories (or the files themselves), sorted."""
+    files = []
+    for root in roots:
+        if root.is_file():
+            files.append(root)
+            continue
+        for path in root.rglob("*"):
+            if (path.suffix.lower() in SCORE_SUFFIXES and path.is_file()
+                    and not path.stem.endswith(SKIPPED_SUFFIX)):
+                files.append(path)
+    return sorted(files)
+
+
+def validate_file(path: str) -> Dict:
+    """Validate one score (run in a worker process)."""
+    started = time.perf_counter()
+    try:
+        report = ScoreIndex(parse_musicxml(path)).report()
+    except Exception as e:
+        report = {"status": "error", "errors": [f"Validation failed: {e}"],
+                  "warnings": [], "corrections": [], "statistics": {}}
+    seconds = time.perf_counter() - started
+
+    codes = {kind: dict(Counter(finding_code(m) for m in report[kind])) for kind in FINDING_KINDS}
+    stats = report.get("statistics", {})
+    return {
+        "path": path,
+        "status": report["status"],
+        "seconds": round(seconds, 4),
+        "parts": stats.get("parts", 0),
+        "measures": stats.get("measures", 0),
+        "notes": stats.get("notes", 0),
+        "errors": len(report["errors"]),
+        "warnings": len(report["warnings"]),
+        "corrections": len(report["corrections"]),
+        "penalty": score_validation_report(report)["penalty"],
+        "codes": codes,
+        "messages": {kind: report[kind][:20] for kind in FINDING_KINDS},
+    }
+
+
+def summarize(files: List[Dict], wall_time: float, workers: int) -> Dict:
+    """Aggregate per-file results: statuses, code counts, totals and timings."""
+    code_counts = {kind: Counter() for kind in FINDING_KINDS}
+    for record in files:
+        for kind in FINDING_KINDS:
+            code_counts[kind].update(record["codes"][kind])
+
+    seconds = sorted(record["seconds"] for record in files)
+    return {
+        "files": len(files),
+        "workers": workers,
+        "wall_seconds": round(wall_time, 2),
+        "files_per_second": round(len(files) / wall_time, 1) if wall_time > 0 else None,
+        "statuses": dict(Counter(record["status"] for record in files)),
+        "codes": {kind: dict(counts.most_common()) for kind, counts in code_counts.items()},
+        "totals": {name: sum(record[name] for record in files)
+                   for name in ("measures", "notes", "errors", "warnings", "corrections", "penalty")},
+        "timing": {
+            "mean": round(statistics.mean(seconds), 4) if seconds else 0.0,
+            "p50": seconds[len(seconds) // 2] if seconds else 0.0,
+            "p95": seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))] if seconds else 0.0,
+            "max": seconds[-1] if seconds else 0.0,
+        },
+    }
+
+
+def run(roots: List[Path], workers: int) -> Dict:
+    """Validate all scores under roots; paths in the report are relative to their root."""
+    scores = find_scores(roots)
+    relative = {}
+    for path in scores:
+        root = next((r for r in roots if r.is_dir() and r in path.parents), path.parent)
+        relative[str(path)] = str(path.relative_to(root))
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunksize = max(1, len(scores) // (workers * 8))
+        files = list(pool.map(validate_file, [str(p) for p in scores], chunksize=chunksize))
+    wall_time = time.perf_counter() - started
+
+    for record in files:
+        record["path"] = relative[record["path"]]
+    return {
+        "roots": [str(r) for r in roots],
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "summary": summarize(files, wall_time, workers),
+        "files": files,
+    }
+
+
+def code_columns(files: List[Dict]) -> List[str]:
+    """CSV columns for the finding codes that occur, in FINDING_CODES order."""
+    seen = {(kind, code) for record in files for kind in FINDING_KINDS for code in record["codes"][kind]}
+    order = [code for code, _ in FINDING_CODES] + ["other"]
+    return [f"{kind}:{code}" for kind in FINDING_KINDS for code in order if (kind, code) in seen]
+
+
+def write_csv(report: Dict, path: str):
+    """One row per file with its counts, timing and per-code columns."""
+    files = report["files"]
+    columns = code_columns(files)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["path", "status", "seconds", "parts", "measures", "notes",
+                         "errors", "warnings", "corrections", "penalty"] + columns)
+        for record in files:
+            counts = [record["codes"][c.split(":")[0]].get(c.split(":")[1], 0) for c in columns]
+            writer.writerow([record[name] for name in ("path", "status", "seconds", "parts", "measures",
+                                                       "notes", "errors", "warnings", "corrections",
+                                                       "penalty")] + counts)
+
+
+def diff_runs(base: Dict, new: Dict) -> Dict:
+    """
+    Compare two runs file by file (matched by relative path).
+
+    A file regressed when its status got worse, its penalty rose or it lost
+    notes; it improved on the opposite. Code count deltas are summed over
+    the files present in both runs.
+    """
+    base_files = {record["path"]: record for record in base["files"]}
+    new_files = {record["path"]: record for record in new["files"]}
+    common = sorted(base_files.keys() & new_files.keys())
+
+    regressed, improved = [], []
+    code_deltas = {kind: Counter() for kind in FINDING_KINDS}
+    for path in common:
+        old, cur = base_files[path], new_files[path]
+        for kind in FINDING_KINDS:
+            code_deltas[kind].update(cur["codes"][kind])
+            code_deltas[kind].subtract(old["codes"][kind])
+
+        change = {
+            "path": path,
+            "status": [old["status"], cur["status"]],
+            "penalty": cur["penalty"] - old["penalty"],
+            "notes": cur["notes"] - old["notes"],
+            "seconds": round(cur["seconds"] - old["seconds"], 4),
+        }
+        worse = (STATUS_RANK.get(cur["status"], 3) > STATUS_RANK.get(old["status"], 3)
+                 or cur["penalty"] > old["penalty"] or cur["notes"] < old["notes"])
+        better = (STATUS_RANK.get(cur["status"], 3) < STATUS_RANK.get(old["status"], 3)
+                  or cur["penalty"] < old["penalty"] or cur["notes"] > old["notes"])
+        if worse:
+            regressed.append(change)
+        elif better:
+            improved.append(change)
+
+    base_timing, new_timing = base["summary"]["timing"], new["summary"]["timing"]
+    return {
+        "files": {
+            "common": len(common),
+            "added": sorted(new_files.keys() - base_files.keys()),
+            "removed": sorted(base_files.keys() - new_files.keys()),
+        },
+        "statuses": {"base": base["summary"]["statuses"], "new": new["summary"]["statuses"]},
+        "code_deltas": {kind: {code: n for code, n in sorted(deltas.items()) if n}
+                        for kind, deltas in code_deltas.items()},
+        "timing_delta": {name: round(new_timing[name] - base_timing[name], 4) for name in new_timing},
+        "regressed": sorted(regressed, key=lambda c: -c["penalty"]),
+        "improved": sorted(improved, key=lambda c: c["penalty"]),
+    }
+
+
+def print_summary(summary: Dict):
+    print(f"{summary['files']} files in {summary['wall_seconds']}s "
+          f"({summary['files_per_second']} files/s, {summary['workers']} workers)")
+    print("Statuses: " + ", ".join(f"{s}={n}" for s, n in sorted(summary["statuses"].items())))
+    for kind in FINDING_KINDS:
+        if summary["codes"][kind]:
+            print(f"{kind.capitalize()}: " + ", ".join(f"{c}={n}" for c, n in summary["codes"][kind].items()))
+    timing = summary["timing"]
+    print(f"Per file: mean {timing['mean']:.4f}s, p50 {timing['p50']:.4f}s, "
+          f"p95 {timing['p95']:.4f}s, max {timing['max']:.4f}s")
+
+
+def print_diff(diff: Dict, limit: int = 20):
+    files = diff["files"]
+    print(f"{files['common']} files compared, {len(files['added'])} added, {len(files['removed'])} removed")
+    print(f"Statuses: {diff['statuses']['base']} -> {diff['statuses']['new']}")
+    for kind, deltas in diff["code_deltas"].items():
+        if deltas:
+            print(f"{kind.capitalize()} delta: " + ", ".join(f"{c}={n:+d}" for c, n in deltas.items()))
+    print("Timing delta: " + ", ".join(f"{k} {v:+.4f}s" for k, v in diff["timing_delta"].items()))
+    print(f"{len(diff['regressed'])} regressed, {len(diff['improved'])} improved")
+    for change in diff["regressed"][:limit]:
+        print(f"  - {change['path']}: {change['status'][0]} -> {change['status'][1]}, "
+              f"penalty {change['penalty']:+d}, notes {change['notes']:+d}")
+
+
+def load_report(path: str) -> Dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    """Main function to run or compare corpus validations."""
+    parser = argparse.ArgumentParser(description="Validate corpora of recognized scores")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Validate all scores under directories")
+    run_parser.add_argument("roots", nargs="+", help="Directories (or files) with MusicXML/MXL scores")
+    run_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="Worker processes")
+    run_parser.add_argument("--json", dest="json_path", help="Write the full report to this file")
+    run_parser.add_argument("--csv", dest="csv_path", help="Write per-file results to this CSV file")
+    run_parser.add_argument("--baseline", help="Report of an earlier run to compare against")
+    run_parser.add_argument("--fail-on-regression", action="store_true",
+                            help="Exit with status 1 if any file regressed against the baseline")
+
+    diff_parser = commands.add_parser("diff", help="Compare two run reports")
+    diff_parser.add_argument("base", help="Report of the reference run")
+    diff_parser.add_argument("new", help="Report of the run to check")
+    diff_parser.add_argument("--json", dest="json_path", help="Write the comparison to this file")
+    diff_parser.add_argument("--fail-on-regression", action="store_true",
+                             help="Exit with status 1 if any file regressed")
+    args = parser.parse_args()
+
+    diff: Optional[Dict] = None
+    if args.command == "run":
+        roots = [Path(p) for p in args.roots]
+        missing = [str(p) for p in roots if not p.exists()]
+        if missing:
+            print(f"Path(s) not found: {', '.join(missing)}")
+            sys.exit(1)
+
+        report = run(roots, max(1, args.workers))
+        print_summary(report["summary"])
+        if args.json_path:
+            with open(args.json_path, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Report written to {args.json_path}")
+        if args.csv_path:
+            write_csv(report, args.csv_path)
+            print(f"CSV written to {args.csv_path}")
+        if args.baseline:
+            diff = diff_runs(load_report(args.baseline), report)
+            print_diff(diff)
+    else:
+        diff = diff_runs(load_report(args.base), load_report(args.new))
+        print_diff(diff)
+        if args.json_path:
+            with open(args.json_path, "w") as f:
+                json.dump(diff, f, indent=2)
+            print(f"Comparison written to {args.json_path}")
+
+    if diff is not None and args.fail_on_regression and diff["regressed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
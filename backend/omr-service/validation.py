@@ -1,15 +1,66 @@
 """
 Validation and correction module for OMR results.
 Ensures musical notation is valid and provides feedback.
+
+Checks run measure by measure, carrying the time signature, divisions and
+clef forward. The per-measure results are kept in a ScoreIndex, so after
+an edit only the changed measures (and those whose carried state changed)
+are validated again.
 """
 
 import xml.etree.ElementTree as ET
+from collections import OrderedDict
 from pathlib import Path
 import logging
-from typing import Dict, List, Tuple
+import os
+import threading
+import time
+import uuid
+import zipfile
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Score indexes kept in memory for incremental re-validation
+VALIDATION_INDEX_CACHE_SIZE = int(os.getenv("VALIDATION_INDEX_CACHE_SIZE", "32"))
+
+# Reasonable ranges for different clefs (MIDI note numbers)
+CLEF_RANGES = {
+    'G': (40, 84),  # Treble: E3 to C6
+    'F': (28, 67),  # Bass: E1 to G4
+    'C': (36, 79),  # Alto/Tenor: C2 to G5
+}
+
+VALID_NOTE_TYPES = {
+    'whole', 'half', 'quarter', 'eighth', '16th', '32nd', '64th', '128th',
+    'breve', 'long'
+}
+
+# State at the start of a part: 4/4, one division per quarter, treble clef
+DEFAULT_MEASURE_STATE = {"time": (4, 4), "divisions": 1, "clef": "G"}
+
+# Stable codes for report messages (for aggregating many reports), matched in order
+FINDING_CODES = [
+    ("duration_mismatch", "Duration mismatch"),
+    ("pitch_range", "outside typical range"),
+    ("incomplete_tie", "Incomplete tie"),
+    ("beam_end_without_begin", "Beam end without begin"),
+    ("no_measures", "No measures found"),
+    ("invalid_note_type", "Invalid note type"),
+    ("invalid_note_duration", "Invalid note duration"),
+    ("missing_time_signature", "Added missing time signature"),
+    ("unclosed_beam", "Unclosed beam"),
+    ("validation_failed", "Validation failed"),
+]
+
+
+class StaleRevision(Exception):
+    """An edit was based on another revision of the score index."""
+
+    def __init__(self, revision: str):
+        super().__init__(f"Score index is at revision {revision}")
+        self.revision = revision
+
 
 def validate_and_correct_musicxml(musicxml_path: str) -> Dict:
     """
@@ -22,46 +73,20 @@ def validate_and_correct_musicxml(musicxml_path: str) -> Dict:
     - Proper time signatures
     - Beam consistency
     
-    Returns validation report with corrections applied.
+    Corrections (a missing time signature, unclosed beams) are not written
+    back to a file: each corrected measure is returned in the report's
+    "patches" as its part id, measure number and index, and the replacement
+    measure XML. write_corrected_musicxml builds the full corrected file
+    from them on demand.
+    
+    Returns validation report with corrections and patches.
     """
     logger.info(f"Validating MusicXML: {musicxml_path}")
     
     try:
-        tree = ET.parse(musicxml_path)
-        root = tree.getroot()
-        
-        validation_report = {
-            "status": "valid",
-            "warnings": [],
-            "errors": [],
-            "corrections": [],
-            "statistics": {}
-        }
-        
-        # Run validation checks
-        validation_report = validate_time_signatures(root, validation_report)
-        validation_report = validate_measure_durations(root, validation_report)
-        validation_report = validate_pitch_ranges(root, validation_report)
-        validation_report = validate_note_durations(root, validation_report)
-        validation_report = check_rhythmic_consistency(root, validation_report)
-        
-        # Collect statistics
-        validation_report["statistics"] = collect_statistics(root)
-        
-        # Determine overall status
-        if validation_report["errors"]:
-            validation_report["status"] = "invalid"
-        elif validation_report["warnings"]:
-            validation_report["status"] = "valid_with_warnings"
-        
-        # If corrections were made, save the corrected file
-        if validation_report["corrections"]:
-            corrected_path = Path(musicxml_path).with_stem(
-                Path(musicxml_path).stem + "_corrected"
-            )
-            tree.write(str(corrected_path), encoding='utf-8', xml_declaration=True)
-            validation_report["corrected_file"] = str(corrected_path)
-            logger.info(f"Saved corrected file: {corrected_path}")
+        index = ScoreIndex(parse_musicxml(musicxml_path))
+        cache_score_index(musicxml_path, index)
+        validation_report = index.report(index.corrected_measures())
         
         logger.info(f"Validation complete: {validation_report['status']}")
         return validation_report
@@ -72,142 +97,411 @@ def validate_and_correct_musicxml(musicxml_path: str) -> Dict:
             "status": "error",
             "errors": [f"Validation failed: {str(e)}"],
             "warnings": [],
-            "corrections": []
+            "corrections": [],
+            "patches": []
         }
 
 
-def validate_time_signatures(root: ET.Element, report: Dict) -> Dict:
-    """Validate time signatures are present and consistent."""
-    parts = root.findall('.//part')
+def revalidate_measures(musicxml_path: str, edits: List[Dict],
+                        revision: Optional[str] = None) -> Dict:
+    """
+    Validate a score again after some of its measures were edited.
     
-    for part_idx, part in enumerate(parts):
-        measures = part.findall('.//measure')
-        
-        if not measures:
-            report["warnings"].append(f"Part {part_idx}: No measures found")
-            continue
-        
-        # Check if first measure has time signature
-        first_measure = measures[0]
-        time_sig = first_measure.find('.//time')
-        
-        if time_sig is None:
-            report["warnings"].append(
-                f"Part {part_idx}: No time signature in first measure, assuming 4/4"
-            )
+    Args:
+        musicxml_path: The recognized score the edits apply to
+        edits: Replaced measures, in the format of the report's patches
+            (part id, measure_index, xml; measure number optional)
+        revision: Revision of the index the edits are based on; when given
+            and different from the cached one, StaleRevision is raised so
+            the client can send all of its edits again. Without it the
+            index is rebuilt from the file first, so the edits must be all
+            edits made to the recognized score.
     
+    Returns:
+        Validation report of the edited score. Its patches are the
+        corrections made to the re-validated measures only, to apply on
+        top of the edits.
+    
+    Raises:
+        ValueError: If an edit does not name an existing measure or is not
+            a <measure> element
+        StaleRevision: See revision
+    """
+    started = time.perf_counter()
+    if revision is None:
+        index = ScoreIndex(parse_musicxml(musicxml_path))
+        cache_score_index(musicxml_path, index)
+    else:
+        index = get_score_index(musicxml_path)
+    with index.lock:
+        if revision is not None and revision != index.revision:
+            raise StaleRevision(index.revision)
+        revalidated = index.revalidate(edits)
+        report = index.report(revalidated & index.corrected_measures())
+    
+    report["revalidated"] = [index.measure_ref(part_idx, measure_idx)
+                             for part_idx, measure_idx in sorted(revalidated)]
+    report["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    logger.info(f"Re-validated {len(revalidated)} measures of {Path(musicxml_path).name} "
+                f"in {report['elapsed_ms']}ms (revision {index.revision})")
     return report
 
 
-def validate_measure_durations(root: ET.Element, report: Dict) -> Dict:
-    """Validate that measure durations match time signatures."""
-    parts = root.findall('.//part')
+class ScoreIndex:
+    """
+    Parsed score with the validation results of every measure and the
+    state (time signature, divisions, clef) in effect where it starts.
+    
+    Its revision is "<index id>:<edit count>". The random id differs for
+    every index built, so a revision from an index that was evicted,
+    rebuilt after a restart or built by another worker never matches.
+    """
     
-    for part_idx, part in enumerate(parts):
-        measures = part.findall('.//measure')
-        current_time_sig = (4, 4)  # Default 4/4
-        divisions = 1  # Default divisions
+    def __init__(self, root: ET.Element):
+        self.root = root
+        self.index_id = uuid.uuid4().hex
+        self.edit_count = 0
+        self.lock = threading.Lock()
+        self.parts = []
+        for part_idx, part in enumerate(root.findall('.//part')):
+            entry = {"id": part.get('id', f"P{part_idx + 1}"), "element": part, "measures": []}
+            self.parts.append(entry)
+            state = DEFAULT_MEASURE_STATE
+            for measure_idx, measure in enumerate(part.findall('.//measure')):
+                entry["measures"].append(None)
+                state = self._validate(part_idx, measure_idx, measure, state)
+    
+    @property
+    def revision(self) -> str:
+        return f"{self.index_id}:{self.edit_count}"
+    
+    def _validate(self, part_idx: int, measure_idx: int, measure: ET.Element, state: Dict) -> Dict:
+        findings, exit_state = validate_measure(measure, measure_idx, part_idx, state)
+        self.parts[part_idx]["measures"][measure_idx] = {
+            "element": measure,
+            "entry_state": state,
+            "exit_state": exit_state,
+            "findings": findings
+        }
+        return exit_state
+    
+    def measure_ref(self, part_idx: int, measure_idx: int) -> Dict:
+        measure = self.parts[part_idx]["measures"][measure_idx]["element"]
+        return {
+            "part": self.parts[part_idx]["id"],
+            "measure": measure.get('number', str(measure_idx + 1)),
+            "measure_index": measure_idx
+        }
+    
+    def corrected_measures(self) -> Set[Tuple[int, int]]:
+        return {(part_idx, measure_idx)
+                for part_idx, part in enumerate(self.parts)
+                for measure_idx, entry in enumerate(part["measures"])
+                if entry["findings"]["corrected"]}
+    
+    def revalidate(self, edits: Iterable[Dict]) -> Set[Tuple[int, int]]:
+        """
+        Replace edited measures and validate them again, followed by any
+        measures whose starting state changed as a result.
         
-        for measure_idx, measure in enumerate(measures):
-            measure_num = measure.get('number', str(measure_idx + 1))
-            
-            # Update time signature if present
-            time_elem = measure.find('.//time')
-            if time_elem is not None:
-                beats = time_elem.find('beats')
-                beat_type = time_elem.find('beat-type')
-                if beats is not None and beat_type is not None:
-                    current_time_sig = (int(beats.text), int(beat_type.text))
-            
-            # Update divisions if present
-            div_elem = measure.find('.//divisions')
-            if div_elem is not None:
-                divisions = int(div_elem.text)
-            
-            # Calculate expected duration
-            expected_duration = calculate_measure_duration(
-                current_time_sig[0],
-                current_time_sig[1],
-                divisions
-            )
-            
-            # Calculate actual duration
-            actual_duration = calculate_actual_duration(measure)
+        Returns:
+            (part index, measure index) of every re-validated measure
+        """
+        part_ids = {part["id"]: part_idx for part_idx, part in enumerate(self.parts)}
+        replaced = {}
+        for edit in edits:
+            part_idx = part_ids.get(edit.get("part"))
+            if part_idx is None:
+                raise ValueError(f"Unknown part: {edit.get('part')}")
+            measures = self.parts[part_idx]["measures"]
+            measure_idx = edit.get("measure_index")
+            if not isinstance(measure_idx, int) or not 0 <= measure_idx < len(measures):
+                raise ValueError(f"Part {edit['part']} has no measure index {measure_idx}")
+            try:
+                element = ET.fromstring(edit["xml"])
+            except (KeyError, TypeError, ET.ParseError) as e:
+                raise ValueError(f"Invalid measure XML for part {edit['part']}, "
+                                 f"index {measure_idx}: {e}")
+            if element.tag != 'measure':
+                raise ValueError(f"Expected a <measure> element, got <{element.tag}>")
+            replaced[(part_idx, measure_idx)] = element
+        
+        revalidated = set()
+        for part_idx in sorted({part_idx for part_idx, _ in replaced}):
+            part = self.parts[part_idx]
+            edited = sorted(measure_idx for p, measure_idx in replaced if p == part_idx)
+            for measure_idx in edited:
+                old = part["measures"][measure_idx]["element"]
+                new = replaced[(part_idx, measure_idx)]
+                new.tail = old.tail
+                children = list(part["element"])
+                part["element"][children.index(old)] = new
+                part["measures"][measure_idx]["element"] = new
             
-            # Check if durations match
-            if actual_duration != expected_duration:
-                tolerance = divisions * 0.1  # Allow small rounding errors
-                if abs(actual_duration - expected_duration) > tolerance:
-                    report["warnings"].append(
-                        f"Part {part_idx}, Measure {measure_num}: "
-                        f"Duration mismatch (expected {expected_duration}, got {actual_duration})"
-                    )
+            state = part["measures"][edited[0]]["entry_state"]
+            for measure_idx in range(edited[0], len(part["measures"])):
+                entry = part["measures"][measure_idx]
+                if measure_idx in edited or state != entry["entry_state"]:
+                    state = self._validate(part_idx, measure_idx, entry["element"], state)
+                    revalidated.add((part_idx, measure_idx))
+                elif measure_idx > edited[-1]:
+                    # Same state as before from here on: the rest is unchanged
+                    break
+                else:
+                    state = entry["exit_state"]
+        
+        self.edit_count += 1
+        return revalidated
     
-    return report
+    def report(self, patch_measures: Iterable[Tuple[int, int]] = ()) -> Dict:
+        """
+        Validation report assembled from the per-measure results, with
+        patches for the given corrected measures.
+        """
+        report = {
+            "status": "valid",
+            "warnings": [],
+            "errors": [],
+            "corrections": [],
+            "patches": [],
+            "statistics": {},
+            "revision": self.revision
+        }
+        
+        for part_idx, part in enumerate(self.parts):
+            if not part["measures"]:
+                report["warnings"].append(f"Part {part_idx}: No measures found")
+            for entry in part["measures"]:
+                for kind in ("warnings", "errors", "corrections"):
+                    report[kind].extend(entry["findings"][kind])
+        
+        for part_idx, measure_idx in sorted(patch_measures):
+            measure = self.parts[part_idx]["measures"][measure_idx]["element"]
+            report["patches"].append({
+                **self.measure_ref(part_idx, measure_idx),
+                "xml": ET.tostring(measure, encoding="unicode").strip()
+            })
+        
+        # Collect statistics
+        report["statistics"] = collect_statistics(self.parts)
+        
+        # Determine overall status
+        if report["errors"]:
+            report["status"] = "invalid"
+        elif report["warnings"]:
+            report["status"] = "valid_with_warnings"
+        
+        return report
 
 
-def validate_pitch_ranges(root: ET.Element, report: Dict) -> Dict:
-    """Validate that pitches are within reasonable ranges."""
-    # Define reasonable ranges for different clefs
-    clef_ranges = {
-        'G': (40, 84),  # Treble: E3 to C6 (MIDI note numbers)
-        'F': (28, 67),  # Bass: E1 to G4
-        'C': (36, 79),  # Alto/Tenor: C2 to G5
-    }
+_score_indexes = OrderedDict()
+_score_indexes_lock = threading.Lock()
+
+
+def cache_score_index(musicxml_path: str, index: ScoreIndex):
+    """Keep a score's index for re-validation (least recently used are dropped)."""
+    key = str(Path(musicxml_path).resolve())
+    with _score_indexes_lock:
+        _score_indexes[key] = index
+        _score_indexes.move_to_end(key)
+        while len(_score_indexes) > VALIDATION_INDEX_CACHE_SIZE:
+            _score_indexes.popitem(last=False)
+
+
+def get_score_index(musicxml_path: str) -> ScoreIndex:
+    """
+    The cached index of a score, or a new one built from the file (with a
+    new revision, so clients holding another revision re-send their edits).
+    """
+    key = str(Path(musicxml_path).resolve())
+    with _score_indexes_lock:
+        index = _score_indexes.get(key)
+        if index is not None:
+            _score_indexes.move_to_end(key)
+            return index
     
-    parts = root.findall('.//part')
+    index = ScoreIndex(parse_musicxml(musicxml_path))
+    cache_score_index(musicxml_path, index)
+    return index
+
+
+def parse_musicxml(path: str) -> ET.Element:
+    """
+    Parse a MusicXML file, plain or compressed (.mxl: the root file named
+    in META-INF/container.xml, else the first XML file in the archive).
+    """
+    if not zipfile.is_zipfile(path):
+        return ET.parse(path).getroot()
     
-    for part_idx, part in enumerate(parts):
-        # Find current clef
-        current_clef = 'G'  # Default to treble
-        clef_elem = part.find('.//clef')
-        if clef_elem is not None:
-            sign = clef_elem.find('sign')
-            if sign is not None:
-                current_clef = sign.text
-        
-        # Get range for this clef
-        min_pitch, max_pitch = clef_ranges.get(current_clef, (21, 108))
-        
-        # Check all pitches
-        pitches = part.findall('.//pitch')
-        for pitch in pitches:
-            step = pitch.find('step')
-            octave = pitch.find('octave')
-            alter = pitch.find('alter')
-            
-            if step is not None and octave is not None:
-                # Calculate MIDI note number
-                midi_note = pitch_to_midi(
-                    step.text,
-                    int(octave.text),
-                    int(alter.text) if alter is not None else 0
-                )
-                
-                if midi_note < min_pitch or midi_note > max_pitch:
-                    report["warnings"].append(
-                        f"Part {part_idx}: Pitch {step.text}{octave.text} "
-                        f"outside typical range for {current_clef} clef"
-                    )
+    with zipfile.ZipFile(path) as archive:
+        names = archive.namelist()
+        root_name = None
+        if "META-INF/container.xml" in names:
+            container = ET.fromstring(archive.read("META-INF/container.xml"))
+            rootfile = container.find('.//{*}rootfile')
+            if rootfile is not None:
+                root_name = rootfile.get('full-path')
+        if root_name is None:
+            candidates = [n for n in names if not n.startswith("META-INF/")
+                          and n.lower().endswith(('.xml', '.musicxml'))]
+            if not candidates:
+                raise ValueError(f"No MusicXML file in {path}")
+            root_name = candidates[0]
+        return ET.fromstring(archive.read(root_name))
+
+
+def validate_measure(measure: ET.Element, measure_idx: int, part_idx: int,
+                     state: Dict) -> Tuple[Dict, Dict]:
+    """
+    Run all checks on one measure, correcting what can be corrected.
     
-    return report
+    Args:
+        measure: The measure (modified in place by corrections)
+        measure_idx: Position of the measure in its part
+        part_idx: Position of the part in the score
+        state: Time signature, divisions and clef in effect before it
+    
+    Returns:
+        Findings (warnings, errors, corrections, whether the measure was
+        corrected, and its statistics) and the state after the measure
+    """
+    findings = {"warnings": [], "errors": [], "corrections": [], "corrected": False}
+    measure_num = measure.get('number', str(measure_idx + 1))
+    
+    if measure_idx == 0 and check_time_signature(measure, measure_num, part_idx, findings):
+        findings["corrected"] = True
+    
+    state = measure_state(measure, state)
+    check_measure_duration(measure, measure_num, part_idx, state, findings)
+    check_pitch_range(measure, part_idx, state["clef"], findings)
+    check_note_durations(measure, findings)
+    check_ties(measure, measure_num, part_idx, findings)
+    if check_beam_consistency(measure, measure_num, part_idx, findings):
+        findings["corrected"] = True
+    
+    findings["statistics"] = measure_statistics(measure)
+    return findings, state
 
 
-def validate_note_durations(root: ET.Element, report: Dict) -> Dict:
-    """Validate that note durations are reasonable."""
-    valid_types = {
-        'whole', 'half', 'quarter', 'eighth', '16th', '32nd', '64th', '128th',
-        'breve', 'long'
-    }
+def measure_state(measure: ET.Element, state: Dict) -> Dict:
+    """State in effect within a measure: the incoming one, updated by its attributes."""
+    state = dict(state)
     
-    notes = root.findall('.//note')
+    # Update time signature if present
+    time_elem = measure.find('.//time')
+    if time_elem is not None:
+        beats = time_elem.find('beats')
+        beat_type = time_elem.find('beat-type')
+        if beats is not None and beat_type is not None:
+            state["time"] = (int(beats.text), int(beat_type.text))
     
-    for note in notes:
+    # Update divisions if present
+    div_elem = measure.find('.//divisions')
+    if div_elem is not None:
+        state["divisions"] = int(div_elem.text)
+    
+    # Update clef if present
+    sign = measure.find('.//clef/sign')
+    if sign is not None and sign.text:
+        state["clef"] = sign.text
+    
+    return state
+
+
+def check_time_signature(measure: ET.Element, measure_num: str, part_idx: int, report: Dict) -> bool:
+    """
+    Make sure a part's first measure has a time signature, adding 4/4
+    (which the duration check assumes) when it has none.
+    
+    Returns:
+        True if the measure was corrected
+    """
+    if measure.find('.//time') is not None:
+        return False
+    
+    insert_time_signature(measure, 4, 4)
+    report["corrections"].append(
+        f"Part {part_idx}, Measure {measure_num}: Added missing time signature (4/4)"
+    )
+    return True
+
+
+def insert_time_signature(measure: ET.Element, beats: int, beat_type: int):
+    """
+    Add a time signature to a measure's attributes (created if missing),
+    after divisions and key as the MusicXML schema orders them.
+    """
+    attributes = measure.find('attributes')
+    if attributes is None:
+        attributes = ET.Element('attributes')
+        # Ahead of the notes, after a leading <print> if there is one
+        leading = 1 if len(measure) and measure[0].tag == 'print' else 0
+        measure.insert(leading, attributes)
+    
+    time_elem = ET.Element('time')
+    ET.SubElement(time_elem, 'beats').text = str(beats)
+    ET.SubElement(time_elem, 'beat-type').text = str(beat_type)
+    
+    position = 0
+    for i, child in enumerate(attributes):
+        if child.tag in ('footnote', 'level', 'divisions', 'key'):
+            position = i + 1
+    attributes.insert(position, time_elem)
+
+
+def check_measure_duration(measure: ET.Element, measure_num: str, part_idx: int,
+                           state: Dict, report: Dict):
+    """Check that the measure's duration matches the time signature."""
+    divisions = state["divisions"]
+    
+    # Calculate expected duration
+    expected_duration = calculate_measure_duration(state["time"][0], state["time"][1], divisions)
+    
+    # Calculate actual duration
+    actual_duration = calculate_actual_duration(measure)
+    
+    # Check if durations match
+    if actual_duration != expected_duration:
+        tolerance = divisions * 0.1  # Allow small rounding errors
+        if abs(actual_duration - expected_duration) > tolerance:
+            report["warnings"].append(
+                f"Part {part_idx}, Measure {measure_num}: "
+                f"Duration mismatch (expected {expected_duration}, got {actual_duration})"
+            )
+
+
+def check_pitch_range(measure: ET.Element, part_idx: int, clef: str, report: Dict):
+    """Check that pitches are within the typical range of the clef."""
+    min_pitch, max_pitch = CLEF_RANGES.get(clef, (21, 108))
+    
+    for pitch in measure.findall('.//pitch'):
+        step = pitch.find('step')
+        octave = pitch.find('octave')
+        alter = pitch.find('alter')
+        
+        if step is not None and octave is not None:
+            # Calculate MIDI note number
+            midi_note = pitch_to_midi(
+                step.text,
+                int(octave.text),
+                int(alter.text) if alter is not None else 0
+            )
+            
+            if midi_note < min_pitch or midi_note > max_pitch:
+                report["warnings"].append(
+                    f"Part {part_idx}: Pitch {step.text}{octave.text} "
+                    f"outside typical range for {clef} clef"
+                )
+
+
+def check_note_durations(measure: ET.Element, report: Dict):
+    """Check that note types are known and durations positive."""
+    for note in measure.findall('.//note'):
         note_type = note.find('type')
         duration = note.find('duration')
         
         # Check if type is valid
-        if note_type is not None and note_type.text not in valid_types:
+        if note_type is not None and note_type.text not in VALID_NOTE_TYPES:
             report["errors"].append(
                 f"Invalid note type: {note_type.text}"
             )
@@ -219,71 +513,148 @@ def validate_note_durations(root: ET.Element, report: Dict) -> Dict:
                 report["errors"].append(
                     f"Invalid note duration: {dur_value}"
                 )
-    
-    return report
 
 
-def check_rhythmic_consistency(root: ET.Element, report: Dict) -> Dict:
-    """Check for rhythmic inconsistencies and suggest corrections."""
-    parts = root.findall('.//part')
-    
-    for part_idx, part in enumerate(parts):
-        measures = part.findall('.//measure')
-        
-        for measure_idx, measure in enumerate(measures):
-            measure_num = measure.get('number', str(measure_idx + 1))
-            
-            # Check for tied notes
-            notes = measure.findall('.//note')
-            for i, note in enumerate(notes):
-                # Check if note has tie but next note doesn't
-                tie = note.find('.//tie[@type="start"]')
-                if tie is not None and i < len(notes) - 1:
-                    next_note = notes[i + 1]
-                    next_tie = next_note.find('.//tie[@type="stop"]')
-                    if next_tie is None:
-                        report["warnings"].append(
-                            f"Part {part_idx}, Measure {measure_num}: "
-                            f"Incomplete tie detected"
-                        )
-            
-            # Check for beam consistency
-            check_beam_consistency(measure, measure_num, part_idx, report)
-    
-    return report
+def check_ties(measure: ET.Element, measure_num: str, part_idx: int, report: Dict):
+    """Check that a tie started in the measure is stopped on the next note."""
+    notes = measure.findall('.//note')
+    for i, note in enumerate(notes):
+        # Check if note has tie but next note doesn't
+        tie = note.find('.//tie[@type="start"]')
+        if tie is not None and i < len(notes) - 1:
+            next_note = notes[i + 1]
+            next_tie = next_note.find('.//tie[@type="stop"]')
+            if next_tie is None:
+                report["warnings"].append(
+                    f"Part {part_idx}, Measure {measure_num}: "
+                    f"Incomplete tie detected"
+                )
 
 
-def check_beam_consistency(measure: ET.Element, measure_num: str, part_idx: int, report: Dict):
-    """Check that beams are properly opened and closed."""
-    beam_stack = []
+def check_beam_consistency(measure: ET.Element, measure_num: str, part_idx: int, report: Dict) -> bool:
+    """
+    Check that beams are properly opened and closed. An unclosed beam is
+    ended on its last note (or dropped when it never continued).
+    
+    Returns:
+        True if the measure was corrected
+    """
+    open_beams = {}  # beam number -> last beam element of the open group
     notes = measure.findall('.//note')
     
     for note in notes:
         beams = note.findall('.//beam')
         for beam in beams:
             beam_type = beam.text
+            number = beam.get('number', '1')
             if beam_type == 'begin':
-                beam_stack.append(beam.get('number', '1'))
+                open_beams[number] = (note, beam)
+            elif beam_type == 'continue' and number in open_beams:
+                open_beams[number] = (note, beam)
             elif beam_type == 'end':
-                if not beam_stack:
+                if open_beams.pop(number, None) is None:
                     report["warnings"].append(
                         f"Part {part_idx}, Measure {measure_num}: "
                         f"Beam end without begin"
                     )
-                else:
-                    beam_stack.pop()
     
-    if beam_stack:
-        report["warnings"].append(
-            f"Part {part_idx}, Measure {measure_num}: "
-            f"Unclosed beam(s)"
+    for number, (note, beam) in sorted(open_beams.items()):
+        if beam.text == 'continue':
+            beam.text = 'end'
+            action = "ended on its last note"
+        else:
+            note.remove(beam)
+            action = "removed (no second note)"
+        report["corrections"].append(
+            f"Part {part_idx}, Measure {measure_num}: Unclosed beam {number} {action}"
         )
+    return bool(open_beams)
 
 
-def collect_statistics(root: ET.Element) -> Dict:
-    """Collect statistics about the musical score."""
+def apply_measure_patches(root: ET.Element, patches: List[Dict]) -> int:
+    """
+    Replace measures of a parsed score by patched ones.
+    
+    Returns:
+        Number of measures replaced (patches whose part or measure no
+        longer matches are skipped)
+    """
+    parts = {part.get('id'): part for part in root.findall('.//part')}
+    applied = 0
+    for patch in patches:
+        part = parts.get(patch["part"])
+        if part is None:
+            continue
+        measures = part.findall('measure')
+        idx = patch["measure_index"]
+        if idx >= len(measures) or measures[idx].get('number') != patch["measure"]:
+            logger.warning(f"Skipping patch for part {patch['part']} measure {patch['measure']}: "
+                           f"not found")
+            continue
+        old = measures[idx]
+        new = ET.fromstring(patch["xml"])
+        new.tail = old.tail
+        part[list(part).index(old)] = new
+        applied += 1
+    return applied
+
+
+def write_corrected_musicxml(musicxml_path: str, patches: List[Dict]) -> str:
+    """
+    Write the corrected score next to the original (<stem>_corrected, plain
+    MusicXML even for .mxl input), applying the validation patches. An
+    existing, up-to-date file is reused.
+    
+    Returns:
+        Path of the corrected file
+    """
+    source = Path(musicxml_path)
+    suffix = ".musicxml" if source.suffix.lower() == ".mxl" else source.suffix
+    corrected_path = source.with_name(f"{source.stem}_corrected{suffix}")
+    if corrected_path.exists() and corrected_path.stat().st_mtime_ns >= source.stat().st_mtime_ns:
+        return str(corrected_path)
+    
+    tree = ET.ElementTree(parse_musicxml(musicxml_path))
+    applied = apply_measure_patches(tree.getroot(), patches)
+    
+    tmp = corrected_path.with_name(f"{corrected_path.name}.{os.getpid()}.tmp")
+    tree.write(str(tmp), encoding='utf-8', xml_declaration=True)
+    tmp.replace(corrected_path)
+    logger.info(f"Saved corrected file: {corrected_path} ({applied} measures patched)")
+    return str(corrected_path)
+
+
+def measure_statistics(measure: ET.Element) -> Dict:
+    """Note, rest and chord counts and the key and time signatures of a measure."""
+    notes = measure.findall('.//note')
+    stats = {
+        "notes": len([n for n in notes if n.find('rest') is None]),
+        "rests": len([n for n in notes if n.find('rest') is not None]),
+        "chords": len([n for n in notes if n.find('chord') is not None]),
+        "key_signatures": [],
+        "time_signatures": []
+    }
+    
+    for key in measure.findall('.//key'):
+        fifths = key.find('fifths')
+        mode = key.find('mode')
+        if fifths is not None:
+            mode_text = mode.text if mode is not None else 'major'
+            stats["key_signatures"].append(f"{int(fifths.text)} ({mode_text})")
+    
+    for time_elem in measure.findall('.//time'):
+        beats = time_elem.find('beats')
+        beat_type = time_elem.find('beat-type')
+        if beats is not None and beat_type is not None:
+            stats["time_signatures"].append(f"{beats.text}/{beat_type.text}")
+    
+    return stats
+
+
+def collect_statistics(parts: List[Dict]) -> Dict:
+    """Collect statistics about the musical score from its indexed measures."""
     stats = {
-        "parts": 0,
+        "parts": len(parts),
         "measures": 0,
         "notes": 0,
         "rests": 0,
@@ -293,45 +664,26 @@ def collect_statistics(root: ET.Element) -> Dict:
         "time_signatures": []
     }
     
-    parts = root.findall('.//part')
-    stats["parts"] = len(parts)
-    
-    all_notes = root.findall('.//note')
-    stats["notes"] = len([n for n in all_notes if n.find('rest') is None])
-    stats["rests"] = len([n for n in all_notes if n.find('rest') is not None])
-    stats["chords"] = len([n for n in all_notes if n.find('chord') is not None])
+    key_sigs = set()
+    time_sigs = set()
+    for part in parts:
+        for entry in part["measures"]:
+            measure_stats = entry["findings"]["statistics"]
+            for name in ("notes", "rests", "chords"):
+                stats[name] += measure_stats[name]
+            key_sigs.update(measure_stats["key_signatures"])
+            time_sigs.update(measure_stats["time_signatures"])
+    stats["key_signatures"] = sorted(key_sigs)
+    stats["time_signatures"] = sorted(time_sigs)
     
     if parts:
-        measures = parts[0].findall('.//measure')
-        stats["measures"] = len(measures)
+        stats["measures"] = len(parts[0]["measures"])
         
         if stats["measures"] > 0:
             stats["average_notes_per_measure"] = round(
                 stats["notes"] / stats["measures"], 2
             )
     
-    # Collect unique key signatures
-    keys = root.findall('.//key')
-    key_sigs = set()
-    for key in keys:
-        fifths = key.find('fifths')
-        mode = key.find('mode')
-        if fifths is not None:
-            key_num = int(fifths.text)
-            mode_text = mode.text if mode is not None else 'major'
-            key_sigs.add(f"{key_num} ({mode_text})")
-    stats["key_signatures"] = list(key_sigs)
-    
-    # Collect unique time signatures
-    times = root.findall('.//time')
-    time_sigs = set()
-    for time in times:
-        beats = time.find('beats')
-        beat_type = time.find('beat-type')
-        if beats is not None and beat_type is not None:
-            time_sigs.add(f"{beats.text}/{beat_type.text}")
-    stats["time_signatures"] = list(time_sigs)
-    
     return stats
 
 
@@ -370,3 +722,37 @@ def pitch_to_midi(step: str, octave: int, alter: int = 0) -> int:
     note_offsets = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
     base = note_offsets.get(step, 0)
     return (octave + 1) * 12 + base + alter
+
+
+def finding_code(message: str) -> str:
+    """Code of a warning, error or correction message (see FINDING_CODES)."""
+    for code, text in FINDING_CODES:
+        if text in message:
+            return code
+    return "other"
+
+
+def score_validation_report(report: Dict) -> Dict:
+    """
+    Summarize a validation report as a penalty for comparing recognitions
+    of the same image (lower is better).
+    
+    Errors weigh most, duration mismatches more than other warnings, and a
+    score without any recognized notes is treated as a failed recognition.
+    """
+    errors = report.get("errors", [])
+    warnings = report.get("warnings", [])
+    duration_mismatches = len([w for w in warnings if "Duration mismatch" in w])
+    notes = report.get("statistics", {}).get("notes", 0)
+    
+    penalty = 10 * len(errors) + 3 * duration_mismatches + (len(warnings) - duration_mismatches)
+    if report.get("status") == "error" or notes == 0:
+        penalty += 100
+    
+    return {
+        "penalty": penalty,
+        "errors": len(errors),
+        "warnings": len(warnings),
+        "duration_mismatches": duration_mismatches,
+        "notes": notes
+    }
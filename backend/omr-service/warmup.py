@@ -0,0 +1,211 @@
+"""
+Startup warm-up for the OMR service.
+The app starts answering health checks before the heavy parts are loaded;
+a background thread then imports OpenCV and the pipeline modules, runs a
+tiny synthetic score through preprocessing and the native recognizer,
+loads music21 with a MIDI conversion and checks the Audiveris
+installation. Readiness (/ready) turns true once that is done, so the
+first real request does not pay for any of it.
+"""
+
+import importlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Set to false to skip the warm-up (the service is then ready right away)
+OMR_WARMUP = os.getenv("OMR_WARMUP", "true").lower() == "true"
+
+# Modules imported on first use by request handlers
+HEAVY_MODULES = ("numpy", "cv2", "preprocessor", "quality", "simple_recognizer")
+
+# Smallest score music21 accepts, converted to MIDI once
+WARMUP_MUSICXML = """<?xml version="1.0" encoding="UTF-8"?>
+<score-partwise version="3.1">
+  <part-list><score-part id="P1"><part-name>Warm-up</part-name></score-part></part-list>
+  <part id="P1">
+    <measure number="1">
+      <attributes>
+        <divisions>1</divisions>
+        <time><beats>4</beats><beat-type>4</beat-type></time>
+        <clef><sign>G</sign><line>2</line></clef>
+      </attributes>
+      <note><pitch><step>C</step><octave>5</octave></pitch><duration>4</duration><type>whole</type></note>
+    </measure>
+  </part>
+</score-partwise>
+"""
+
+
+class WarmupState:
+    """Progress of the warm-up, reported by the readiness endpoint."""
+
+    def __init__(self):
+        self.ready = False
+        self.started_at = None
+        self.finished_at = None
+        self.steps = []
+        self._lock = threading.Lock()
+
+    def record(self, name: str, status: str, seconds: float, detail: Optional[str] = None):
+        with self._lock:
+            self.steps.append({"name": name, "status": status,
+                               "seconds": round(seconds, 3), "detail": detail})
+
+    def mark_ready(self):
+        with self._lock:
+            self.ready = True
+            self.finished_at = time.time()
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            data = {
+                "ready": self.ready,
+                "steps": list(self.steps),
+            }
+            if self.started_at and self.finished_at:
+                data["warmup_seconds"] = round(self.finished_at - self.started_at, 3)
+            return data
+
+
+warmup_state = WarmupState()
+
+
+def synthetic_score(path: Path, interline: int = 16):
+    """Write a small image of one treble staff with a few quarter notes."""
+    import cv2
+    import numpy as np
+
+    width, height = 40 * interline, 12 * interline
+    image = np.full((height, width), 235, np.uint8)
+    top = 4 * interline
+    bottom = top + 4 * interline
+    for i in range(5):
+        y = top + i * interline
+        cv2.line(image, (interline, y), (width - interline, y), 20, 2)
+    # Crude treble clef: a loop on the G line and a stroke past both ends of the staff
+    cv2.circle(image, (int(1.9 * interline), bottom - interline), int(0.7 * interline), 20, 2)
+    cv2.line(image, (int(2.3 * interline), top - interline), (int(1.5 * interline), bottom + interline), 20, 2)
+
+    for i, position in enumerate((2, 4, 6, 4, 3, 5, 7, 2)):
+        x = int((6.5 + 4 * i) * interline)
+        y = bottom - position * interline // 2
+        cv2.ellipse(image, (x, y), (int(0.65 * interline), int(0.45 * interline)),
+                    -20, 0, 360, 20, -1)
+        cv2.line(image, (x + int(0.6 * interline), y), (x + int(0.6 * interline),
+                 y - int(3.5 * interline)), 20, 2)
+    for x in (width // 2, width - interline):
+        cv2.line(image, (x, top), (x, bottom), 20, 2)
+    cv2.imwrite(str(path), image)
+
+
+def import_modules() -> str:
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
+    return ", ".join(HEAVY_MODULES)
+
+
+def warm_pipeline() -> str:
+    """Run the quality gate, preprocessing and native recognition once."""
+    from audiveris_client import recognize_score
+    from preprocessor import preprocess_handwritten_music
+    from quality import ImageQualityError, check_image_quality
+    from simple_recognizer import NotSimpleScore
+    from validation import validate_and_correct_musicxml
+
+    with tempfile.TemporaryDirectory(prefix="omr-warmup-") as tmp:
+        input_path = Path(tmp) / "warmup.png"
+        synthetic_score(input_path)
+        try:
+            check_image_quality(str(input_path))
+        except ImageQualityError as e:
+            logger.info(f"Warm-up image rejected by quality gate ({e.reason}), continuing")
+
+        preprocessing = {"apply_smoothing": True}
+        preprocessed = preprocess_handwritten_music(str(input_path), tmp, **preprocessing)
+        try:
+            result = recognize_score(preprocessed, tmp, engine="native",
+                                     context={"input_path": str(input_path),
+                                              "preprocessing": preprocessing})
+        except NotSimpleScore as e:
+            return f"native recognizer declined: {e}"
+        validate_and_correct_musicxml(result["files"]["musicxml"])
+        return f"native recognizer found {result['native']['notes']} notes"
+
+
+def warm_music21() -> Optional[str]:
+    """Import music21 and convert a one-note score to MIDI; None if unavailable."""
+    from audiveris_client import convert_to_midi
+
+    with tempfile.TemporaryDirectory(prefix="omr-warmup-") as tmp:
+        musicxml_path = Path(tmp) / "warmup.musicxml"
+        musicxml_path.write_text(WARMUP_MUSICXML, encoding="utf-8")
+        if convert_to_midi(str(musicxml_path)) is None:
+            return None
+    return "MIDI conversion ready"
+
+
+def warm_audiveris() -> Optional[str]:
+    """
+    Check Java and the Audiveris JAR (starting the JVM once) and read the
+    JAR so the first recognition starts from the page cache; None if
+    Audiveris is not installed.
+    """
+    from audiveris_client import AUDIVERIS_JAR, check_audiveris_installation
+
+    if not check_audiveris_installation():
+        return None
+    size = 0
+    with open(AUDIVERIS_JAR, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            size += len(chunk)
+    return f"{AUDIVERIS_JAR} ({size / 1_000_000:.1f} MB)"
+
+
+WARMUP_STEPS: List[tuple] = [
+    ("imports", import_modules),
+    ("pipeline", warm_pipeline),
+    ("music21", warm_music21),
+    ("audiveris", warm_audiveris),
+]
+
+
+def run_warmup(state: WarmupState = warmup_state,
+               steps: Optional[List[tuple]] = None):
+    """
+    Run the warm-up steps in order, then mark the service ready. A failing
+    step is logged and reported but does not keep the service unready:
+    requests that need the missing part fail on their own.
+    """
+    state.started_at = time.time()
+    for name, step in steps or WARMUP_STEPS:
+        started = time.monotonic()
+        try:
+            detail = step()
+            status = "ok" if detail is not None else "unavailable"
+        except Exception as e:
+            logger.warning(f"Warm-up step {name} failed: {e}")
+            detail, status = str(e), "failed"
+        elapsed = time.monotonic() - started
+        state.record(name, status, elapsed, detail)
+        logger.info(f"Warm-up {name}: {status} in {elapsed:.2f}s" + (f" ({detail})" if detail else ""))
+
+    state.mark_ready()
+    logger.info(f"Service ready after {state.finished_at - state.started_at:.2f}s of warm-up")
+
+
+def start_warmup(state: WarmupState = warmup_state) -> Optional[threading.Thread]:
+    """Start the warm-up in a background thread (or mark ready if disabled)."""
+    if not OMR_WARMUP:
+        state.started_at = time.time()
+        state.mark_ready()
+        return None
+    thread = threading.Thread(target=run_warmup, args=(state,), name="omr-warmup", daemon=True)
+    thread.start()
+    return thread